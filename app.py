@@ -1,7 +1,8 @@
-from flask import Flask, render_template, request, jsonify
-from os import remove
-from os.path import isfile
+from flask import Flask, Response, g, render_template, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from os.path import basename, splitext
 from werkzeug.datastructures import ImmutableDict
+from zipfile import BadZipFile, ZipFile
 
 from rules.services import (
     # import common keys of json replies
@@ -10,17 +11,89 @@ from rules.services import (
     STATUS_FAIL, STATUS_SUCCESS, 
     # import common messages
     NO_MULTIPART_MESSAGE, EMPTY_MESSAGE, ALL_VALUES_NOT_PASSED_MESSAGE, EXTENSION_NOT_SUPPORTED_MESSAGE,
+    NOT_DECODABLE_MESSAGE, BACKEND_NOT_SUPPORTED_MESSAGE, ARCHIVE_TOO_LARGE_MESSAGE, BUSY_MESSAGE,
+    INFERENCE_TIMEOUT_MESSAGE, TOP_K_NOT_SUPPORTED_MESSAGE, THRESHOLD_NOT_SUPPORTED_MESSAGE,
     # import a costant with the name of content type of the http request
-    MULTIPART_FORM_DATA,
+    MULTIPART_FORM_DATA, OCTET_STREAM, NDJSON, FRAME_HEADER_BYTES,
     # import the supported file extensions for images
     SUPPORTED_IMAGE_EXTENSIONS,
+    # import the default and the supported detector backends
+    BACKEND, SUPPORTED_BACKENDS,
     # import json requests param values
-    FIELD_IMG, FIELD_INFO, FIELD_IDENTITY, 
+    FIELD_IMG, FIELD_INFO, FIELD_IDENTITY, FIELD_ARCHIVE, FIELD_BACKEND, FIELD_STRIDE, FIELD_CSV,
+    FIELD_K, FIELD_THRESHOLD,
+    # import the default stride of the streams, the default and maximum candidates of a face, and the archives size
+    STREAM_FRAME_STRIDE, TOP_K, MAX_TOP_K, MAX_ARCHIVE_BYTES,
     # import the services of the facade
-    upload_representation, remove_representation, find_representations, verify_representation, extract_faces  
+    upload_representation, remove_representation, find_representations, verify_representation, extract_faces,
+    find_representations_batch, analyze_image, identify_stream, read_enrolments, upload_representations_bulk,
+    get_gallery_cache_stats, get_batching_stats, get_detection_cache_stats, is_ready, decode_image,
+    # import the executor of the inferences
+    inference_executor
 )
+from rules.executor import QueueFullError, InferenceTimeoutError
+from rules.metrics import metrics_registry, stage_histogram, PROMETHEUS_CONTENT_TYPE
+
+import logging
+import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+# The metrics of the requests, exposed by the /metrics endpoint
+serialize_seconds = stage_histogram('serialize')
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """
+        The default JSON provider of Flask, that also measures the serialization of the replies
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        with serialize_seconds.time():
+            return super().dumps(obj, **kwargs)
+
 
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
+
+@app.before_request
+def start_inference():
+    # The inference workers are started by the first request, and never at import: the spawned
+    # workers import this module again, and would start their own workers recursively
+    inference_executor.start()
+
+
+@app.before_request
+def start_timer():
+    g.request_tic = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    # The route template is used as label, so the number of series does not grow with the urls
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    if 'request_tic' in g:
+        metrics_registry.histogram('deepface_request_seconds', 'The seconds spent serving every request',
+                                   endpoint=endpoint).observe(time.perf_counter() - g.request_tic)
+
+    metrics_registry.counter('deepface_requests_total', 'The number of served requests',
+                             endpoint=endpoint, code=response.status_code).inc()
+
+    return response
+
+
+@app.errorhandler(QueueFullError)
+def queue_full(error):
+    # Too many inferences are waiting: refuse the request, so that the client can retry later
+    return jsonify({KEY_MESSAGE: BUSY_MESSAGE,
+                    KEY_STATUS: STATUS_FAIL}), 503
+
+
+@app.errorhandler(InferenceTimeoutError)
+def inference_timeout(error):
+    return jsonify({KEY_MESSAGE: INFERENCE_TIMEOUT_MESSAGE,
+                    KEY_STATUS: STATUS_FAIL}), 504
 
 
 @app.route('/')
@@ -32,7 +105,8 @@ def home():
 def detect_coordinates():
     """
         This method is used to detect the coordinates of a face into the input image
-            - img:  the image in which the face will be detected
+            - img:      the image in which the face will be detected
+            - backend:  the detector backend, optional
     """
     message = {KEY_MESSAGE: NO_MULTIPART_MESSAGE, 
                KEY_STATUS: STATUS_FAIL}
@@ -50,17 +124,29 @@ def detect_coordinates():
         if img is None:
             return jsonify({KEY_MESSAGE: 'img Field must be present and be not empty'})
         
-        temp_file_name = img.filename
+        file_name = img.filename
         
         # Check the supported extensions
-        if not temp_file_name.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
+        if not file_name.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
             return jsonify({KEY_MESSAGE: EXTENSION_NOT_SUPPORTED_MESSAGE,
                             KEY_STATUS: STATUS_FAIL})
         
-        img.save(temp_file_name) # Save the image as local file
+        # Get the detector backend, if the request overrides the default one
+        backend = input_arg.get(FIELD_BACKEND) or BACKEND
+
+        if backend not in SUPPORTED_BACKENDS:
+            return jsonify({KEY_MESSAGE: BACKEND_NOT_SUPPORTED_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        # Decode the uploaded image in memory, without writing it to the disk
+        img_array = decode_image(img.read())
+
+        if img_array is None:
+            return jsonify({KEY_MESSAGE: NOT_DECODABLE_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
 
         try:
-            coordinates = extract_faces(temp_file_name)
+            coordinates = extract_faces(img_array, backend=backend)
 
             message = {KEY_MESSAGE: 'Coordinates found',
                         KEY_STATUS: STATUS_SUCCESS,
@@ -69,8 +155,6 @@ def detect_coordinates():
             message = {KEY_MESSAGE: 'Could not detect any face in the given image',
                            KEY_STATUS: STATUS_FAIL}
 
-        if isfile(temp_file_name): remove(temp_file_name)  # clean temporary file
-
     return jsonify(message)
 
 
@@ -78,7 +162,8 @@ def detect_coordinates():
 def detect_faceboxes():
     """
         This method is used to detect the coordinates of a face into the input image
-            - img:  the image in which the face will be detected
+            - img:      the image in which the face will be detected
+            - backend:  the detector backend, optional
     """
     message = {KEY_MESSAGE: NO_MULTIPART_MESSAGE,
                KEY_STATUS: STATUS_FAIL}
@@ -96,17 +181,30 @@ def detect_faceboxes():
         if img is None:
             return jsonify({KEY_MESSAGE: 'img Field must be present and be not empty'})
         
-        temp_file_name = img.filename
+        file_name = img.filename
         
         # Check the supported extensions
-        if not temp_file_name.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
+        if not file_name.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
             return jsonify({KEY_MESSAGE: EXTENSION_NOT_SUPPORTED_MESSAGE,
                             KEY_STATUS: STATUS_FAIL})
         
-        img.save(temp_file_name) # Save the image as local file
+        # Get the detector backend, if the request overrides the default one
+        backend = input_arg.get(FIELD_BACKEND) or BACKEND
+
+        if backend not in SUPPORTED_BACKENDS:
+            return jsonify({KEY_MESSAGE: BACKEND_NOT_SUPPORTED_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        # Decode the uploaded image in memory, without writing it to the disk
+        img_array = decode_image(img.read())
+
+        if img_array is None:
+            return jsonify({KEY_MESSAGE: NOT_DECODABLE_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
 
         try:
-            b64_img = extract_faces(temp_file_name, return_image=True)
+            b64_img = extract_faces(img_array, return_image=True, extension=splitext(file_name)[1],
+                                   backend=backend)
             message = {KEY_MESSAGE: 'Face detected',
                         KEY_STATUS: STATUS_SUCCESS,
                         KEY_IMG_B64: b64_img}
@@ -114,8 +212,6 @@ def detect_faceboxes():
             message = {KEY_MESSAGE: 'Could not detect any face in the given image',
                         KEY_STATUS: STATUS_FAIL}
 
-        if isfile(temp_file_name): remove(temp_file_name)  # clean temporary file
-
     return jsonify(message)
 
 
@@ -126,6 +222,7 @@ def verify():
         by a username.
             - img:      a base64 encoded image that must contains a single face to be verfied
             - identity: the stored id of the person searched in the img
+            - backend:  the detector backend, optional
     """
     message = {KEY_MESSAGE: NO_MULTIPART_MESSAGE,
                KEY_STATUS: STATUS_FAIL}
@@ -153,18 +250,28 @@ def verify():
                 return jsonify({KEY_MESSAGE: 'Identity field has not been setted',
                                 KEY_STATUS: STATUS_FAIL})
         
-        temp_file_name = img.filename
+        file_name = img.filename
         
         # Check the supported extensions
-        if not temp_file_name.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
+        if not file_name.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
             return jsonify({KEY_MESSAGE: EXTENSION_NOT_SUPPORTED_MESSAGE,
                             KEY_STATUS: STATUS_FAIL})
         
-        img.save(temp_file_name) # Save the image as local file
-        message = verify_representation(temp_file_name, identity)
+        # Get the detector backend, if the request overrides the default one
+        backend = input_arg.get(FIELD_BACKEND) or BACKEND
 
-        # Clean temporary file
-        if isfile(temp_file_name): remove(temp_file_name)  
+        if backend not in SUPPORTED_BACKENDS:
+            return jsonify({KEY_MESSAGE: BACKEND_NOT_SUPPORTED_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        # Decode the uploaded image in memory, without writing it to the disk
+        img_array = decode_image(img.read())
+
+        if img_array is None:
+            return jsonify({KEY_MESSAGE: NOT_DECODABLE_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        message = verify_representation(img_array, identity, backend=backend)
 
     return jsonify(message)
 
@@ -178,6 +285,7 @@ def represent():
             - img:      base64 encoded image that must contain a single face
             - identity: unique identity of the input face
             - info:     additional info about the identity
+            - backend:  the detector backend, optional
         Returns:        a message that determines the status of the request
     """
     message = {KEY_MESSAGE: NO_MULTIPART_MESSAGE,
@@ -203,18 +311,86 @@ def represent():
         if not is_input_correct:
             return jsonify(message)
         
-        temp_file_name = img.filename
+        file_name = img.filename
 
         # Check the supported extensions
-        if not temp_file_name.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
+        if not file_name.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
             return jsonify({KEY_MESSAGE: EXTENSION_NOT_SUPPORTED_MESSAGE,
                             KEY_STATUS: STATUS_FAIL})
 
-        img.save(temp_file_name) # Save the image as local file
-        message = upload_representation(temp_file_name, username, info)
-        
-        # Clean the temporary file
-        if isfile(temp_file_name): remove(temp_file_name)
+        # Get the detector backend, if the request overrides the default one
+        backend = input_arg.get(FIELD_BACKEND) or BACKEND
+
+        if backend not in SUPPORTED_BACKENDS:
+            return jsonify({KEY_MESSAGE: BACKEND_NOT_SUPPORTED_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        # Decode the uploaded image in memory, without writing it to the disk
+        img_array = decode_image(img.read())
+
+        if img_array is None:
+            return jsonify({KEY_MESSAGE: NOT_DECODABLE_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        message = upload_representation(img_array, username, info, backend=backend)
+
+    return jsonify(message)
+
+
+@app.route('/represent/bulk', methods=['POST'])
+def represent_bulk():
+    """
+        This method enrols many identities with a single write to the storage. The usernames
+        already enrolled are skipped, so a failed request can be sent again to resume it.
+        - csv:      a csv file with the username, info and file columns, a row for every identity
+        - archive:  a zip archive with the images named in the file column
+        - img:      the images named in the file column, alternative or additional to the archive
+        - backend:  the detector backend, optional
+        - Returns:  a message with the number of enrolled identities and a result for every row
+    """
+    message = {KEY_MESSAGE: NO_MULTIPART_MESSAGE,
+               KEY_STATUS: STATUS_FAIL}
+
+    if request.content_type.find(MULTIPART_FORM_DATA) != -1:
+        csv_file = request.files.get(FIELD_CSV)
+
+        if csv_file is None:
+            return jsonify({KEY_MESSAGE: ALL_VALUES_NOT_PASSED_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        # Get the detector backend, if the request overrides the default one
+        backend = request.form.get(FIELD_BACKEND) or BACKEND
+
+        if backend not in SUPPORTED_BACKENDS:
+            return jsonify({KEY_MESSAGE: BACKEND_NOT_SUPPORTED_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        try:
+            rows = read_enrolments(csv_file.read().decode('utf-8-sig'))
+        except (UnicodeDecodeError, ValueError) as e:
+            return jsonify({KEY_MESSAGE: f'The csv could not be read: {e}',
+                            KEY_STATUS: STATUS_FAIL})
+
+        # Every image is read only when it is embedded
+        readers = {basename(img.filename): img.read for img in request.files.getlist(FIELD_IMG)}
+        archive = request.files.get(FIELD_ARCHIVE)
+
+        valid, zip_file, message = _open_archive(archive, message)
+
+        if not valid:
+            return jsonify(message)
+
+        if zip_file is not None:
+            for member in zip_file.infolist():
+                if not member.is_dir() and member.filename.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
+                    readers.setdefault(member.filename, _archive_reader(zip_file, member))
+                    readers.setdefault(basename(member.filename), _archive_reader(zip_file, member))
+
+        message = upload_representations_bulk([(username, info, readers.get(file_name))
+                                               for username, info, file_name in rows], backend=backend)
+
+        if zip_file is not None:
+            zip_file.close()
 
     return jsonify(message)
 
@@ -224,9 +400,13 @@ def identify():
     """
         This method is used to find the representation with the closest representation
         to the input one.
-        - img:      the input image encoded in base64
-        - Returns:  a message with the status of the request. If successful the username and info
-                    of the representation found are added to the response.
+        - img:          the input image encoded in base64
+        - backend:      the detector backend, optional
+        - k:            the number of candidates returned for every face, optional
+        - threshold:    the maximum distance of a candidate, optional
+        - Returns:      a message with the status of the request. If successful the username and info
+                        of the representations found are added to the response, with the coordinates
+                        and the candidates of every face
     """
     message = {KEY_MESSAGE: NO_MULTIPART_MESSAGE,
                KEY_STATUS: STATUS_FAIL}
@@ -246,29 +426,204 @@ def identify():
             return jsonify({KEY_MESSAGE: 'No file has been detected. Pass a file to perform the operation.',
                             KEY_STATUS: STATUS_FAIL})
         
-        temp_file_name = img.filename
+        file_name = img.filename
 
         # Check the supported extensions
-        if not temp_file_name.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
+        if not file_name.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
             return jsonify({KEY_MESSAGE: EXTENSION_NOT_SUPPORTED_MESSAGE,
                             KEY_STATUS: STATUS_FAIL})
         
-        img.save(temp_file_name) # Save the image as local file
-        message = find_representations(temp_file_name)
+        # Get the detector backend, if the request overrides the default one
+        backend = input_arg.get(FIELD_BACKEND) or BACKEND
+
+        if backend not in SUPPORTED_BACKENDS:
+            return jsonify({KEY_MESSAGE: BACKEND_NOT_SUPPORTED_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        # Get the number of candidates and the threshold, if the request overrides the default ones
+        valid, k, threshold, message = _check_ranking_input(input_arg, message)
+
+        if not valid:
+            return jsonify(message)
 
-        # Clean temporary file
-        if isfile(temp_file_name): remove(temp_file_name)  
+        # Decode the uploaded image in memory, without writing it to the disk
+        img_array = decode_image(img.read())
+
+        if img_array is None:
+            return jsonify({KEY_MESSAGE: NOT_DECODABLE_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        message = find_representations(img_array, backend=backend, k=k, threshold=threshold)
 
     return jsonify(message)
 
 
+@app.route('/identify/batch', methods=['POST'])
+def identify_batch():
+    """
+        This method is used to find the closest representations of the faces of many images
+        with a single request. Failures of single images are reported in their own result.
+        - img:      the input images, passed as many img fields
+        - archive:  a zip archive of images, alternative or additional to the img fields
+        - backend:  the detector backend, optional
+        - k:        the number of candidates returned for every face, optional
+        - threshold: the maximum distance of a candidate, optional
+        - Returns:  a message with the status of the request and a result for every image
+    """
+    message = {KEY_MESSAGE: NO_MULTIPART_MESSAGE,
+               KEY_STATUS: STATUS_FAIL}
+
+    if request.content_type.find(MULTIPART_FORM_DATA) != -1:
+        # Every image is read and decoded only when it is processed
+        images = list()
+
+        # Get the detector backend, if the request overrides the default one
+        backend = request.form.get(FIELD_BACKEND) or BACKEND
+
+        if backend not in SUPPORTED_BACKENDS:
+            return jsonify({KEY_MESSAGE: BACKEND_NOT_SUPPORTED_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        # Get the number of candidates and the threshold, if the request overrides the default ones
+        valid, k, threshold, message = _check_ranking_input(request.form, message)
+
+        if not valid:
+            return jsonify(message)
+
+        # Read every image passed as a separate field
+        for img in request.files.getlist(FIELD_IMG):
+            images.append(_named_reader(img.filename, img.read))
+
+        # Read every image contained in the archive
+        valid, zip_file, message = _open_archive(request.files.get(FIELD_ARCHIVE), message)
+
+        if not valid:
+            return jsonify(message)
+
+        if zip_file is not None:
+            for member in zip_file.infolist():
+                if not member.is_dir():
+                    images.append(_named_reader(member.filename, _archive_reader(zip_file, member)))
+
+        if len(images) == 0:
+            return jsonify({KEY_MESSAGE: 'No file has been detected. Pass at least a file to perform the operation.',
+                            KEY_STATUS: STATUS_FAIL})
+
+        message = find_representations_batch(images, backend=backend, k=k, threshold=threshold)
+
+        if zip_file is not None:
+            zip_file.close()
+
+    return jsonify(message)
+
+
+@app.route('/analyze', methods=['POST'])
+def analyze():
+    """
+        This method detects the faces of the input image once, and returns their coordinates,
+        their closest identities and the image with the faces drawn on it.
+        - img:      the input image
+        - backend:  the detector backend, optional
+        - k:        the number of candidates returned for every face, optional
+        - threshold: the maximum distance of a candidate, optional
+        - Returns:  a message with the status of the request and, if successful, the faces
+                    found and the annotated image
+    """
+    message = {KEY_MESSAGE: NO_MULTIPART_MESSAGE,
+               KEY_STATUS: STATUS_FAIL}
+
+    if request.content_type.find(MULTIPART_FORM_DATA) != -1:
+        img = request.files.get(FIELD_IMG)
+
+        # Wrong input: img not setted or empty
+        if img is None:
+            return jsonify({KEY_MESSAGE: 'No file has been detected. Pass a file to perform the operation.',
+                            KEY_STATUS: STATUS_FAIL})
+
+        file_name = img.filename
+
+        # Check the supported extensions
+        if not file_name.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
+            return jsonify({KEY_MESSAGE: EXTENSION_NOT_SUPPORTED_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        # Get the detector backend, if the request overrides the default one
+        backend = request.form.get(FIELD_BACKEND) or BACKEND
+
+        if backend not in SUPPORTED_BACKENDS:
+            return jsonify({KEY_MESSAGE: BACKEND_NOT_SUPPORTED_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        # Get the number of candidates and the threshold, if the request overrides the default ones
+        valid, k, threshold, message = _check_ranking_input(request.form, message)
+
+        if not valid:
+            return jsonify(message)
+
+        # Decode the uploaded image in memory, without writing it to the disk
+        img_array = decode_image(img.read())
+
+        if img_array is None:
+            return jsonify({KEY_MESSAGE: NOT_DECODABLE_MESSAGE,
+                            KEY_STATUS: STATUS_FAIL})
+
+        message = analyze_image(img_array, extension=splitext(file_name)[1], backend=backend, k=k, threshold=threshold)
+
+    return jsonify(message)
+
+
+@app.route('/identify/stream', methods=['POST'])
+def identify_frames():
+    """
+        This method identifies the faces of a stream of frames, following them across the frames,
+        and streams back a result for every processed frame as newline delimited json.
+        - img:      the frames, passed in order as many img fields of a multipart request. Alternatively
+                    the body is an application/octet-stream of frames, each one preceded by its size in
+                    4 big-endian bytes, which is processed while it is being received
+        - backend:  the detector backend, optional. A query parameter for the octet streams
+        - stride:   the number of frames for every processed one, optional
+        - Returns:  a json line for every processed frame, with the track and the identity of every
+                    face and the summary of the tracks ended in the frame, and a last line with the
+                    summary of the tracks still open
+    """
+    if request.content_type is None:
+        return jsonify({KEY_MESSAGE: NO_MULTIPART_MESSAGE,
+                        KEY_STATUS: STATUS_FAIL})
+
+    input_arg = request.args if request.content_type.find(OCTET_STREAM) != -1 else request.form
+
+    # Get the detector backend, if the request overrides the default one
+    backend = input_arg.get(FIELD_BACKEND) or BACKEND
+
+    if backend not in SUPPORTED_BACKENDS:
+        return jsonify({KEY_MESSAGE: BACKEND_NOT_SUPPORTED_MESSAGE,
+                        KEY_STATUS: STATUS_FAIL})
+
+    stride = input_arg.get(FIELD_STRIDE, STREAM_FRAME_STRIDE, type=int)
+
+    if stride < 1:
+        return jsonify({KEY_MESSAGE: 'The stride must be a positive integer',
+                        KEY_STATUS: STATUS_FAIL})
+
+    if request.content_type.find(MULTIPART_FORM_DATA) != -1:
+        frames = (img.read() for img in request.files.getlist(FIELD_IMG))
+    elif request.content_type.find(OCTET_STREAM) != -1:
+        frames = _read_frames(request.stream)
+    else:
+        return jsonify({KEY_MESSAGE: NO_MULTIPART_MESSAGE,
+                        KEY_STATUS: STATUS_FAIL})
+
+    lines = (app.json.dumps(result) + '\n' for result in identify_stream(frames, backend=backend, stride=stride))
+
+    return Response(stream_with_context(lines), mimetype=NDJSON)
+
+
 @app.route('/remove', methods=['POST'])
 def remove_rep():
     message = {KEY_MESSAGE: NO_MULTIPART_MESSAGE,
                KEY_STATUS: STATUS_FAIL}
 
     if request.content_type.find(MULTIPART_FORM_DATA) != -1:
-        print(MULTIPART_FORM_DATA)
         input_arg: dict = request.form
 
         if input_arg is None:
@@ -282,6 +637,142 @@ def remove_rep():
     return jsonify(message)
 
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+        This method is the readiness probe of the instance. It replies with 503
+        until the models have been loaded and warmed up.
+    """
+    message = is_ready()
+    code = 200 if message[KEY_STATUS] == STATUS_SUCCESS else 503
+
+    return jsonify(message), code
+
+
+@app.route('/gallery/stats', methods=['GET'])
+def gallery_stats():
+    """
+        This method returns the hit/miss/reload counters of the in-memory gallery cache
+    """
+    return jsonify({KEY_STATUS: STATUS_SUCCESS,
+                    KEY_MESSAGE: get_gallery_cache_stats()})
+
+
+@app.route('/inference/stats', methods=['GET'])
+def inference_stats():
+    """
+        This method returns the histograms of the embedding batch sizes and wait times
+    """
+    return jsonify({KEY_STATUS: STATUS_SUCCESS,
+                    KEY_MESSAGE: get_batching_stats()})
+
+
+@app.route('/detection/cache/stats', methods=['GET'])
+def detection_cache_stats():
+    """
+        This method returns the hit rate and the size of the cache of the detected faces
+    """
+    return jsonify({KEY_STATUS: STATUS_SUCCESS,
+                    KEY_MESSAGE: get_detection_cache_stats()})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+        This method exposes the latency of every stage, the request counters and the
+        state of the caches in the Prometheus text format
+    """
+    return Response(metrics_registry.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+def _read_frames(stream):
+    # Read the size-prefixed frames as they arrive, until the body ends
+    while True:
+        header = _read_exactly(stream, FRAME_HEADER_BYTES)
+
+        if len(header) < FRAME_HEADER_BYTES:
+            return
+
+        yield _read_exactly(stream, int.from_bytes(header, 'big'))
+
+
+def _read_exactly(stream, size: int) -> bytes:
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+
+        if not chunk:
+            break
+
+        data.extend(chunk)
+
+    return bytes(data)
+
+
+def _named_reader(file_name: str, read) -> tuple:
+    # Skip the reading of files whose extension is not supported, the
+    # image is then reported as not decodable in the batch result
+    if not file_name.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
+        return basename(file_name), None
+
+    return basename(file_name), read
+
+
+def _archive_reader(zip_file: ZipFile, member):
+    # A corrupted member is reported as not decodable, without failing the other ones
+    def read() -> bytes:
+        try:
+            return zip_file.read(member)
+        except BadZipFile:
+            return None
+
+    return read
+
+
+def _open_archive(archive, message):
+    # No archive has been passed
+    if archive is None:
+        return True, None, message
+
+    # The archive is read from the spooled upload, without copying it in memory
+    try:
+        zip_file = ZipFile(archive.stream)
+    except BadZipFile:
+        message = {KEY_MESSAGE: 'The archive you have sent is not a valid zip file',
+                   KEY_STATUS: STATUS_FAIL}
+        return False, None, message
+
+    # Check the declared size of the members, before any of them is decompressed
+    if sum(member.file_size for member in zip_file.infolist()) > MAX_ARCHIVE_BYTES:
+        zip_file.close()
+        message = {KEY_MESSAGE: ARCHIVE_TOO_LARGE_MESSAGE,
+                   KEY_STATUS: STATUS_FAIL}
+        return False, None, message
+
+    return True, zip_file, message
+
+
+def _check_ranking_input(input_arg, message):
+    # Check the number of candidates of every face, a value that is not an integer is None
+    k = input_arg.get(FIELD_K, type=int) if input_arg.get(FIELD_K) else TOP_K
+
+    if k is None or not 1 <= k <= MAX_TOP_K:
+        message = {KEY_MESSAGE: TOP_K_NOT_SUPPORTED_MESSAGE,
+                   KEY_STATUS: STATUS_FAIL}
+        return False, None, None, message
+
+    # Check the distance threshold, if it is not passed the one of the model is used
+    threshold = input_arg.get(FIELD_THRESHOLD, -1.0, type=float) if input_arg.get(FIELD_THRESHOLD) else None
+
+    if threshold is not None and not 0 < threshold < float('inf'):
+        message = {KEY_MESSAGE: THRESHOLD_NOT_SUPPORTED_MESSAGE,
+                   KEY_STATUS: STATUS_FAIL}
+        return False, None, None, message
+
+    return True, k, threshold, message
+
+
 def _check_represent_input(img, username, info, message):
     # Check if the input misses input parameters
     if (img is None) or (username is None) or (info is None):
@@ -299,4 +790,6 @@ def _check_represent_input(img, username, info, message):
 
 
 if __name__ == "__main__":
+    # Start the inference workers and warm up their models in background as soon as the app starts
+    inference_executor.start()
     app.run(host='0.0.0.0', port=5000)
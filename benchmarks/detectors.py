@@ -0,0 +1,161 @@
+"""
+    This script compares the detector backends on a local set of images, reporting the
+    detection latency and the detection recall of each one, so that the backend of a
+    deployment can be chosen with data.
+
+    Usage:
+        python -m benchmarks.detectors <images dir> [--labels labels.json] [--backends opencv ssd ...]
+
+    The labels file maps the name of every image to the boxes of its faces, each one as
+    [x1, y1, x2, y2]. A labelled face is found when a detection overlaps it by MATCH_IOU,
+    and every detection finds at most one face. Without labels every image is expected to
+    contain at least one face, found by any detection.
+"""
+from argparse import ArgumentParser
+from cv2 import imread
+from os import listdir
+from os.path import join
+
+from rules.models import get_registry
+from rules.services import MODEL, SUPPORTED_BACKENDS, SUPPORTED_IMAGE_EXTENSIONS
+from rules.tracking import box_iou
+
+import json
+import numpy as np
+import time
+
+MATCH_IOU = 0.5
+
+
+def match_faces(detected: list, labelled: list) -> int:
+    """
+        This function matches the detected faces of an image to its labelled faces, greedily
+        pairing the most overlapping ones first
+            - detected: the detected facial areas, as dictionaries with the x1, y1, x2, y2 keys
+            - labelled: the labelled facial areas, in the same format
+            - return:   the number of labelled faces found by a detection
+    """
+    pairs = sorted(((box_iou(d, l), i, j) for i, d in enumerate(detected) for j, l in enumerate(labelled)),
+                   reverse=True)
+    used_detections = set()
+    used_labels = set()
+
+    for iou, i, j in pairs:
+        if iou < MATCH_IOU:
+            break
+
+        if i not in used_detections and j not in used_labels:
+            used_detections.add(i)
+            used_labels.add(j)
+
+    return len(used_labels)
+
+
+def benchmark_backend(backend: str, images: dict, labels: dict, repeat: int = 1) -> dict:
+    """
+        This function measures a detector backend on the given images
+            - backend:  the name of the detector backend
+            - images:   a dictionary that maps the name of every image to its pixels
+            - labels:   a dictionary that maps the name of an image to the facial areas it contains
+            - repeat:   the number of detections of every image, to smooth the latency
+            - return:   a dictionary with the load time, the latency percentiles and the recall
+    """
+    tic = time.perf_counter()
+    registry = get_registry(backend, MODEL)
+    registry.warm_up()
+    load_seconds = time.perf_counter() - tic
+
+    latencies = list()
+    expected = 0
+    found = 0
+
+    for name, img in images.items():
+        for _ in range(repeat):
+            tic = time.perf_counter()
+
+            try:
+                faces = registry.detect(img, enforce_detection=True)
+            except ValueError:
+                faces = list()
+
+            latencies.append(time.perf_counter() - tic)
+
+        # Without a label the image is expected to contain a face, found by any detection. With
+        # the labels the false positives do not increase the recall, since they match no face
+        if name in labels:
+            detected = [{'x1': area['x'], 'y1': area['y'], 'x2': area['x'] + area['w'], 'y2': area['y'] + area['h']}
+                        for _, area, _ in faces]
+            expected += len(labels[name])
+            found += match_faces(detected, labels[name])
+        else:
+            expected += 1
+            found += min(len(faces), 1)
+
+    latencies = np.array(latencies) * 1000
+
+    return {'backend': backend,
+            'load_seconds': load_seconds,
+            'mean_ms': float(latencies.mean()),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'recall': found / expected if expected > 0 else 0.0}
+
+
+def load_images(directory: str) -> dict:
+    """
+        This function reads the supported images of a directory
+            - return: a dictionary that maps the name of every image to its pixels
+    """
+    images = dict()
+
+    for name in sorted(listdir(directory)):
+        if name.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
+            img = imread(join(directory, name))
+
+            if img is not None:
+                images[name] = img
+
+    return images
+
+
+def main():
+    parser = ArgumentParser(description='Compare the latency and the recall of the detector backends')
+    parser.add_argument('images', help='the directory with the images')
+    parser.add_argument('--labels', help='a json file that maps every image to the boxes of its faces')
+    parser.add_argument('--backends', nargs='+', default=list(SUPPORTED_BACKENDS), choices=SUPPORTED_BACKENDS)
+    parser.add_argument('--repeat', type=int, default=1, help='the detections of every image')
+    parser.add_argument('--output', help='a json file where the results are written')
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    labels = dict()
+
+    if args.labels is not None:
+        with open(args.labels) as labels_file:
+            labels = {name: [dict(zip(('x1', 'y1', 'x2', 'y2'), box)) for box in boxes]
+                      for name, boxes in json.load(labels_file).items()}
+
+    print(f'Benchmarking {len(args.backends)} backends on {len(images)} images')
+    print(f'{"backend":<12}{"load s":>10}{"mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}{"recall":>10}')
+
+    results = list()
+
+    for backend in args.backends:
+        try:
+            result = benchmark_backend(backend, images, labels, args.repeat)
+        except Exception as e:
+            # A backend could miss its optional dependencies, the others are still measured
+            print(f'{backend:<12}could not be loaded: {e}')
+            continue
+
+        results.append(result)
+        print(f'{backend:<12}{result["load_seconds"]:>10.2f}{result["mean_ms"]:>10.1f}'
+              f'{result["p50_ms"]:>10.1f}{result["p95_ms"]:>10.1f}{result["recall"]:>10.3f}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
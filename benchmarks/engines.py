@@ -0,0 +1,110 @@
+"""
+    This script checks the parity of the onnx engine with the keras reference and measures
+    their latency. For every quantization it reports how far the embeddings are from the
+    reference ones, and how many verification decisions based on findThreshold change
+    over all the pairs of faces of a local validation set.
+
+    Usage:
+        python -m benchmarks.engines <images dir> [--quantizations fp32 fp16 int8] [--tolerance 0.02]
+
+    The script exits with an error if an engine exceeds the tolerance or changes any decision,
+    so it can gate the deployment of a new engine configuration.
+"""
+from argparse import ArgumentParser
+from deepface.commons.distance import findThreshold
+
+from benchmarks.detectors import load_images
+from rules.engines import ENGINE_KERAS, ENGINE_ONNX
+from rules.index import compute_distances, METRIC_COSINE, METRIC_EUCLIDEAN
+from rules.models import get_registry
+from rules.services import BACKEND, MODEL
+
+import json
+import numpy as np
+import sys
+import time
+
+
+def embed_with(registry, faces: np.ndarray, repeat: int = 1) -> tuple:
+    """
+        This function embeds the faces with a registry, one face per inference
+            - return: the (embeddings, milliseconds per face) pair
+    """
+    registry.warm_up()
+    embeddings = list()
+    tic = time.perf_counter()
+
+    for _ in range(repeat):
+        embeddings = [registry.predict(face[np.newaxis])[0] for face in faces]
+
+    return np.array(embeddings, dtype=np.float32), (time.perf_counter() - tic) * 1000 / (repeat * len(faces))
+
+
+def decisions(embeddings: np.ndarray, metric: str) -> np.ndarray:
+    """
+        This function returns the verification decision of every pair of faces
+    """
+    distances = compute_distances(embeddings, embeddings, metric)
+
+    return distances[np.triu_indices(len(embeddings), k=1)] <= findThreshold(MODEL, metric)
+
+
+def main():
+    parser = ArgumentParser(description='Check the parity and the latency of the onnx engine against keras')
+    parser.add_argument('images', help='the directory with the validation images')
+    parser.add_argument('--quantizations', nargs='+', default=['fp32', 'fp16', 'int8'], choices=['fp32', 'fp16', 'int8'])
+    parser.add_argument('--tolerance', type=float, default=0.02, help='the maximum cosine distance from the reference')
+    parser.add_argument('--repeat', type=int, default=1, help='the inferences of every face')
+    parser.add_argument('--output', help='a json file where the results are written')
+    args = parser.parse_args()
+
+    # Detect the faces once with the reference registry, so every engine embeds the same crops
+    reference = get_registry(BACKEND, MODEL, ENGINE_KERAS)
+    faces = list()
+
+    for name, img in load_images(args.images).items():
+        try:
+            faces.extend(face[0] for face, _, _ in reference.detect(img))
+        except ValueError:
+            print(f'No face found in {name}, skipped')
+
+    if len(faces) < 2:
+        sys.exit('At least two faces are needed to check the verification decisions')
+
+    faces = np.array(faces, dtype=np.float32)
+    expected, reference_ms = embed_with(reference, faces, args.repeat)
+    expected_decisions = {metric: decisions(expected, metric) for metric in (METRIC_EUCLIDEAN, METRIC_COSINE)}
+
+    print(f'Checking {len(faces)} faces, {len(expected_decisions[METRIC_EUCLIDEAN])} pairs')
+    print(f'{"engine":<12}{"ms/face":>10}{"speedup":>10}{"max cos":>12}{"changed":>10}')
+    print(f'{"keras":<12}{reference_ms:>10.1f}{1.0:>10.2f}{0.0:>12.5f}{0:>10}')
+
+    results = [{'engine': ENGINE_KERAS, 'ms_per_face': reference_ms}]
+    failed = False
+
+    for quantization in args.quantizations:
+        registry = get_registry(BACKEND, MODEL, ENGINE_ONNX, None if quantization == 'fp32' else quantization)
+        embeddings, engine_ms = embed_with(registry, faces, args.repeat)
+
+        # The distance of every embedding from its reference, and the decisions that changed
+        drift = float(np.max(np.diagonal(compute_distances(embeddings, expected, METRIC_COSINE))))
+        changed = int(sum(np.count_nonzero(decisions(embeddings, metric) != expected_decisions[metric])
+                          for metric in expected_decisions))
+
+        failed = failed or drift > args.tolerance or changed > 0
+        results.append({'engine': f'onnx-{quantization}', 'ms_per_face': engine_ms,
+                        'max_cosine_distance': drift, 'changed_decisions': changed})
+
+        print(f'{"onnx-" + quantization:<12}{engine_ms:>10.1f}{reference_ms / engine_ms:>10.2f}'
+              f'{drift:>12.5f}{changed:>10}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if failed:
+        sys.exit(f'An engine exceeded the tolerance of {args.tolerance} or changed some decisions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""
+    This script benchmarks the service stack offline, so that the results of two versions
+    can be compared to catch regressions. It runs two suites:
+
+    - operations: synthetic galleries of random embeddings are written with a LocalFileManager,
+      then the enrolment, deletion, identification and verification of rules/operations.py
+      are measured on each of them;
+    - routes: the end-to-end latency of the main routes is measured with the Flask test client,
+      with a stub detector and a stub recognition model in place of the deepface ones.
+
+    Usage:
+        python -m benchmarks.service [--sizes 1000 10000 100000] [--operations 100] [--requests 50]
+                                     [--suites operations routes] [--output results.json]
+
+    Nothing is downloaded and no cloud service is used: every gallery lives in a temporary directory.
+"""
+from argparse import ArgumentParser
+from io import BytesIO
+from subprocess import CalledProcessError, check_output
+from tempfile import TemporaryDirectory
+
+from rules.operations import FaceRecognizer, FaceRepresentationDeleter, FaceRepresentationUploader, gallery_cache
+from rules.persistence.local import LocalFileManager
+
+import json
+import numpy as np
+import platform
+import time
+
+# The size of the synthetic embeddings, the one of Facenet512
+EMBEDDING_SIZE = 512
+
+# The standard deviation of the noise added to a stored embedding to obtain a probe of the same identity
+PROBE_NOISE = 0.1
+
+# The side of the synthetic images sent to the routes, and the input side of the stub model
+IMAGE_SIZE = (480, 640)
+TARGET_SIZE = (160, 160)
+
+
+def summarize(latencies: list) -> dict:
+    """
+        This function summarizes the latencies of an operation
+            - latencies:    the seconds spent by every call
+            - return:       the number of calls, the throughput and the latency percentiles in milliseconds
+    """
+    latencies = np.array(latencies) * 1000
+
+    return {'calls': len(latencies),
+            'per_second': float(len(latencies) * 1000 / latencies.sum()) if latencies.sum() > 0 else 0.0,
+            'mean_ms': float(latencies.mean()),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'p99_ms': float(np.percentile(latencies, 99))}
+
+
+def measure(function, arguments: list) -> dict:
+    """
+        This function calls a function once for every argument, timing every call
+            - return: the summary of the latencies
+    """
+    latencies = list()
+
+    for argument in arguments:
+        tic = time.perf_counter()
+        function(argument)
+        latencies.append(time.perf_counter() - tic)
+
+    return summarize(latencies)
+
+
+def build_gallery(manager: LocalFileManager, size: int, rng: np.random.Generator) -> np.ndarray:
+    """
+        This function writes a synthetic gallery as a base snapshot, without enrolling the
+        identities one by one
+            - manager:  the manager of the directory that holds the gallery
+            - size:     the number of identities
+            - return:   the embeddings of the gallery, one per row
+    """
+    embeddings = rng.standard_normal((size, EMBEDDING_SIZE), dtype=np.float32)
+    usernames = [f'user{i}' for i in range(size)]
+
+    gallery_cache.store(manager).compact(usernames, ['synthetic'] * size, embeddings, frozenset())
+
+    return embeddings
+
+
+def benchmark_operations(size: int, operations: int, rng: np.random.Generator) -> dict:
+    """
+        This function measures the operations of rules/operations.py on a synthetic gallery
+            - size:         the number of identities of the gallery
+            - operations:   the number of calls of every operation
+            - return:       the summary of every operation
+    """
+    with TemporaryDirectory() as directory:
+        manager = LocalFileManager(directory)
+
+        tic = time.perf_counter()
+        embeddings = build_gallery(manager, size, rng)
+        build_seconds = time.perf_counter() - tic
+
+        # The first read decodes the snapshot and builds the index, the next ones hit the cache
+        gallery_cache.invalidate(manager)
+        tic = time.perf_counter()
+        gallery_cache.get(manager)
+        load_seconds = time.perf_counter() - tic
+
+        targets = rng.integers(0, size, operations)
+        probes = embeddings[targets] + rng.normal(0, PROBE_NOISE, (operations, EMBEDDING_SIZE)).astype(np.float32)
+
+        identify = measure(lambda probe: FaceRecognizer(manager, [{'embedding': probe}]).match_representations(),
+                           probes)
+        verify = measure(lambda i: FaceRecognizer(manager, [{'embedding': probes[i]}]).verify_identity(f'user{targets[i]}'),
+                         range(operations))
+
+        # The enrolments append segments, and are compacted as the service would do
+        enrolled = [{'username': f'new{i}', 'info': 'synthetic', 'embedding': rng.standard_normal(EMBEDDING_SIZE).tolist()}
+                    for i in range(operations)]
+        enrol = measure(lambda rep: FaceRepresentationUploader(manager, rep).upload_representation(), enrolled)
+        delete = measure(lambda i: FaceRepresentationDeleter(manager, f'new{i}').delete_representation(),
+                         range(operations))
+
+        gallery_cache.invalidate(manager)
+
+    return {'gallery_size': size,
+            'build_seconds': build_seconds,
+            'load_seconds': load_seconds,
+            'identify': identify,
+            'verify': verify,
+            'enrol': enrol,
+            'delete': delete}
+
+
+class StubModel:
+    """
+        This class replaces the recognition model with a fixed random projection of the
+        face crops, so that the routes can be measured without the deepface weights.
+    """
+
+    def __init__(self, seed: int = 0) -> None:
+        rows = (TARGET_SIZE[0] // 10) * (TARGET_SIZE[1] // 10) * 3
+        self.projection = np.random.default_rng(seed).standard_normal((rows, EMBEDDING_SIZE), dtype=np.float32)
+
+    def predict(self, batch: np.ndarray, verbose: int = 0) -> np.ndarray:
+        return batch[:, ::10, ::10, :].reshape(len(batch), -1).astype(np.float32) @ self.projection
+
+
+def stub_detect(img, enforce_detection=True) -> list:
+    """
+        This function replaces the detector backend: it finds a single face in the center of the image
+    """
+    from cv2 import resize
+
+    height, width = img.shape[:2]
+    region = {'x': width // 4, 'y': height // 4, 'w': width // 2, 'h': height // 2}
+    face = img[region['y']:region['y'] + region['h'], region['x']:region['x'] + region['w']]
+
+    return [(resize(face, TARGET_SIZE)[np.newaxis].astype(np.float32) / 255, region, 0.99)]
+
+
+def benchmark_routes(requests: int, gallery_size: int, rng: np.random.Generator) -> dict:
+    """
+        This function measures the end-to-end latency of the main routes with the Flask test client
+            - requests:     the number of requests sent to every route
+            - gallery_size: the number of identities of the gallery matched by the routes
+            - return:       the summary of every route
+    """
+    from cv2 import imencode
+    from rules import services
+    from rules.models import get_registry
+
+    # The inferences run in process, on the stub detector and the stub model
+    services.inference_executor.workers = 0
+    registry = get_registry(*services.inference_executor._key())
+    registry.model = StubModel()
+    registry.target_size = TARGET_SIZE
+    registry.detect = stub_detect
+    registry.warm_up = registry._ready.set
+
+    from app import app
+
+    def image(i: int) -> tuple:
+        # Every request sends a different image, so the detection cache does not hide the inferences
+        pixels = rng.integers(0, 256, (*IMAGE_SIZE, 3), dtype=np.uint8)
+        return BytesIO(imencode('.jpg', pixels)[1].tobytes()), f'image{i}.jpg'
+
+    with TemporaryDirectory() as directory:
+        services._manager = LocalFileManager(directory)
+        build_gallery(services._manager, gallery_size, rng)
+        client = app.test_client()
+        client.get('/ready')
+
+        def post(route: str, **fields):
+            response = client.post(route, data=fields, content_type='multipart/form-data')
+
+            if response.status_code != 200:
+                raise RuntimeError(f'{route} replied {response.status_code}')
+
+        results = {'gallery_size': gallery_size,
+                   'identify': measure(lambda i: post('/identify', img=image(i)), range(requests)),
+                   'verify': measure(lambda i: post('/verify', img=image(i), identity='user0'), range(requests)),
+                   'analyze': measure(lambda i: post('/analyze', img=image(i)), range(requests)),
+                   'represent': measure(lambda i: post('/represent', img=image(i), identity=f'route{i}',
+                                                       info='synthetic'), range(requests))}
+
+        gallery_cache.invalidate(services._manager)
+
+    return results
+
+
+def environment() -> dict:
+    """
+        This function describes the environment of the run, so that the results can be compared
+    """
+    try:
+        commit = check_output(['git', 'rev-parse', 'HEAD'], text=True).strip()
+    except (CalledProcessError, OSError):
+        commit = None
+
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'processor': platform.processor()}
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the operations and the routes of the service offline')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000],
+                        help='the sizes of the synthetic galleries, up to 1000000')
+    parser.add_argument('--operations', type=int, default=100, help='the calls of every operation')
+    parser.add_argument('--requests', type=int, default=50, help='the requests sent to every route')
+    parser.add_argument('--route-gallery', type=int, default=10000, help='the size of the gallery of the routes')
+    parser.add_argument('--suites', nargs='+', default=['operations', 'routes'], choices=['operations', 'routes'])
+    parser.add_argument('--seed', type=int, default=0, help='the seed of the synthetic data')
+    parser.add_argument('--output', help='a json file where the results are written')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = {'environment': environment(), 'arguments': vars(args), 'operations': list(), 'routes': None}
+
+    if 'operations' in args.suites:
+        print(f'{"size":>10}{"operation":>12}{"per s":>10}{"mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+
+        for size in args.sizes:
+            result = benchmark_operations(size, args.operations, rng)
+            results['operations'].append(result)
+
+            for operation in ('identify', 'verify', 'enrol', 'delete'):
+                summary = result[operation]
+                print(f'{size:>10}{operation:>12}{summary["per_second"]:>10.1f}{summary["mean_ms"]:>10.2f}'
+                      f'{summary["p50_ms"]:>10.2f}{summary["p95_ms"]:>10.2f}{summary["p99_ms"]:>10.2f}')
+
+    if 'routes' in args.suites:
+        results['routes'] = benchmark_routes(args.requests, args.route_gallery, rng)
+
+        print(f'{"route":>12}{"per s":>10}{"mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+
+        for route in ('identify', 'verify', 'analyze', 'represent'):
+            summary = results['routes'][route]
+            print(f'{route:>12}{summary["per_second"]:>10.1f}{summary["mean_ms"]:>10.2f}'
+                  f'{summary["p50_ms"]:>10.2f}{summary["p95_ms"]:>10.2f}{summary["p99_ms"]:>10.2f}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+    This script builds a gallery offline from a directory or a zip archive of images and a csv
+    with the username, info and file columns. The images are embedded in parallel by the inference
+    workers, and the gallery is written once at the end through the chosen persistence manager.
+
+    Usage:
+        python gallery_builder.py <images dir or zip> <csv> [--storage local|azure|firestore] [--location dfdb]
+
+    Every embedding is appended to a checkpoint file as soon as it is computed, so an interrupted
+    build can be started again with the same arguments and only embeds the missing images. The
+    images that are missing or have no single face are checkpointed as failed, while the ones
+    refused by busy or slow inference workers are embedded again by the next run.
+"""
+from argparse import ArgumentParser
+from os.path import isdir, join
+from zipfile import ZipFile
+
+from rules.operations import FaceRepresentationBulkUploader, gallery_cache
+from rules.services import (BACKEND, SUPPORTED_BACKENDS, BUSY_MESSAGE, INFERENCE_TIMEOUT_MESSAGE, embed_enrolments,
+                            read_enrolments)
+
+import json
+import time
+
+# The seconds between two progress reports
+PROGRESS_INTERVAL = 5
+
+# The failures that can succeed on a later run, which are not written to the checkpoint
+TRANSIENT_MESSAGES = (BUSY_MESSAGE, INFERENCE_TIMEOUT_MESSAGE)
+
+
+def get_manager(storage: str, location: str, connection_string: str = None):
+    """
+        This function builds the persistence manager where the gallery is written
+            - storage:              local, azure or firestore
+            - location:             the folder, the container or the collection of the gallery
+            - connection_string:    the connection string of the azure storage, optional
+    """
+    if storage == 'azure':
+        from rules.persistence.azure import AzureBlobManager
+        return AzureBlobManager(location, connection_string or 'skip')
+
+    if storage == 'firestore':
+        from rules.persistence.firestore import FirestoreDatabaseManager
+        return FirestoreDatabaseManager(location)
+
+    from rules.persistence.local import LocalFileManager
+    return LocalFileManager(location)
+
+
+def read_checkpoint(path: str) -> dict:
+    """
+        This function reads the enrolments completed by the previous runs
+            - return: a dictionary that maps every completed username to its checkpoint entry
+    """
+    completed = dict()
+
+    try:
+        with open(path) as checkpoint:
+            for line in checkpoint:
+                # The last line could be truncated if the previous run was killed while writing it
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+                completed[entry['username']] = entry
+    except FileNotFoundError:
+        pass
+
+    return completed
+
+
+def main():
+    parser = ArgumentParser(description='Build a gallery from a directory or a zip archive of images')
+    parser.add_argument('source', help='the directory or the zip archive with the images')
+    parser.add_argument('csv', help='a csv with the username, info and file columns')
+    parser.add_argument('--storage', default='local', choices=['local', 'azure', 'firestore'])
+    parser.add_argument('--location', default='dfdb', help='the folder, container or collection of the gallery')
+    parser.add_argument('--connection-string', help='the connection string of the azure storage')
+    parser.add_argument('--backend', default=BACKEND, choices=SUPPORTED_BACKENDS)
+    parser.add_argument('--checkpoint', help='the checkpoint file, by default the csv path with a .checkpoint suffix')
+    args = parser.parse_args()
+
+    checkpoint_path = args.checkpoint or f'{args.csv}.checkpoint'
+    manager = get_manager(args.storage, args.location, args.connection_string)
+
+    with open(args.csv, encoding='utf-8-sig') as csv_file:
+        rows = read_enrolments(csv_file.read())
+
+    zip_file = None if isdir(args.source) else ZipFile(args.source)
+
+    def reader(file_name: str):
+        if zip_file is not None:
+            return lambda: zip_file.read(file_name)
+
+        def read() -> bytes:
+            with open(join(args.source, file_name), 'rb') as image_file:
+                return image_file.read()
+
+        return read
+
+    # Skip the repeated usernames, the enrolled ones and the ones completed by a previous run
+    completed = read_checkpoint(checkpoint_path)
+    enrolled = gallery_cache.get(manager)
+    seen = set()
+    enrolments = list()
+
+    for username, info, file_name in rows:
+        if username and info and file_name and username not in seen and username not in enrolled:
+            seen.add(username)
+
+            if username not in completed:
+                enrolments.append((username, info, reader(file_name)))
+
+    print(f'{len(rows)} rows, {len(seen)} usernames to enrol, {len(seen) - len(enrolments)} already embedded')
+
+    tic = time.perf_counter()
+    last_report = tic
+    failed = 0
+
+    with open(checkpoint_path, 'a+') as checkpoint:
+        # Terminate the line truncated by a killed run, so the next entry starts on its own line
+        if checkpoint.tell() > 0:
+            checkpoint.seek(checkpoint.tell() - 1)
+
+            if checkpoint.read(1) != '\n':
+                checkpoint.write('\n')
+
+        for i, (username, info, embedding, message) in enumerate(embed_enrolments(enrolments, args.backend), start=1):
+            entry = {'username': username, 'info': info, 'embedding': embedding, 'message': message}
+
+            # The missing or broken images are checkpointed as failed, so the next runs skip them
+            if message not in TRANSIENT_MESSAGES:
+                checkpoint.write(json.dumps(entry) + '\n')
+                checkpoint.flush()
+
+            completed[username] = entry
+            failed += embedding is None
+
+            if time.perf_counter() - last_report >= PROGRESS_INTERVAL or i == len(enrolments):
+                last_report = time.perf_counter()
+                print(f'{i}/{len(enrolments)} images embedded, {i / (last_report - tic):.1f}/s, {failed} failed')
+
+    if zip_file is not None:
+        zip_file.close()
+
+    # The gallery is written once, with all the embeddings of this and of the previous runs
+    representations = [{'username': entry['username'], 'info': entry['info'], 'embedding': entry['embedding']}
+                       for username, entry in completed.items()
+                       if username in seen and entry['embedding'] is not None]
+
+    duplicated = FaceRepresentationBulkUploader(manager, representations).upload_representations()
+
+    print(f'{len(representations) - len(duplicated)} representations written to {args.storage}:{args.location}')
+
+    for username, entry in completed.items():
+        if username in seen and entry['embedding'] is None:
+            print(f'{username}: {entry["message"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+from .metrics import Histogram, SIZE_BUCKETS
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+import time
+
+
+class MicroBatcher:
+    """
+        This class collects the face crops of concurrent requests for a short time and
+        embeds them with a single batched forward pass, giving back to every request its
+        own slice of the embeddings. A batch is dispatched when it reaches the maximum
+        size or when its first request has waited for the maximum wait time.
+    """
+
+    def __init__(self, embed, max_batch_size: int = 32, max_wait: float = 0.005, dispatchers: int = 1) -> None:
+        """
+            - embed:            the function that embeds a list of face crops, returning one embedding per crop
+            - max_batch_size:   the number of face crops that triggers the dispatch of a batch. A request
+                                with more crops is dispatched alone
+            - max_wait:         the seconds a request can wait for other requests to fill its batch
+            - dispatchers:      the number of batches that can be embedded at the same time
+        """
+        self.embed_batch = embed
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        # The number of face crops of every batch, and the seconds every request waited for its batch
+        self.batch_sizes = Histogram(SIZE_BUCKETS)
+        self.wait_times = Histogram()
+
+        self._queue = Queue()
+        self._dispatcher = ThreadPoolExecutor(max_workers=dispatchers, thread_name_prefix='embedding-batch')
+        self._thread = None
+        self._lock = Lock()
+
+    def embed(self, faces: list) -> list:
+        """
+            This method embeds the face crops of a request together with the ones of the concurrent requests
+                - faces:    the face crops of the request
+                - return:   the list of embeddings, in the same order of the input faces
+                - raise:    the error raised by the embedding of the batch
+        """
+        if len(faces) == 0:
+            return list()
+
+        self._ensure_started()
+
+        future = Future()
+        self._queue.put((faces, future, time.perf_counter()))
+
+        return future.result()
+
+    def stats(self) -> dict:
+        """
+            This method returns the histograms of the batch sizes and of the wait times
+        """
+        return {'batch_size': self.batch_sizes.snapshot(),
+                'wait_seconds': self.wait_times.snapshot()}
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._collect, name='embedding-batcher', daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        while True:
+            # Block until a request arrives, it opens a new batch
+            requests = [self._queue.get()]
+            size = len(requests[0][0])
+            deadline = requests[0][2] + self.max_wait
+
+            # Fill the batch until it is full or the first request waited too much
+            while size < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+
+                if timeout <= 0:
+                    break
+
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except Empty:
+                    break
+
+                requests.append(request)
+                size += len(request[0])
+
+            self._dispatcher.submit(self._run, requests, size)
+
+    def _run(self, requests: list, size: int):
+        now = time.perf_counter()
+
+        self.batch_sizes.observe(size)
+
+        for _, _, enqueued in requests:
+            self.wait_times.observe(now - enqueued)
+
+        try:
+            embeddings = self.embed_batch([face for faces, _, _ in requests for face in faces])
+        except Exception as e:
+            # The whole batch failed, every request gets the error
+            for _, future, _ in requests:
+                future.set_exception(e)
+            return
+
+        # Give every request its own slice of the embeddings
+        start = 0
+
+        for faces, future, _ in requests:
+            future.set_result(embeddings[start:start + len(faces)])
+            start += len(faces)
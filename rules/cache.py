@@ -0,0 +1,113 @@
+from collections import OrderedDict
+from threading import Lock
+
+import time
+
+
+class LRUCache:
+    """
+        This class is a thread-safe least recently used cache bounded by the total size
+        of its values, in bytes. Every entry also expires after a time to live, so that
+        entries not requested for a long time do not hold memory forever.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float = None) -> None:
+        """
+            - max_bytes:    the maximum total size of the cached values. The least recently
+                            used entries are evicted to make room for the new ones
+            - ttl:          the seconds an entry is valid after it has been stored. None never expires
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """
+            This method returns the value of a key, marking it as the most recently used
+                - return: the cached value, or default if the key is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and self.ttl is not None and time.monotonic() > entry[2]:
+                self._pop(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[0]
+
+    def put(self, key, value, size: int):
+        """
+            This method stores a value, replacing the previous value of the key
+                - size: the size of the value in bytes. Values larger than the whole cache are not stored
+        """
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+
+            if size > self.max_bytes:
+                return
+
+            expires = time.monotonic() + self.ttl if self.ttl is not None else None
+            self._entries[key] = (value, size, expires)
+            self.size += size
+
+            # Evict the least recently used entries until the cache fits its bound
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def pop(self, key):
+        """
+            This method removes the entry of a key, if it exists
+        """
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+
+    def keys(self) -> list:
+        """
+            This method returns the cached keys, from the least to the most recently used
+        """
+        with self._lock:
+            return list(self._entries.keys())
+
+    def clear(self):
+        """
+            This method removes all the entries
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        """
+            This method returns the counters and the hit rate of the cache
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / requests if requests > 0 else 0.0,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'bytes': self.size,
+                    'max_bytes': self.max_bytes}
+
+    def _pop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
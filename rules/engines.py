@@ -0,0 +1,137 @@
+from hashlib import sha256
+from os import getpid, makedirs, replace
+from os.path import isfile, join
+
+import numpy as np
+
+# The engines that can run the recognition model
+ENGINE_KERAS = 'keras'
+ENGINE_ONNX = 'onnx'
+SUPPORTED_ENGINES = (ENGINE_KERAS, ENGINE_ONNX)
+
+# The weight quantizations of the onnx engine
+QUANTIZATION_FP16 = 'fp16'
+QUANTIZATION_INT8 = 'int8'
+SUPPORTED_QUANTIZATIONS = (None, QUANTIZATION_FP16, QUANTIZATION_INT8)
+
+# The opset used to export the keras models
+ONNX_OPSET = 13
+
+
+class OnnxEngine:
+    """
+        This class runs a recognition model exported to onnx with the CPU execution
+        provider of onnxruntime, which is usually much faster than keras on CPU.
+    """
+
+    def __init__(self, path: str, threads: int = 0) -> None:
+        """
+            - path:     the path of the onnx model
+            - threads:  the threads used by every inference. If 0 onnxruntime chooses them
+        """
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        """
+            This method computes the embeddings of a batch of faces
+                - batch:    the faces, shaped (n, height, width, 3)
+                - return:   the embeddings, one per row
+        """
+        return self.session.run(None, {self.input_name: batch.astype(np.float32)})[0]
+
+
+def export_onnx(keras_model, path: str):
+    """
+        This function exports a keras model to onnx, with a dynamic batch size
+            - keras_model:  the model to export
+            - path:         the path of the exported model
+    """
+    import tensorflow as tf
+    import tf2onnx
+
+    input_shape = keras_model.inputs[0].shape[1:]
+    signature = (tf.TensorSpec((None, *input_shape), tf.float32, name='input'),)
+
+    tf2onnx.convert.from_keras(keras_model, input_signature=signature, opset=ONNX_OPSET, output_path=path)
+
+
+def quantize_onnx(source: str, path: str, quantization: str):
+    """
+        This function quantizes the weights of an onnx model
+            - source:       the path of the float32 model
+            - path:         the path of the quantized model
+            - quantization: fp16 to halve the weights, int8 to quantize them dynamically
+            - raise:        ValueError if the quantization is not supported
+    """
+    if quantization == QUANTIZATION_INT8:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        quantize_dynamic(source, path, weight_type=QuantType.QInt8)
+    elif quantization == QUANTIZATION_FP16:
+        import onnx
+        from onnxconverter_common import float16
+
+        # The inputs and the outputs stay float32, so the callers do not change
+        onnx.save(float16.convert_float_to_float16(onnx.load(source), keep_io_types=True), path)
+    else:
+        raise ValueError(f'The quantization {quantization} is not supported')
+
+
+def model_digest(keras_model) -> str:
+    """
+        This function fingerprints the weights of a keras model and the exporter version, so the
+        exported files are rebuilt when any of them changes
+            - keras_model:  the model to fingerprint
+            - return:       the hexadecimal digest
+    """
+    import tf2onnx
+
+    digest = sha256(tf2onnx.__version__.encode())
+
+    for weights in keras_model.get_weights():
+        digest.update(np.ascontiguousarray(weights).tobytes())
+
+    return digest.hexdigest()[:16]
+
+
+def build_onnx_engine(keras_model, model_name: str, quantization: str = None, directory: str = 'models',
+                      threads: int = 0) -> OnnxEngine:
+    """
+        This function returns the onnx engine of a keras model. The model is exported, and
+        quantized if requested, the first time and then reused from the directory. The files
+        are named after the weights digest, the opset and the quantization, so they are
+        exported again when any of them changes.
+            - keras_model:  the reference keras model
+            - model_name:   the name of the model, used to name the exported files
+            - quantization: None, fp16 or int8
+            - directory:    the directory of the exported models
+            - threads:      the threads used by every inference. If 0 onnxruntime chooses them
+    """
+    if quantization not in SUPPORTED_QUANTIZATIONS:
+        raise ValueError(f'The quantization {quantization} is not supported')
+
+    makedirs(directory, exist_ok=True)
+    prefix = f'{model_name}.{model_digest(keras_model)}.opset{ONNX_OPSET}'
+    reference = join(directory, f'{prefix}.fp32.onnx')
+    path = join(directory, f'{prefix}.{quantization or "fp32"}.onnx')
+
+    # Every worker writes its own temporary file, so the concurrent exports never mix
+    if not isfile(reference):
+        temp_path = f'{reference}.{getpid()}.tmp'
+        export_onnx(keras_model, temp_path)
+        replace(temp_path, reference)
+
+    if not isfile(path):
+        temp_path = f'{path}.{getpid()}.tmp'
+        quantize_onnx(reference, temp_path, quantization)
+        replace(temp_path, path)
+
+    return OnnxEngine(path, threads)
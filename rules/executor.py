@@ -0,0 +1,221 @@
+from .engines import ENGINE_KERAS
+from .models import get_registry, set_inference_threads
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from threading import BoundedSemaphore, Lock, Thread
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(RuntimeError):
+    """
+        Raised when an inference is submitted while the queue of the executor is full
+    """
+
+
+class InferenceTimeoutError(RuntimeError):
+    """
+        Raised when an inference does not complete within the timeout of the executor
+    """
+
+
+# The registries are identified by a (backend, model, engine, quantization) key
+
+def _initialize_worker(key: tuple, threads: int):
+    # The workers share the cores, so each of them runs its inferences on a few threads
+    # instead of the default pools, that are as large as all the cores
+    if threads > 0:
+        set_inference_threads(threads)
+
+    # Load and warm up the models once, when the worker process starts
+    get_registry(*key).warm_up()
+
+
+def _detect(img, key: tuple, enforce_detection: bool) -> list:
+    return get_registry(*key).detect(img, enforce_detection)
+
+
+def _embed(faces: list, key: tuple) -> list:
+    return get_registry(*key).embed(faces)
+
+
+def _ping() -> bool:
+    return True
+
+
+class InferenceExecutor:
+    """
+        This class dispatches the face detection and the embedding inferences to a bounded
+        pool of worker processes, each of them holding the models preloaded. The number of
+        inferences waiting or running is limited by the queue depth, so that the server can
+        refuse new work instead of piling it up. If no worker is configured, the inferences
+        run in the calling thread with the models of the current process.
+    """
+
+    def __init__(self, backend: str, model: str, workers: int = 0, queue_depth: int = 0, timeout: float = None,
+                 engine: str = ENGINE_KERAS, quantization: str = None, threads_per_worker: int = 1) -> None:
+        """
+            - backend:      the name of the face detector backend
+            - model:        the name of the face recognition model
+            - workers:      the number of worker processes. If 0 the inferences run in process
+            - queue_depth:  the number of inferences that can wait for a free worker
+            - timeout:      the seconds an inference can last before it is abandoned. None waits forever
+            - engine:       the engine that runs the recognition model [keras, onnx]
+            - quantization: the weight quantization of the onnx engine [None, fp16, int8]
+            - threads_per_worker:   the inference threads of every worker process. If 0 the
+                                    engines choose them, usually one for every core
+        """
+        self.backend = backend
+        self.model = model
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.engine = engine
+        self.quantization = quantization
+        self.threads_per_worker = threads_per_worker
+
+        self._error = None
+        self._ready = False
+        self._thread = None
+        self._pool = None
+        self._pool_lock = Lock()
+        self._slots = BoundedSemaphore(max(workers, 1) + queue_depth)
+
+    @property
+    def ready(self) -> bool:
+        """
+            True once the models are loaded and warmed up in every worker
+        """
+        if self.workers == 0:
+            return get_registry(*self._key()).ready
+
+        return self._ready
+
+    @property
+    def error(self) -> Exception:
+        """
+            The error raised while warming up the models, None if there was none
+        """
+        if self.workers == 0:
+            return get_registry(*self._key()).error
+
+        return self._error
+
+    def _key(self, backend: str = None) -> tuple:
+        # The key of the registries that serve the inferences
+        return backend or self.backend, self.model, self.engine, self.quantization
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                # Workers are spawned, since forking a process that holds the models is unsafe
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn'),
+                                                 initializer=_initialize_worker,
+                                                 initargs=(self._key(), self.threads_per_worker))
+
+            return self._pool
+
+    def start(self) -> Thread:
+        """
+            This method loads and warms up the models in background, in the current process
+            or in every worker process. Only the first call starts them, the next ones have no effect.
+                - return: the started thread
+        """
+        with self._pool_lock:
+            if self._thread is None:
+                if self.workers == 0:
+                    self._thread = get_registry(*self._key()).start()
+                else:
+                    self._thread = Thread(target=self._start, name='inference-warm-up', daemon=True)
+                    self._thread.start()
+
+            return self._thread
+
+    def _start(self):
+        try:
+            # Every worker runs the initializer before accepting its first task
+            pool = self._get_pool()
+
+            for future in [pool.submit(_ping) for _ in range(self.workers)]:
+                future.result()
+
+            self._ready = True
+        except Exception as e:
+            self._error = e
+            logger.exception('Could not start the inference workers: %s', e)
+
+    def run(self, fn, *args):
+        """
+            This method runs a task in the pool, waiting for its result.
+                - fn:       the task, a module-level function that can be sent to the workers
+                - args:     the arguments of the task
+                - return:   the result of the task
+                - raise:    QueueFullError if too many inferences are waiting, InferenceTimeoutError
+                            if the task does not complete within the timeout
+        """
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError('Too many inferences are waiting to be processed')
+
+        if self.workers == 0:
+            try:
+                return fn(*args)
+            finally:
+                self._slots.release()
+
+        pool = self._get_pool()
+
+        try:
+            future = pool.submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._drop_pool(pool)
+            raise
+
+        # The slot is released when the task really ends, even after a timeout
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise InferenceTimeoutError(f'The inference did not complete in {self.timeout} seconds')
+        except BrokenProcessPool:
+            self._drop_pool(pool)
+            raise
+
+    def _drop_pool(self, pool: ProcessPoolExecutor):
+        # A worker died: drop the pool, so that a new one is created by the next task
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+
+    def detect(self, img, enforce_detection=True, backend: str = None) -> list:
+        """
+            This method detects and aligns the faces of an image
+                - backend:  the detector backend to use instead of the preloaded one. It is
+                            loaded by the workers at its first use
+                - return:   a list of (face, facial_area, confidence) tuples
+                - raise:    ValueError if enforce_detection is True and no face is found
+        """
+        return self.run(_detect, img, self._key(backend), enforce_detection)
+
+    def embed(self, faces: list) -> list:
+        """
+            This method computes the embeddings of many face crops with a single batched forward pass
+                - return: the list of embeddings, in the same order of the input faces
+        """
+        if len(faces) == 0:
+            return list()
+
+        return self.run(_embed, faces, self._key())
+
+    def shutdown(self):
+        """
+            This method stops the worker processes
+        """
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
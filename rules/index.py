@@ -0,0 +1,709 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_right
+from copy import copy
+
+import numpy as np
+
+# The distance metrics supported by the vectorized matcher
+METRIC_EUCLIDEAN = 'euclidean'
+METRIC_EUCLIDEAN_L2 = 'euclidean_l2'
+METRIC_COSINE = 'cosine'
+SUPPORTED_METRICS = (METRIC_EUCLIDEAN, METRIC_EUCLIDEAN_L2, METRIC_COSINE)
+
+# The types of gallery index that can be built
+INDEX_FLAT = 'flat'
+INDEX_IVF = 'ivf'
+
+# The types used to store the embeddings. The compressed ones are decoded on the fly
+STORAGE_FLOAT32 = 'float32'
+STORAGE_FLOAT16 = 'float16'
+STORAGE_INT8 = 'int8'
+SUPPORTED_STORAGES = (STORAGE_FLOAT32, STORAGE_FLOAT16, STORAGE_INT8)
+
+# Number of rows processed at once while assigning vectors to the IVF lists,
+# it bounds the size of the temporary distance matrices
+_ASSIGNMENT_CHUNK = 16384
+
+# Number of compressed rows decoded at once while scanning them
+_DECODE_CHUNK = 16384
+
+
+def to_embedding_matrix(embeddings: list) -> np.ndarray:
+    """
+        This function stacks a list of embeddings into a single contiguous
+        float32 matrix with one embedding per row.
+            - embeddings:   a list of embeddings (lists or numpy arrays of the same length)
+            - return:       a (n, d) float32 matrix
+    """
+    if len(embeddings) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+
+    return np.ascontiguousarray(np.vstack(embeddings), dtype=np.float32)
+
+
+def _l2_normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+
+    return matrix / norms
+
+
+def compute_distances(probes: np.ndarray, gallery: np.ndarray, metric: str = METRIC_EUCLIDEAN) -> np.ndarray:
+    """
+        This function computes the whole probe x gallery distance matrix
+        with a single vectorized call.
+            - probes:   a (p, d) float32 matrix of unknown embeddings
+            - gallery:  a (g, d) float32 matrix of known embeddings
+            - metric:   the metric used to evaluate the distance [cosine, euclidean, euclidean_l2]
+            - return:   a (p, g) float32 matrix where the (i, j) entry is the distance between
+                        the i_th probe and the j_th gallery embedding
+            - raise:    ValueError if the metric is not supported
+    """
+    if metric not in SUPPORTED_METRICS:
+        raise ValueError(f'Unsupported distance metric: {metric}')
+
+    if metric == METRIC_COSINE:
+        # Cosine distance is 1 - cosine similarity of the normalized vectors
+        return 1.0 - _l2_normalize(probes) @ _l2_normalize(gallery).T
+
+    if metric == METRIC_EUCLIDEAN_L2:
+        probes = _l2_normalize(probes)
+        gallery = _l2_normalize(gallery)
+
+    # Use the expansion ||p - g||^2 = ||p||^2 + ||g||^2 - 2 p.g so that the
+    # distances are obtained with a single matrix product
+    squared = (np.einsum('ij,ij->i', probes, probes)[:, None]
+               + np.einsum('ij,ij->i', gallery, gallery)[None, :]
+               - 2.0 * (probes @ gallery.T))
+
+    # Clip the negative values produced by floating point rounding
+    return np.sqrt(np.maximum(squared, 0.0))
+
+
+def select_top_k(distances: np.ndarray, k: int) -> np.ndarray:
+    """
+        This function selects the positions of the k lowest distances of every row
+        with a partial sort, ordering only the selected ones.
+            - distances:    a (p, n) distance matrix
+            - k:            the number of positions to select for every row
+            - return:       a (p, min(k, n)) matrix of column positions, sorted by distance
+    """
+    k = min(k, distances.shape[1])
+
+    if k < distances.shape[1]:
+        candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+
+    order = np.argsort(np.take_along_axis(distances, candidates, axis=1), axis=1)
+
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def quantize_embeddings(embeddings: np.ndarray, storage: str) -> tuple:
+    """
+        This function compresses a float32 matrix of embeddings. The int8 codes are scaled
+        row by row, so that the largest component of every embedding is mapped to 127.
+            - embeddings:   a (n, d) float32 matrix
+            - storage:      the type of the compressed matrix [float32, float16, int8]
+            - return:       a (codes, scales) pair, where scales is None unless the storage is int8
+            - raise:        ValueError if the storage is not supported
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+
+    if storage == STORAGE_FLOAT32:
+        return embeddings, None
+
+    if storage == STORAGE_FLOAT16:
+        return embeddings.astype(np.float16), None
+
+    if storage == STORAGE_INT8:
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+
+        return np.round(embeddings / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    raise ValueError(f'Unsupported storage type: {storage}')
+
+
+class QuantizedMatrix:
+    """
+        A read-only matrix of compressed embeddings, float16 or int8 with a scale for every
+        row. The distances are computed decoding a chunk of rows at a time, so the memory
+        stays bounded even when the codes are memory-mapped. If the exact float32 embeddings
+        are available, the single rows are read from them, so that they can re-rank the
+        candidates of the coarse scan.
+    """
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray = None, exact=None) -> None:
+        """
+            - codes:    the (n, d) float16 or int8 compressed embeddings
+            - scales:   the scale of every row, needed by the int8 codes
+            - exact:    a function that loads the (n, d) float32 embeddings, None if they are not stored
+        """
+        self.codes = codes
+        self.scales = scales
+
+        self._exact_loader = exact
+        self._exact = None
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def shape(self) -> tuple:
+        return self.codes.shape
+
+    @property
+    def exact(self) -> np.ndarray:
+        """
+            The exact float32 embeddings, loaded at the first use. None if they are not stored
+        """
+        if self._exact is None and self._exact_loader is not None:
+            self._exact = self._exact_loader()
+            self._exact_loader = None
+
+        return self._exact
+
+    def decode(self, rows) -> np.ndarray:
+        """
+            Returns the decoded float32 embeddings of some rows, given as a slice or an array of positions
+        """
+        decoded = self.codes[rows].astype(np.float32)
+
+        if self.scales is not None:
+            decoded *= self.scales[rows][:, None]
+
+        return decoded
+
+    def rows(self, rows) -> np.ndarray:
+        """
+            Returns the float32 embeddings of some rows, exact if they are stored
+        """
+        if self.exact is not None:
+            return np.asarray(self.exact[rows], dtype=np.float32)
+
+        return self.decode(rows)
+
+    def __getitem__(self, row: int) -> np.ndarray:
+        return self.rows(np.array([row]))[0]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        matrix = self.rows(slice(None))
+
+        return matrix if dtype is None else matrix.astype(dtype)
+
+    def distances(self, probes: np.ndarray, metric: str) -> np.ndarray:
+        """
+            Computes the coarse distances between the probes and the compressed rows
+        """
+        return np.hstack([compute_distances(probes, self.decode(slice(start, start + _DECODE_CHUNK)), metric)
+                          for start in range(0, max(len(self), 1), _DECODE_CHUNK)])
+
+
+class EmbeddingTable:
+    """
+        A table of embeddings identified by unique keys. The rows are stored in blocks: the
+        first block can be a memory-mapped matrix, that is never copied, while the rows added
+        later go in new small blocks. Removed rows are only marked as dead, so that no block
+        is ever rewritten.
+    """
+
+    # When there are more blocks, the ones after the first are merged in a single block
+    MAX_BLOCKS = 8
+
+    def __init__(self) -> None:
+        self._keys = list()
+        self._positions = dict()
+        self._blocks = list()
+        self._offsets = list()
+        self._dead = set()
+        self._key_array = None
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, key) -> bool:
+        return key in self._positions
+
+    def keys(self) -> list:
+        """
+            Returns the keys of the alive rows, in insertion order
+        """
+        return [key for row, key in enumerate(self._keys) if row not in self._dead]
+
+    @property
+    def quantized(self) -> bool:
+        """
+            True if some rows are compressed, so that their distances are approximated
+        """
+        return any(isinstance(block, QuantizedMatrix) for block in self._blocks)
+
+    def add(self, keys: list, embeddings: np.ndarray):
+        """
+            Adds a block of embeddings. A float32 matrix, memory-mapped or not, and a QuantizedMatrix
+            are stored without copies.
+                - raise: KeyError if a key is already in the table
+        """
+        if len(keys) == 0:
+            return
+
+        for key in keys:
+            if key in self._positions:
+                raise KeyError(key)
+
+        start = len(self._keys)
+
+        self._keys.extend(keys)
+        self._positions.update({key: start + i for i, key in enumerate(keys)})
+        if not isinstance(embeddings, QuantizedMatrix):
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+
+        self._blocks.append(embeddings)
+        self._offsets.append(start)
+        self._key_array = None
+
+        if len(self._blocks) > self.MAX_BLOCKS:
+            self._merge_blocks()
+
+    def _merge_blocks(self):
+        # Keep the first block untouched, since it could be memory-mapped or compressed
+        merged = np.concatenate([np.asarray(block, dtype=np.float32) for block in self._blocks[1:]])
+
+        self._blocks = [self._blocks[0], merged]
+        self._offsets = [self._offsets[0], self._offsets[1]]
+
+    def remove(self, keys: list):
+        """
+            Marks the rows of some keys as dead
+                - raise: KeyError if a key is not in the table
+        """
+        for key in keys:
+            self._dead.add(self._positions.pop(key))
+
+    def get(self, key) -> np.ndarray:
+        """
+            Returns the embedding of a key
+                - raise: KeyError if the key is not in the table
+        """
+        row = self._positions[key]
+        block = bisect_right(self._offsets, row) - 1
+
+        return self._blocks[block][row - self._offsets[block]]
+
+    def rows(self, rows: np.ndarray) -> np.ndarray:
+        """
+            Returns the float32 embeddings of some rows, given as an array of positions. The
+            compressed rows are read from their exact embeddings, if they are stored.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        found = np.empty((len(rows), self._blocks[0].shape[1]), dtype=np.float32)
+        owners = np.searchsorted(self._offsets, rows, side='right') - 1
+
+        for block in np.unique(owners):
+            members = owners == block
+            local = rows[members] - self._offsets[block]
+
+            if isinstance(self._blocks[block], QuantizedMatrix):
+                found[members] = self._blocks[block].rows(local)
+            else:
+                found[members] = self._blocks[block][local]
+
+        return found
+
+    def matrix(self) -> np.ndarray:
+        """
+            Returns a new matrix with the embeddings of the alive rows, in the order of keys()
+        """
+        if len(self._positions) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+
+        return to_embedding_matrix([self.get(key) for key in self.keys()])
+
+    @property
+    def key_array(self) -> np.ndarray:
+        """
+            An array with the keys of all the rows, dead rows included
+        """
+        if self._key_array is None:
+            self._key_array = np.array(self._keys, dtype=object)
+
+        return self._key_array
+
+    def distances(self, probes: np.ndarray, metric: str) -> np.ndarray:
+        """
+            Computes the distances between the probes and all the rows, block by block.
+                - return: a (p, rows) matrix, with infinite distances for the dead rows
+        """
+        distances = np.hstack([block.distances(probes, metric) if isinstance(block, QuantizedMatrix)
+                               else compute_distances(probes, block, metric) for block in self._blocks])
+
+        if len(self._dead) > 0:
+            distances[:, list(self._dead)] = np.inf
+
+        return distances
+
+    def copy(self) -> 'EmbeddingTable':
+        """
+            Returns a copy of the table that shares the embedding blocks with this one
+        """
+        table = EmbeddingTable()
+
+        table._keys = list(self._keys)
+        table._positions = dict(self._positions)
+        table._blocks = list(self._blocks)
+        table._offsets = list(self._offsets)
+        table._dead = set(self._dead)
+
+        return table
+
+    def __getstate__(self) -> dict:
+        # Persist only the alive rows in a single block
+        return {'keys': self.keys(), 'matrix': np.array(self.matrix())}
+
+    def __setstate__(self, state: dict):
+        self.__init__()
+        self.add(state['keys'], state['matrix'])
+
+
+class GalleryIndex(ABC):
+    """
+        This class provides an interface to the indexes used to search the
+        closest stored embeddings to a set of probe embeddings. The stored
+        embeddings are identified by a unique key, the username.
+    """
+
+    # True if the index is worth persisting, because building it costs more than loading it
+    persistent = True
+
+    # Parameters that only affect the search, so they can be changed on a persisted index
+    SEARCH_PARAMS = ('rerank',)
+
+    # The number of candidates of the coarse scan of the compressed embeddings that are re-ranked
+    # with their exact embeddings. If it is not greater than k, the candidates are not re-ranked
+    rerank = 0
+
+    def __init__(self, metric: str = METRIC_EUCLIDEAN, rerank: int = 0) -> None:
+        """
+            - metric: the metric used to evaluate the distance between the embeddings
+            - rerank: the number of candidates re-ranked with the exact embeddings for every probe
+        """
+        if metric not in SUPPORTED_METRICS:
+            raise ValueError(f'Unsupported distance metric: {metric}')
+
+        self.metric = metric
+        self.rerank = rerank
+
+    @abstractmethod
+    def add(self, keys: list, embeddings: np.ndarray):
+        """
+            This method adds some embeddings to the index
+                - keys:         the unique keys of the embeddings
+                - embeddings:   a (n, d) matrix of embeddings, one for every key
+                - raise:        KeyError if a key is already in the index
+        """
+        pass
+
+    @abstractmethod
+    def remove(self, keys: list):
+        """
+            This method removes some embeddings from the index
+                - keys:     the keys of the embeddings to remove
+                - raise:    KeyError if a key is not in the index
+        """
+        pass
+
+    @abstractmethod
+    def search(self, probes: np.ndarray, k: int = 1) -> tuple:
+        """
+            This method searches the k closest stored embeddings to every probe
+                - probes:   a (p, d) matrix of probe embeddings
+                - k:        the number of neighbours to return for every probe
+                - return:   a (distances, keys) pair of (p, k) matrices, sorted by distance. Missing
+                            neighbours have an infinite distance and a None key
+        """
+        pass
+
+    @abstractmethod
+    def get(self, key) -> np.ndarray:
+        """
+            This method returns the stored embedding of a key
+                - raise: KeyError if the key is not in the index
+        """
+        pass
+
+    @abstractmethod
+    def keys(self) -> set:
+        """
+            This method returns the keys stored in the index
+        """
+        pass
+
+    @abstractmethod
+    def copy(self) -> 'GalleryIndex':
+        """
+            This method returns a copy of the index that can be modified without affecting
+            this one. The embeddings are shared between the copies, not duplicated.
+        """
+        pass
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    @staticmethod
+    def _search_tables(probes: np.ndarray, tables: list, k: int, metric: str, rerank: int = 0) -> tuple:
+        # Search the k closest embeddings to the probes among the rows of the given tables
+        distances = np.full((len(probes), k), np.inf, dtype=np.float32)
+        keys = np.full((len(probes), k), None, dtype=object)
+
+        tables = [table for table in tables if len(table) > 0]
+
+        if len(tables) == 0 or len(probes) == 0:
+            return distances, keys
+
+        found = np.hstack([table.distances(probes, metric) for table in tables])
+        candidate_keys = np.concatenate([table.key_array for table in tables])
+
+        if rerank > k and any(table.quantized for table in tables):
+            positions = select_top_k(found, rerank)
+            exact = GalleryIndex._exact_distances(probes, tables, positions, metric)
+
+            # Dead rows keep their infinite distance
+            exact[np.isinf(np.take_along_axis(found, positions, axis=1))] = np.inf
+            order = np.argsort(exact, axis=1)[:, :k]
+
+            positions = np.take_along_axis(positions, order, axis=1)
+            found_distances = np.take_along_axis(exact, order, axis=1)
+        else:
+            positions = select_top_k(found, k)
+            found_distances = np.take_along_axis(found, positions, axis=1)
+
+        distances[:, :positions.shape[1]] = found_distances
+        keys[:, :positions.shape[1]] = candidate_keys[positions]
+
+        # Dead rows could be selected if there are less than k alive rows
+        keys[np.isinf(distances)] = None
+
+        return distances, keys
+
+
+    @staticmethod
+    def _exact_distances(probes: np.ndarray, tables: list, positions: np.ndarray, metric: str) -> np.ndarray:
+        # Compute the exact distances between every probe and its candidates, given as positions
+        # in the concatenation of the rows of the tables
+        starts = np.cumsum([0] + [len(table.key_array) for table in tables])
+        owners = np.searchsorted(starts, positions, side='right') - 1
+        exact = np.empty(positions.shape, dtype=np.float32)
+
+        for i, probe in enumerate(probes):
+            candidates = np.empty((positions.shape[1], probes.shape[1]), dtype=np.float32)
+
+            for table in np.unique(owners[i]):
+                members = owners[i] == table
+                candidates[members] = tables[table].rows(positions[i][members] - starts[table])
+
+            exact[i] = compute_distances(probe[None, :], candidates, metric)[0]
+
+        return exact
+
+
+class FlatIndex(GalleryIndex):
+    """
+        An exact index, that compares every probe against all the stored embeddings.
+        The embeddings are matched in place, so a memory-mapped gallery is never copied.
+    """
+
+    # Building a flat index does not copy the embeddings, so it is never persisted
+    persistent = False
+
+    def __init__(self, metric: str = METRIC_EUCLIDEAN, rerank: int = 0) -> None:
+        super(FlatIndex, self).__init__(metric, rerank)
+        self._table = EmbeddingTable()
+
+    def add(self, keys: list, embeddings: np.ndarray):
+        self._table.add(keys, embeddings)
+
+    def remove(self, keys: list):
+        self._table.remove(keys)
+
+    def search(self, probes: np.ndarray, k: int = 1) -> tuple:
+        # All the probes are compared at once against the whole gallery
+        return self._search_tables(probes, [self._table], k, self.metric, self.rerank)
+
+    def get(self, key) -> np.ndarray:
+        return self._table.get(key)
+
+    def keys(self) -> set:
+        return set(self._table.keys())
+
+    def copy(self) -> 'FlatIndex':
+        index = FlatIndex(self.metric, self.rerank)
+        index._table = self._table.copy()
+
+        return index
+
+
+class IVFIndex(GalleryIndex):
+    """
+        An approximate inverted file index. The embeddings are partitioned in lists
+        by a k-means coarse quantizer and every probe is compared only against the
+        embeddings of the n_probe lists with the closest centroids. Until enough
+        embeddings are added to train the quantizer, the index behaves as a flat one.
+    """
+
+    # Parameters that only affect the search, so they can be changed on a persisted index
+    SEARCH_PARAMS = ('n_probe', 'rerank')
+
+    def __init__(self, metric: str = METRIC_EUCLIDEAN, n_lists: int = 256, n_probe: int = 8,
+                 min_train_size: int = None, kmeans_iterations: int = 10, seed: int = 0, rerank: int = 0) -> None:
+        """
+            - metric:               the metric used to evaluate the distance between the embeddings
+            - n_lists:              the number of partitions of the gallery
+            - n_probe:              the number of partitions searched for every probe. Higher
+                                    values improve the recall and increase the latency
+            - min_train_size:       the number of embeddings needed to train the quantizer. By
+                                    default it is 39 times the number of lists
+            - kmeans_iterations:    the number of iterations of the k-means training
+            - seed:                 the seed used to initialize the centroids
+            - rerank:               the number of candidates re-ranked with the exact embeddings
+        """
+        super(IVFIndex, self).__init__(metric, rerank)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size if min_train_size is not None else 39 * n_lists
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+
+        self.centroids = None
+        self._lists = [EmbeddingTable()]
+        self._assignments = dict()
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def _prepare(self, embeddings: np.ndarray) -> np.ndarray:
+        # The partitions of the angular metrics are computed on the unit sphere
+        if self.metric in (METRIC_COSINE, METRIC_EUCLIDEAN_L2):
+            return _l2_normalize(embeddings)
+
+        return embeddings
+
+    def _assign(self, embeddings: np.ndarray) -> np.ndarray:
+        assignments = np.empty(len(embeddings), dtype=np.int64)
+
+        for start in range(0, len(embeddings), _ASSIGNMENT_CHUNK):
+            chunk = self._prepare(embeddings[start:start + _ASSIGNMENT_CHUNK])
+            distances = compute_distances(chunk, self.centroids, METRIC_EUCLIDEAN)
+            assignments[start:start + _ASSIGNMENT_CHUNK] = np.argmin(distances, axis=1)
+
+        return assignments
+
+    def train(self):
+        """
+            This method trains the coarse quantizer with the stored embeddings
+            and redistributes them in the new lists.
+        """
+        keys = [key for inverted in self._lists for key in inverted.keys()]
+
+        if len(keys) < self.n_lists:
+            return
+
+        embeddings = np.concatenate([inverted.matrix() for inverted in self._lists if len(inverted) > 0])
+
+        # Run the Lloyd's iterations of k-means from a random subset of the embeddings
+        points = self._prepare(embeddings)
+        rng = np.random.default_rng(self.seed)
+        self.centroids = points[rng.choice(len(points), self.n_lists, replace=False)].copy()
+
+        for _ in range(self.kmeans_iterations):
+            assignments = self._assign(embeddings)
+
+            for list_id in range(self.n_lists):
+                members = points[assignments == list_id]
+
+                if len(members) > 0:
+                    self.centroids[list_id] = members.mean(axis=0)
+
+        self._lists = [EmbeddingTable() for _ in range(self.n_lists)]
+        self._assignments = dict()
+        self._add(keys, embeddings)
+
+    def _add(self, keys: list, embeddings: np.ndarray):
+        assignments = self._assign(embeddings) if self.trained else np.zeros(len(keys), dtype=np.int64)
+        keys = np.array(keys, dtype=object)
+
+        # Add a single block to every list that receives some embeddings
+        for list_id in np.unique(assignments):
+            members = assignments == list_id
+
+            self._lists[list_id].add(list(keys[members]), embeddings[members])
+            self._assignments.update({key: int(list_id) for key in keys[members]})
+
+    def add(self, keys: list, embeddings: np.ndarray):
+        for key in keys:
+            if key in self._assignments:
+                raise KeyError(key)
+
+        self._add(keys, np.asarray(embeddings, dtype=np.float32))
+
+        if not self.trained and len(self._assignments) >= self.min_train_size:
+            self.train()
+
+    def remove(self, keys: list):
+        for key in keys:
+            self._lists[self._assignments.pop(key)].remove([key])
+
+    def search(self, probes: np.ndarray, k: int = 1) -> tuple:
+        if not self.trained:
+            return self._search_tables(probes, self._lists, k, self.metric, self.rerank)
+
+        distances = np.full((len(probes), k), np.inf, dtype=np.float32)
+        keys = np.full((len(probes), k), None, dtype=object)
+
+        if len(probes) == 0:
+            return distances, keys
+
+        # Select the lists with the closest centroids to every probe
+        centroid_distances = compute_distances(self._prepare(probes), self.centroids, METRIC_EUCLIDEAN)
+        probed_lists = select_top_k(centroid_distances, self.n_probe)
+
+        for i, probe in enumerate(probes):
+            found_distances, found_keys = self._search_tables(probe[None, :], [self._lists[list_id] for list_id in probed_lists[i]],
+                                                              k, self.metric, self.rerank)
+            distances[i], keys[i] = found_distances[0], found_keys[0]
+
+        return distances, keys
+
+    def get(self, key) -> np.ndarray:
+        return self._lists[self._assignments[key]].get(key)
+
+    def keys(self) -> set:
+        return set(self._assignments.keys())
+
+    def copy(self) -> 'IVFIndex':
+        index = copy(self)
+
+        index._lists = [inverted.copy() for inverted in self._lists]
+        index._assignments = dict(self._assignments)
+
+        return index
+
+
+def build_index(index_type: str = INDEX_FLAT, metric: str = METRIC_EUCLIDEAN, **params) -> GalleryIndex:
+    """
+        This function builds an empty gallery index
+            - index_type:   the type of the index [flat, ivf]
+            - metric:       the metric used to evaluate the distance between the embeddings
+            - params:       the parameters specific to the index type
+            - return:       the empty index
+            - raise:        ValueError if the index type is not supported
+    """
+    if index_type == INDEX_FLAT:
+        # The flat index has no partitions, only the re-ranking applies to it
+        return FlatIndex(metric, params.get('rerank', 0))
+
+    if index_type == INDEX_IVF:
+        return IVFIndex(metric, **params)
+
+    raise ValueError(f'Unsupported index type: {index_type}')
@@ -0,0 +1,221 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+
+import time
+
+# The default buckets of the histograms that measure durations, in seconds
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The default buckets of the histograms that measure batch sizes
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+# The buckets of the histograms that count the faces of an image
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32)
+
+# The content type of the Prometheus text exposition format
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """
+        This class counts the observed values in cumulative buckets, so that the
+        distribution of a measure can be inspected without storing every value.
+    """
+
+    def __init__(self, buckets: tuple = DURATION_BUCKETS) -> None:
+        """
+            - buckets:  the sorted upper bounds of the buckets. A last bucket without
+                        upper bound is always added
+        """
+        self.buckets = tuple(sorted(buckets))
+
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        """
+            This method records a value in the first bucket whose upper bound is not lower than it
+        """
+        with self._lock:
+            self._counts[bisect_left(self.buckets, value)] += 1
+            self._sum += value
+
+    def snapshot(self) -> dict:
+        """
+            This method returns the cumulative count of every bucket, the number of
+            observed values and their sum
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        buckets = dict()
+        cumulative = 0
+
+        for bound, count in zip([*self.buckets, '+Inf'], counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+
+        return {'buckets': buckets, 'count': cumulative, 'sum': total}
+
+    @contextmanager
+    def time(self):
+        """
+            This method observes the seconds spent in the body of a with statement
+        """
+        tic = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - tic)
+
+
+class Counter:
+    """
+        This class counts the occurrences of an event. The count never decreases.
+    """
+
+    def __init__(self) -> None:
+        self._value = 0.0
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1):
+        """
+            This method increments the counter
+        """
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+
+class Gauge:
+    """
+        This class holds a value that can go up and down. The value is either set
+        explicitly, or read from a function every time it is requested.
+    """
+
+    def __init__(self, function=None) -> None:
+        """
+            - function: a function without arguments that returns the current value
+        """
+        self.function = function
+        self._value = 0.0
+
+    def set(self, value: float):
+        """
+            This method sets the current value
+        """
+        self._value = value
+
+    @property
+    def value(self) -> float:
+        return self.function() if self.function is not None else self._value
+
+
+class MetricsRegistry:
+    """
+        This class holds the metrics of the process and renders them in the Prometheus
+        text format. Every metric is identified by its name and its labels: requesting
+        the same metric twice returns the same instance.
+    """
+
+    def __init__(self) -> None:
+        # The families of metrics: name -> (type, help, {labels: metric})
+        self._families = dict()
+        self._lock = Lock()
+
+    def histogram(self, name: str, help: str, buckets: tuple = DURATION_BUCKETS, **labels) -> Histogram:
+        """
+            This method returns a histogram, creating it the first time it is requested
+        """
+        return self._get(name, help, 'histogram', labels, lambda: Histogram(buckets))
+
+    def counter(self, name: str, help: str, **labels) -> Counter:
+        """
+            This method returns a counter, creating it the first time it is requested
+        """
+        return self._get(name, help, 'counter', labels, Counter)
+
+    def gauge(self, name: str, help: str, function=None, **labels) -> Gauge:
+        """
+            This method returns a gauge, creating it the first time it is requested
+                - function: a function that returns the value of a new gauge at every scrape
+        """
+        return self._get(name, help, 'gauge', labels, lambda: Gauge(function))
+
+    def register(self, name: str, help: str, metric, **labels):
+        """
+            This method registers a metric created elsewhere, like the histograms of a component
+        """
+        kind = {Histogram: 'histogram', Counter: 'counter', Gauge: 'gauge'}[type(metric)]
+
+        self._get(name, help, kind, labels, lambda: metric)
+
+    def _get(self, name: str, help: str, kind: str, labels: dict, factory):
+        key = tuple(sorted(labels.items()))
+
+        with self._lock:
+            family = self._families.setdefault(name, (kind, help, dict()))
+
+            if family[0] != kind:
+                raise ValueError(f'The metric {name} is already registered as a {family[0]}')
+
+            if key not in family[2]:
+                family[2][key] = factory()
+
+            return family[2][key]
+
+    def render(self) -> str:
+        """
+            This method renders all the metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            families = [(name, kind, help, list(metrics.items())) for name, (kind, help, metrics) in self._families.items()]
+
+        lines = list()
+
+        for name, kind, help, metrics in families:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+
+            for labels, metric in metrics:
+                if kind == 'histogram':
+                    snapshot = metric.snapshot()
+
+                    for bound, count in snapshot['buckets'].items():
+                        lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {count}')
+
+                    lines.append(f'{name}_sum{_format_labels(labels)} {snapshot["sum"]}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {snapshot["count"]}')
+                else:
+                    lines.append(f'{name}{_format_labels(labels)} {float(metric.value)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: tuple) -> str:
+    if len(labels) == 0:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+# The metrics of the process, exposed by the /metrics endpoint
+metrics_registry = MetricsRegistry()
+
+
+def stage_histogram(stage: str) -> Histogram:
+    """
+        This function returns the histogram of the seconds spent in a stage of the requests
+            - stage:    the name of the stage, like detect or embed
+    """
+    return metrics_registry.histogram('deepface_stage_seconds', 'The seconds spent in every stage of the requests',
+                                      stage=stage)
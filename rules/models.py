@@ -0,0 +1,197 @@
+from deepface import DeepFace
+from deepface.commons import functions
+from deepface.detectors import FaceDetector
+from .engines import build_onnx_engine, ENGINE_KERAS, ENGINE_ONNX, SUPPORTED_ENGINES
+from os import environ
+from threading import Event, Lock, Thread
+
+import logging
+import numpy as np
+import time
+
+logger = logging.getLogger(__name__)
+
+# Side of the synthetic image used to warm up the detector backend
+WARM_UP_IMAGE_SIDE = 160
+
+# The threads of every inference of the current process. If 0 the engines choose them
+_inference_threads = 0
+
+
+def set_inference_threads(threads: int):
+    """
+        This function limits the threads used by the inferences of the current process. It must
+        be called before the first inference, since the thread pools of tensorflow are created then.
+            - threads: the intra-op and inter-op threads of tensorflow and onnxruntime, and the OpenMP threads
+    """
+    global _inference_threads
+    _inference_threads = threads
+
+    for variable in ('OMP_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS'):
+        environ[variable] = str(threads)
+
+    import tensorflow as tf
+
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    except RuntimeError as e:
+        # The runtime of tensorflow is already initialized, its pools cannot change anymore
+        logger.warning('Could not limit the tensorflow threads: %s', e)
+
+
+class ModelRegistry:
+    """
+        This class loads the face detector backend and the face recognition model
+        once per process and keeps them warm, so that the graph building and the
+        first-call costs are not paid by user requests.
+    """
+
+    def __init__(self, backend: str, model: str, engine: str = ENGINE_KERAS, quantization: str = None) -> None:
+        """
+            - backend:      the name of the face detector backend to preload
+            - model:        the name of the face recognition model to preload
+            - engine:       the engine that runs the recognition model [keras, onnx]
+            - quantization: the weight quantization of the onnx engine [None, fp16, int8]
+        """
+        if engine not in SUPPORTED_ENGINES:
+            raise ValueError(f'The engine {engine} is not supported')
+
+        self.backend = backend
+        self.model_name = model
+        self.engine_name = engine
+        self.quantization = quantization
+
+        self.model = None
+        self.engine = None
+        self.detector = None
+        self.target_size = None
+
+        self.error = None
+        self._ready = Event()
+        self._lock = Lock()
+
+    @property
+    def ready(self) -> bool:
+        """
+            True once the models are loaded and the warm-up inferences are completed
+        """
+        return self._ready.is_set()
+
+    def load(self):
+        """
+            This method builds the detector backend and the recognition model. Both of
+            them are cached by deepface, so the wrapper calls reuse these instances.
+        """
+        with self._lock:
+            if self.model is None:
+                tic = time.time()
+
+                self.model = DeepFace.build_model(self.model_name)
+                self.detector = FaceDetector.build_model(self.backend)
+                self.target_size = functions.find_target_size(model_name=self.model_name)
+
+                # The keras model is still the reference, the onnx engine is exported from it
+                if self.engine_name == ENGINE_ONNX:
+                    self.engine = build_onnx_engine(self.model, self.model_name, self.quantization,
+                                                    threads=_inference_threads)
+
+                logger.info('Loaded %s (%s) and %s in %.2f seconds', self.model_name, self.engine_name, self.backend,
+                            time.time() - tic)
+
+        return self
+
+    def warm_up(self):
+        """
+            This method runs a detection and an embedding inference on synthetic
+            inputs, so that the lazily built graphs are ready before the first request.
+        """
+        self.load()
+        tic = time.time()
+
+        # The detection could find no face in a blank image, so the detection is not enforced
+        blank = np.zeros((WARM_UP_IMAGE_SIDE, WARM_UP_IMAGE_SIDE, 3), dtype=np.uint8)
+        functions.extract_faces(img=blank, target_size=self.target_size,
+                                detector_backend=self.backend, enforce_detection=False)
+
+        self.predict(np.zeros((1, *self.target_size, 3), dtype=np.float32))
+
+        logger.info('Warmed up %s and %s in %.2f seconds', self.model_name, self.backend, time.time() - tic)
+        self._ready.set()
+
+    def start(self) -> Thread:
+        """
+            This method loads and warms up the models in a background thread, so that
+            the server can answer readiness probes while the warm-up is running.
+                - return: the started thread
+        """
+        thread = Thread(target=self._start, name='model-warm-up', daemon=True)
+        thread.start()
+
+        return thread
+
+    def _start(self):
+        try:
+            self.warm_up()
+        except Exception as e:
+            # Keep the instance not ready and record the reason
+            self.error = e
+            logger.exception('Could not warm up the models: %s', e)
+
+    def detect(self, img, enforce_detection=True) -> list:
+        """
+            This method detects and aligns the faces of an image with the preloaded detector
+                - img:                  the image, as a path to an existing file or a numpy array
+                - enforce_detection:    if True a ValueError is raised when no face is found
+                - return:               a list of (face, facial_area, confidence) tuples, where the face
+                                        is already resized to the input shape of the model
+        """
+        self.load()
+
+        return functions.extract_faces(img=img, target_size=self.target_size,
+                                       detector_backend=self.backend, enforce_detection=enforce_detection)
+
+    def embed(self, faces: list) -> list:
+        """
+            This method computes the embeddings of many face crops with a single
+            batched forward pass of the recognition model.
+                - faces:    a list of face crops, each one shaped (1, height, width, 3) as
+                            returned by the detection
+                - return:   the list of embeddings, in the same order of the input faces
+        """
+        if len(faces) == 0:
+            return list()
+
+        return self.predict(np.concatenate(faces)).tolist()
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        """
+            This method runs the recognition model on a batch of faces with the configured engine
+                - batch:    the faces, shaped (n, height, width, 3)
+                - return:   the embeddings, one per row
+        """
+        self.load()
+
+        if self.engine is not None:
+            return self.engine.predict(batch)
+
+        return self.model.predict(batch, verbose=0)
+
+
+# The registries of the current process, one for every detector backend, model and engine
+_registries = dict()
+_registries_lock = Lock()
+
+
+def get_registry(backend: str, model: str, engine: str = ENGINE_KERAS, quantization: str = None) -> ModelRegistry:
+    """
+        This function returns the registry of the current process that serves the
+        given detector backend and recognition model, creating it if needed.
+    """
+    key = (backend, model, engine, quantization)
+
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = ModelRegistry(*key)
+
+        return _registries[key]
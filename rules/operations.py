@@ -1,12 +1,18 @@
-from deepface.commons.distance import findThreshold, findEuclideanDistance
-from numpy import argmin
+from deepface.commons.distance import findThreshold
+from .metrics import metrics_registry, stage_histogram
+from .index import GalleryIndex, build_index, to_embedding_matrix, compute_distances, select_top_k, INDEX_FLAT, STORAGE_FLOAT32, SUPPORTED_STORAGES
 from .persistence.opm import ObjectPersistenceManager
+from .persistence.segmented import SegmentedStore, OP_ADD, OP_DELETE
 from os import remove
 from os.path import isfile, join
-from pandas import DataFrame
+from threading import Lock
 
+import logging
+import numpy as np
 import time
 
+logger = logging.getLogger(__name__)
+
 # If this constant is set, the input parameter is skipped. It is primarily used
 # on the username and info input parameter in the FaceRepresentation class. That's 
 # because if the action of 'find the closest representation' is performed, the
@@ -17,9 +23,356 @@ SKIP = 'skip'
 # A constant that defines the name of the file that contains all the representations
 REPRESENTATIONS_BLOB = 'representations.pkl'
 
+# A constant that defines the name of the file that contains the persisted gallery index
+INDEX_BLOB = 'gallery.index'
+
+# The number of segments that triggers the compaction into a new base snapshot
+COMPACTION_THRESHOLD = 32
+
+# The metrics of the gallery, exposed by the /metrics endpoint
+gallery_load_seconds = stage_histogram('gallery_load')
+match_seconds = stage_histogram('match')
+gallery_size = metrics_registry.gauge('deepface_gallery_size', 'The number of representations of the last loaded gallery')
+
+
+class Gallery:
+    """
+        This class holds the decoded content of the representations storage: the info
+        of every username and the index that contains their embeddings. The embeddings
+        are not copied out of the index, which can match them in place, even when they
+        are memory-mapped from the storage.
+    """
+
+    def __init__(self, infos: dict, index: GalleryIndex, segments: frozenset = frozenset()) -> None:
+        """
+            - infos:    a dictionary that maps every username to its info
+            - index:    the index that contains the embeddings of the usernames
+            - segments: the names of the storage segments included in the gallery
+        """
+        self.infos = infos
+        self.index = index
+        self.segments = segments
+
+    def __len__(self) -> int:
+        return len(self.infos)
+
+    def __contains__(self, username: str) -> bool:
+        return username in self.infos
+
+    @property
+    def usernames(self) -> list:
+        return list(self.infos.keys())
+
+    @property
+    def representations(self) -> list:
+        """
+            The list of representations of the gallery, built on demand
+        """
+        return [{'username': username, 'info': info, 'embedding': self.index.get(username).tolist()}
+                for username, info in self.infos.items()]
+
+    def embedding_of(self, username: str) -> np.ndarray:
+        """
+            This method returns the embedding of a username
+                - raise: KeyError if the username is not in the gallery
+        """
+        return self.index.get(username)
+
+    def matrix(self) -> np.ndarray:
+        """
+            This method returns a new float32 matrix with the embeddings of the usernames, in
+            the order of the usernames property
+        """
+        return to_embedding_matrix([self.index.get(username) for username in self.infos])
+
+    def apply(self, segments: dict) -> 'Gallery':
+        """
+            This method replays the records of some storage segments over the gallery.
+            The gallery is not mutated, since it could be used by other requests.
+                - segments: a dictionary that maps the segment names to their records, in
+                            the order they have been written
+                - return:   the updated Gallery
+        """
+        gallery = self.apply_records([record for records in segments.values() for record in records])
+        gallery.segments = self.segments | frozenset(segments)
+
+        return gallery
+
+    def apply_records(self, records: list) -> 'Gallery':
+        """
+            This method applies some add/delete records to a copy of the gallery
+                - records:  the records to apply, in the order they have been written
+                - return:   the updated Gallery
+        """
+        infos = dict(self.infos)
+        added = dict()
+        removed = list()
+
+        for record in records:
+            if record['op'] == OP_ADD:
+                rep = record['representation']
+
+                # The first enrolment of a username wins over concurrent ones
+                if rep['username'] not in infos:
+                    infos[rep['username']] = rep['info']
+                    added[rep['username']] = rep['embedding']
+
+            elif record['op'] == OP_DELETE and record['username'] in infos:
+                del infos[record['username']]
+
+                # A username added by these records is not in the index yet
+                if added.pop(record['username'], None) is None:
+                    removed.append(record['username'])
+
+        # The index is updated once, so that the added embeddings are stored as a single block
+        index: GalleryIndex = self.index.copy()
+        index.remove(removed)
+
+        if len(added) > 0:
+            index.add(list(added.keys()), to_embedding_matrix(list(added.values())))
+
+        return Gallery(infos, index, self.segments)
+
+
+class GalleryCache:
+    """
+        This class is a process-wide cache of the decoded galleries. A gallery is
+        downloaded again only when the version of the backing entity, as reported
+        by the persistence manager, changes.
+    """
+
+    def __init__(self, index_type: str = INDEX_FLAT, index_params: dict = None) -> None:
+        """
+            - index_type:   the type of the index built over the galleries [flat, ivf]
+            - index_params: the parameters of the index, as accepted by build_index
+        """
+        self._lock = Lock()
+        self._entries = dict()
+
+        self.index_type = index_type
+        self.index_params = index_params if index_params is not None else dict()
+
+        # How the compactions store the embeddings
+        self.storage = STORAGE_FLOAT32
+        self.keep_exact = False
+
+        # Counters used to monitor the effectiveness of the cache
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.replayed_segments = 0
+
+    def configure_index(self, index_type: str, **index_params):
+        """
+            This method changes the type of the index built over the galleries. The
+            cached galleries are dropped, so that their index is built again.
+                - index_type:   the type of the index [flat, ivf]
+                - index_params: the parameters of the index, as accepted by build_index
+        """
+        build_index(index_type, **index_params)
+
+        with self._lock:
+            self.index_type = index_type
+            self.index_params = index_params
+            self._entries.clear()
+
+    def configure_storage(self, storage: str, keep_exact: bool = False):
+        """
+            This method changes how the embeddings are stored by the next compactions. The
+            snapshots already written keep their storage type, and are still readable.
+                - storage:      the type of the stored embeddings [float32, float16, int8]
+                - keep_exact:   if True the exact embeddings are stored next to the compressed ones
+                - raise:        ValueError if the storage type is not supported
+        """
+        if storage not in SUPPORTED_STORAGES:
+            raise ValueError(f'Unsupported storage type: {storage}')
+
+        self.storage = storage
+        self.keep_exact = keep_exact
+
+    def store(self, persistence_manager: ObjectPersistenceManager, entity_name: str = REPRESENTATIONS_BLOB) -> SegmentedStore:
+        """
+            This method returns the segmented store of an entity, with the configured storage type
+        """
+        return SegmentedStore(persistence_manager, entity_name, self.storage, self.keep_exact)
+
+    def build_index(self, usernames: list, embeddings: np.ndarray) -> GalleryIndex:
+        """
+            This method builds a configured index with the given embeddings
+                - usernames:    the usernames that identify the embeddings
+                - embeddings:   a matrix with the embedding of every username, one per row
+        """
+        index = build_index(self.index_type, **self.index_params)
+
+        if len(usernames) > 0:
+            index.add(usernames, embeddings)
+
+        return index
+
+    def _load_index(self, persistence_manager: ObjectPersistenceManager, usernames: list,
+                    embeddings: np.ndarray) -> GalleryIndex:
+        # Reuse the persisted index only if it has the configured type and it
+        # contains exactly the downloaded usernames, otherwise rebuild it
+        expected_index = build_index(self.index_type, **self.index_params)
+
+        if persistence_manager.stores_objects and expected_index.persistent:
+            index = persistence_manager.download(INDEX_BLOB)
+
+            if (type(index) is type(expected_index) and index.metric == expected_index.metric and
+                    index.keys() == set(usernames)):
+                # Apply the configured search knobs to the persisted index
+                for name in getattr(index, 'SEARCH_PARAMS', tuple()):
+                    if name in self.index_params:
+                        setattr(index, name, self.index_params[name])
+
+                return index
+
+        return self.build_index(usernames, embeddings)
+
+    def persist_index(self, persistence_manager: ObjectPersistenceManager, index: GalleryIndex):
+        """
+            This method uploads an index, so that other workers do not need to rebuild it
+        """
+        if persistence_manager.stores_objects and index.persistent:
+            persistence_manager.upload(INDEX_BLOB, index)
+
+    @staticmethod
+    def _key(persistence_manager: ObjectPersistenceManager, entity_name: str) -> tuple:
+        return type(persistence_manager).__name__, persistence_manager.persistence_location, entity_name
+
+    def get(self, persistence_manager: ObjectPersistenceManager, entity_name: str = REPRESENTATIONS_BLOB) -> Gallery:
+        """
+            This method returns the gallery stored in the given entity, downloading
+            it only if it is not cached or if its version is changed. If the storage
+            supports segments, only the segments not seen yet are downloaded.
+                - persistence_manager:  the storage manager that holds the representations
+                - entity_name:          the name of the entity that contains the representations
+                - return:               the cached or freshly downloaded Gallery
+        """
+        if persistence_manager.stores_objects:
+            return self._get_segmented(self.store(persistence_manager, entity_name))
+
+        key = self._key(persistence_manager, entity_name)
+        version = persistence_manager.version(entity_name)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and version is not None and entry[0] == version:
+                self.hits += 1
+                return entry[1]
+
+            self._count_load(entry)
+
+            representations = persistence_manager.download(entity_name)
+            gallery = self._gallery_from_representations(representations if representations is not None else list())
+            self._entries[key] = (version, gallery)
+
+        return gallery
+
+    def _get_segmented(self, store: SegmentedStore) -> Gallery:
+        key = self._key(store.persistence_manager, store.base_name)
+
+        # The round trips to the storage are made outside of the lock, so the readers of a
+        # cached gallery do not wait for each other. The segments are listed before the base
+        # version is read: a compaction in between leaves listed segments that are already
+        # folded, which are harmless, instead of a stale base without the folded segments
+        segments = store.list_segments()
+        version = store.base_version()
+        listed = frozenset(segments)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] == version and all(segment in entry[1].segments for segment in segments):
+                self.hits += 1
+                return entry[1]
+
+            if entry is None or entry[0] != version:
+                self._count_load(entry)
+
+        # Reload the base snapshot only if it is changed, that is after a compaction
+        if entry is None or entry[0] != version:
+            usernames, infos, embeddings, folded = store.load_base()
+            index = self._load_index(store.persistence_manager, usernames, embeddings)
+            gallery = Gallery(dict(zip(usernames, infos)), index, folded & listed)
+        else:
+            gallery = entry[1]
+
+        # Replay only the segments that are not already in the gallery
+        pending = [segment for segment in segments if segment not in gallery.segments]
+
+        if len(pending) > 0:
+            gallery = gallery.apply({segment: store.read_segment(segment) for segment in pending})
+            # Forget the segments deleted by the compactions, so the set does not grow with every write
+            gallery.segments &= listed
+
+        with self._lock:
+            self.replayed_segments += len(pending)
+            self._entries[key] = (version, gallery)
+
+        return gallery
+
+    def _gallery_from_representations(self, representations: list) -> Gallery:
+        usernames = [rep['username'] for rep in representations]
+        embeddings = to_embedding_matrix([rep['embedding'] for rep in representations])
+
+        return Gallery({rep['username']: rep['info'] for rep in representations},
+                       self.build_index(usernames, embeddings))
+
+    def _count_load(self, entry):
+        if entry is None:
+            self.misses += 1
+        else:
+            self.reloads += 1
+
+    def advance(self, persistence_manager: ObjectPersistenceManager, gallery: Gallery, records: list, version: int,
+                entity_name: str = REPRESENTATIONS_BLOB):
+        """
+            This method applies to the cached gallery the records that have just been written, so
+            that the next read does not download the gallery again. If another write happened since
+            the gallery was cached, the gallery is dropped and downloaded again by the next read.
+                - persistence_manager:  the storage manager that holds the representations
+                - gallery:              the gallery on which the records have been written
+                - records:              the written add/delete records
+                - version:              the version of the entity after the write, one more than before it
+                - entity_name:          the name of the entity that contains the representations
+        """
+        key = self._key(persistence_manager, entity_name)
+        updated = gallery.apply_records(records)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[1] is gallery and isinstance(entry[0], int) and entry[0] + 1 == version:
+                self._entries[key] = (version, updated)
+            else:
+                self._entries.pop(key, None)
+
+    def invalidate(self, persistence_manager: ObjectPersistenceManager, entity_name: str = REPRESENTATIONS_BLOB):
+        """
+            This method removes a gallery from the cache
+        """
+        with self._lock:
+            self._entries.pop(self._key(persistence_manager, entity_name), None)
+
+    def stats(self) -> dict:
+        """
+            This method returns the counters of the cache
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'reloads': self.reloads,
+                    'replayed_segments': self.replayed_segments, 'cached_galleries': len(self._entries)}
+
+
+# The process-wide gallery cache shared by all the face operations
+gallery_cache = GalleryCache()
+
+
 class FaceOperation:
     def __init__(self, persistence_manager: ObjectPersistenceManager) -> None:
         self.persistence_manager = persistence_manager
+        self.gallery_cache = gallery_cache
         self.temp_download_folder = 'temp'
 
     @staticmethod
@@ -32,14 +385,40 @@ class FaceOperation:
         if isfile(path):
             remove(path)
     
-    @classmethod
-    def get_dataframe_from_representations(cls, reps: list):
+    def _write(self, gallery: Gallery, records: list, compact: bool = False):
         """
-            This class method is used to cast a list of face representations
-            in a pandas Dataframe that will be used to quickly check 
-            the status of the storage while Face operation are running
+            This method persists some add/delete records. If the storage supports segments,
+            the records are appended as a new small segment and the segments are compacted
+            when they are too many. Otherwise the whole list of representations is uploaded.
+                - gallery:  the gallery on which the records have been validated
+                - records:  the add/delete records to persist
+                - compact:  if True the segments are compacted right away, so that a large
+                            segment is not replayed by every reader
         """
-        return DataFrame(reps)
+        if not self.persistence_manager.stores_objects:
+            # Only the documents of the records are written, so that concurrent writers do not
+            # overwrite each other and a write does not cost the whole gallery
+            upserts = [dict(record['representation'], embedding=np.asarray(record['representation']['embedding']).tolist())
+                       for record in records if record['op'] == OP_ADD]
+            deletions = [record['username'] for record in records if record['op'] == OP_DELETE]
+
+            version = self.persistence_manager.update(REPRESENTATIONS_BLOB, upserts, deletions)
+            self.gallery_cache.advance(self.persistence_manager, gallery, records, version)
+            return
+
+        store = self.gallery_cache.store(self.persistence_manager)
+        store.append(records)
+
+        if compact or len(store.list_segments()) >= COMPACTION_THRESHOLD:
+            # A single writer compacts at a time, the segments of the others are folded by it or later
+            with store.compaction_lease() as leased:
+                if leased:
+                    # Fold the stored segments seen by the gallery refreshed under the lease into
+                    # a new base snapshot, and persist the index that matches it
+                    gallery: Gallery = self.gallery_cache.get(self.persistence_manager)
+                    segments = gallery.segments & frozenset(store.list_segments())
+                    store.compact(gallery.usernames, list(gallery.infos.values()), gallery.matrix(), segments)
+                    self.gallery_cache.persist_index(self.persistence_manager, gallery.index)
     
         
 
@@ -61,22 +440,14 @@ class FaceRepresentationDeleter(FaceOperation):
         """
         ret = False
 
-        representations: list  = self.persistence_manager.download(REPRESENTATIONS_BLOB)
+        gallery: Gallery = self.gallery_cache.get(self.persistence_manager)
    
-        if representations is not None:
-            df = self.get_dataframe_from_representations(representations)
-                
+        if len(gallery) > 0:
             # If the identity is not present into the storage a ValueError is raised
-            if self.identity_to_delete not in df['username'].values:                    
+            if self.identity_to_delete not in gallery:                    
                 raise ValueError
-            
-            rep_to_remove = next(rep for rep in representations if rep['username'] == self.identity_to_delete)
-            # Remove the identity and the representation
-            representations.remove(rep_to_remove)
-            
-            print(len(representations))
-
-            self.persistence_manager.upload(REPRESENTATIONS_BLOB, representations)
+
+            self._write(gallery, [SegmentedStore.delete_record(self.identity_to_delete)])
             ret = True 
                     
         return ret
@@ -107,38 +478,51 @@ class FaceRepresentationUploader(FaceOperation):
                             ValueError if the file could not be uploaded for generic issues
                 - Return:   a boolean value to determine the status of the upload
         """
-        representations: list = self.persistence_manager.download(REPRESENTATIONS_BLOB)
+        gallery: Gallery = self.gallery_cache.get(self.persistence_manager)
 
-        # Instantiate an empty list if no representations were previously saved
-        if representations is None:            
-            representations: list = list()
+        # Upload the new representation if its username is not already enrolled
+        if self.rep['username'] in gallery:
+            logger.info('Duplicated username: %s', self.rep['username'])
+            return False
 
-        # Append the new representation    
-        representations.append(self.rep)
+        self._write(gallery, [SegmentedStore.add_record(self.rep)])
 
-        # Control flags
-        duplicated_username = False
-        upload_status = False
+        return True
 
-        # Check for duplicate usernames
-        if len(representations) > 1:
-            df = self.get_dataframe_from_representations(representations)
-            
-            print("Current Dataframe:")
-            print(df)
+    
+class FaceRepresentationBulkUploader(FaceOperation):
+    def __init__(self, persistence_manager: ObjectPersistenceManager, reps: list) -> None:
+        """
+            - persistence_manager: the specific storage manager, used to upload the FaceRepresentations
+            - reps: the representations to upload, with distinct usernames
+        """
+        super(FaceRepresentationBulkUploader, self).__init__(persistence_manager)
+        self.reps = reps
 
-            if True in df.duplicated(subset=['username']).values: 
-                print(df.duplicated(subset=['username']))
-                duplicated_username = True
+        if any(rep.get(key, SKIP) is SKIP for rep in reps for key in ('username', 'info', 'embedding')):
+            raise ValueError('Could not perform this action. Username and info are setted as SKIP ',
+                             'or embedding is not evaluated')
 
-        # Upload the updated representations if no duplicates are detected
-        if not duplicated_username:
-            self.persistence_manager.upload(REPRESENTATIONS_BLOB, representations)  
-            upload_status = True 
+    def upload_representations(self) -> list:
+        """
+            This method is used to upload many FaceRepresentations with a single write
+            to the storage location, instead of a write for every representation.
+                - Raise:    OSError if the file does not exists, or a generic
+                            ValueError if the file could not be uploaded for generic issues
+                - Return:   the usernames that were already enrolled, and have not been uploaded
+        """
+        gallery: Gallery = self.gallery_cache.get(self.persistence_manager)
+
+        # Upload only the representations whose username is not already enrolled
+        duplicated = [rep['username'] for rep in self.reps if rep['username'] in gallery]
+        records = [SegmentedStore.add_record(rep) for rep in self.reps if rep['username'] not in gallery]
+
+        if len(records) > 0:
+            self._write(gallery, records, compact=len(records) >= COMPACTION_THRESHOLD)
+
+        return duplicated
 
-        return upload_status
 
-    
 class FaceRecognizer(FaceOperation): 
     def __init__(self, persistence_manager: ObjectPersistenceManager, source_representations: list) -> None:
         """
@@ -149,57 +533,81 @@ class FaceRecognizer(FaceOperation):
         self.source_representations = source_representations
 
 
+    def rank_representations(self, k: int = 1, threshold: float = None, metric='euclidean', model='Facenet512') -> list:
+        """
+            This method is used to find, for every FaceRepresentation setted as input
+            of the class during init operations, the k closest stored FaceRepresentations.
+            All the probes are searched together, and only the k closest candidates of every
+            probe are selected with a partial sort, so the whole gallery is never sorted.
+                - k:            the maximum number of candidates of every input FaceRepresentation
+                - threshold:    the maximum distance of a candidate. If None the threshold of the
+                                model and of the metric is used
+                - metric:       the metric used to evaluate the distance between the representations.
+                                [cosine, euclidean, euclidean_l2]
+                - return:       a list with an entry for every input FaceRepresentation. The entry is the
+                                list of its candidates sorted by distance, each one a dictionary with the
+                                username, the info, the distance and a score. The score is 1 for identical
+                                embeddings and 0 at the threshold
+        """
+        ranked_candidates = [list() for _ in self.source_representations]
+
+        with gallery_load_seconds.time():
+            gallery: Gallery = self.gallery_cache.get(self.persistence_manager)
+
+        gallery_size.set(len(gallery))
+
+        if len(gallery) > 0 and self.source_representations:
+            match_tic = time.perf_counter()
+
+            if threshold is None:
+                threshold = findThreshold(model_name=model, distance_metric=metric)
+
+            probes = to_embedding_matrix([unknown['embedding'] for unknown in self.source_representations])
+
+            # Search the closest stored embeddings with the gallery index. If the index
+            # serves another metric, compare the probes against the whole gallery
+            if gallery.index.metric == metric:
+                distances, usernames = gallery.index.search(probes, k=k)
+            else:
+                distances = compute_distances(probes, gallery.matrix(), metric)
+                closest = select_top_k(distances, k)
+                usernames = np.array(gallery.usernames, dtype=object)[closest]
+                distances = np.take_along_axis(distances, closest, axis=1)
+
+            for i, j in zip(*np.nonzero(distances <= threshold)):
+                if usernames[i, j] is not None:
+                    distance = float(distances[i, j])
+                    ranked_candidates[i].append({'username': usernames[i, j],
+                                                 'info': gallery.infos[usernames[i, j]],
+                                                 'distance': distance,
+                                                 'score': min(max(1 - distance / threshold, 0.0), 1.0) if threshold > 0 else 1.0})
+
+            match_seconds.observe(time.perf_counter() - match_tic)
+
+        return ranked_candidates
+
+    def match_representations(self, metric='euclidean', model='Facenet512') -> list:
+        """
+            This method is used to find, for every FaceRepresentation setted as input
+            of the class during init operations, the closest stored FaceRepresentation
+                - metric:   the metric used to evaluate the distance between the representations.
+                            [cosine, euclidean, euclidean_l2]
+                - return:   a list with an entry for every input FaceRepresentation. The entry is
+                            the found identity, or None if no identity is close enough
+        """
+        return [f'{candidates[0]["username"]} - {candidates[0]["info"]}' if len(candidates) > 0 else None
+                for candidates in self.rank_representations(1, None, metric, model)]
+
     def find_closest_representations(self, metric='euclidean', model='Facenet512') -> list:
         """
             This method is used to find the FaceRepresentation
             whose embeddings are the closest possible to the FaceRepresentation
             setted as input of the class during init operations
                 - metric:   the metric used to evaluate the distance between the representations.
-                            [cosine, euclidean]
+                            [cosine, euclidean, euclidean_l2]
                 - return:   a list of the found identies from the input FaceRepresentation list
-                - raise:    ValueError if no distances are found
         """
-        found_identities = list()
-
-        tic = time.time()
-        known_representations: list = self.persistence_manager.download(REPRESENTATIONS_BLOB)
-        tac = time.time()
-        
-        if known_representations is not None:
-            print(f'Downloaded representations data in {str(tac - tic)} seconds')
-
-            treshold = findThreshold(model_name=model, distance_metric=metric)
-
-            # List that saves the distances scores of the i_th representation
-            # against all the ones, already stored in the storage. It must be
-            found_distances = list()
-
-            for i, unknown in enumerate(self.source_representations):
-                # For every unknown input representation, calculate the distances
-                # againt all the known representations
-                for j, known in enumerate(known_representations):
-                    distance = findEuclideanDistance(known['embedding'], unknown['embedding'])
-                    found_distances.append(distance)
-                    print(f'{i} => {j}: {known["username"]} - distance: {distance}')
-
-                # Find the index of the lowest distance
-                if len(found_distances) == 1:
-                    min_dist_index = 0
-                else:
-                    min_dist_index = argmin(found_distances)
-                    print(min_dist_index)
-
-                if len(found_distances) > 0 and found_distances[min_dist_index] <= treshold:
-                    # Get the index of the minimum distance found during the process and extract the representation
-                    entry: dict = known_representations[min_dist_index]
-                    found_identities.append(f'{entry["username"]} - {entry["info"]}')
-                    print(f'Generated identity for {i} - {min_dist_index} with min distance {found_distances[min_dist_index]}')
-                
-                # Clear the list at the end of cycle to save 
-                # the distances for the next input representation
-                found_distances.clear()
-        
-        return found_identities
+        return [identity for identity in self.match_representations(metric, model) if identity is not None]
     
 
     def verify_identity(self, target_username: str, model='Facenet512', metric='euclidean') -> bool:
@@ -210,23 +618,28 @@ class FaceRecognizer(FaceOperation):
                 - target_username: the unique id of the representation which will be evaluated against source                    - return: a boolean value according to the operation status
                 - raise: StopIteration if the target_username does not exist
             """
-        contains = False
+        if self.persistence_manager.supports_lookup:
+            # Download only the representation of the target username
+            target = self.persistence_manager.download_document(REPRESENTATIONS_BLOB, target_username)
+
+            if target is None:
+                raise StopIteration
 
-        all_representation: list = self.persistence_manager.download(REPRESENTATIONS_BLOB)
+            target_embedding = target['embedding']
+        else:
+            gallery: Gallery = self.gallery_cache.get(self.persistence_manager)
 
-        if all_representation is not None:
             # Get if it exsists the unique representation with the target username
-            target: dict = next(rep for rep in all_representation if rep['username'] == target_username)
+            if target_username not in gallery:
+                raise StopIteration
 
-            treshold = findThreshold(model, metric)
-                
-            found_distances: list = []
+            target_embedding = gallery.embedding_of(target_username)
 
-            for source in self.source_representations:
-                found_distances.append(findEuclideanDistance(source['embedding'], target['embedding']))
+        treshold = findThreshold(model, metric)
 
-            # If the min distance is less than the treshold value then the input 
-            # representation contains the target identity
-            contains = min(found_distances) <= treshold
+        probes = to_embedding_matrix([source['embedding'] for source in self.source_representations])
+        found_distances = compute_distances(probes, to_embedding_matrix([target_embedding]), metric)
 
-        return contains   
+        # If the min distance is less than the treshold value then the input 
+        # representation contains the target identity
+        return bool(found_distances.min() <= treshold)
@@ -1,21 +1,38 @@
 # Import dependencies for the Azure specialization of the ObjectPersistenceManager
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError, ResourceNotModifiedError
+from ..cache import LRUCache
+from .clients import get_blob_service_client
 from .opm import ObjectPersistenceManager
-from os.path import join, isfile
 
-import os
 import pickle
 
+# The connection string of the Azurite storage emulator, that uses its well-known development
+# account. It lets the manager run against a local stand-in of the Azure storage
+AZURITE_CONNECTION_STRING = ('DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;'
+                             'AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuCo3BvlJ0fbACXJ40hg0Ve/i5jfHgOkcwCMc5Jmdw==;'
+                             'BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;')
+
+# The size of the chunks of the ranged downloads and of the block uploads. Larger blobs
+# are transferred in chunks, on up to MAX_CONCURRENCY parallel connections
+CHUNK_SIZE = 4 * 1024 * 1024
+MAX_CONCURRENCY = 4
+
+# The maximum size of the downloaded blobs kept to answer the conditional downloads
+DOWNLOAD_CACHE_BYTES = 256 * 1024 * 1024
+
 class AzureBlobManager(ObjectPersistenceManager):
     """
         This class inherits all of its services from the base ObjectPersistenceManager. 
         AzureBlobManager is specialized in uploading or downloading blobs 
-        to or from the Azure Storage service.
+        to or from the Azure Storage service. The last downloaded version of the
+        most recently used blobs is kept, so that downloading an unchanged blob costs
+        a single conditional request, without transferring its content again.
     """
 
-    def __init__(self, container_name: str, connection_string: str = 'skip'):
+    def __init__(self, container_name: str, connection_string: str = 'skip',
+                 max_concurrency: int = MAX_CONCURRENCY, create_container: bool = False,
+                 download_cache_bytes: int = DOWNLOAD_CACHE_BYTES):
         """
             Parameters
             ----------
@@ -23,26 +40,55 @@ class AzureBlobManager(ObjectPersistenceManager):
                 The name of the container where blobs will be uploaded.
 
             connection_string: str    
-                If specified, perform the connection using this string.
+                If specified, perform the connection using this string. Use
+                AZURITE_CONNECTION_STRING to connect to a local emulator.
+
+            max_concurrency: int
+                The number of parallel connections used to transfer a large blob.
+
+            create_container: bool
+                If True the container is created when it does not exist.
+
+            download_cache_bytes: int
+                The maximum size of the downloaded blobs kept in memory. The least
+                recently used ones are dropped, and downloaded again when requested.
         """
         super(AzureBlobManager, self).__init__(container_name)
         self.connection_string = connection_string
-        self.container_client = self.__blob_service_setup()
+        self.max_concurrency = max_concurrency
+        self.create_container = create_container
+        self._container_client = None
+
+        # The (etag, object) pair of the last downloaded version of the blobs, bounded by their size
+        self._downloads = LRUCache(download_cache_bytes)
+
+    @property
+    def container_client(self):
+        """
+            The client of the container, created the first time it is used. The underlying
+            service client, with its connections and its token, is shared with the other managers.
+        """
+        if self._container_client is None:
+            self._container_client = self.__blob_service_setup()
+
+        return self._container_client
 
     def __blob_service_setup(self):
-        # Use a token to access Azure resources instead
-        # This token is obtained via a Managed identity
-        token_credential = DefaultAzureCredential()
+        # Transfer the blobs larger than a chunk with ranged requests. Without a connection
+        # string the shared client uses a token obtained via a Managed identity
+        blob_service_client = get_blob_service_client(
+            None if self.connection_string == 'skip' else self.connection_string,
+            max_single_get_size=CHUNK_SIZE, max_chunk_get_size=CHUNK_SIZE,
+            max_single_put_size=CHUNK_SIZE, max_block_size=CHUNK_SIZE)
+        container_client = blob_service_client.get_container_client(self.persistence_location)
 
-        if self.connection_string == 'skip':
-            # Create the blob service client using the token
-            blob_service_client = BlobServiceClient(
-                account_url="https://deepfacestorage.blob.core.windows.net",
-                credential=token_credential)
-        else:
-            blob_service_client = BlobServiceClient.from_connection_string(self.connection_string)
+        if self.create_container:
+            try:
+                container_client.create_container()
+            except ResourceExistsError:
+                pass
 
-        return blob_service_client.get_container_client(self.persistence_location)
+        return container_client
 
     def upload(self, blob_name: str, data: object):
         """
@@ -63,23 +109,22 @@ class AzureBlobManager(ObjectPersistenceManager):
             ValueError 
                 If the file could not be uploaded for generic issues.
         """
-        # Write a temporary local file that will be uploaded to the blob storage
-        path: str = join('temp', blob_name)
-        with open(path, 'wb') as f: f.write(pickle.dumps(data))
+        # Upload the serialized data straight from memory, in parallel blocks if it is large
+        blob = self.container_client.upload_blob(blob_name, pickle.dumps(data), overwrite=True,
+                                                 max_concurrency=self.max_concurrency)
 
-        # Upload the temporary file to the blob storage
-        with open(path, 'rb') as blob_data:
-            blob = self.container_client.upload_blob(blob_name, blob_data, overwrite=True)
+        self._forget(blob_name)
 
-        if isfile(path) : os.remove(path)
-            
         if blob is None:
             raise ValueError('The upload of the blob failed')
         
     def download(self, blob_name: str) -> object:
         """
             This method is used to download a blob stored in the 
-            Azure blob manager and identified by its blob_name.
+            Azure blob manager and identified by its blob_name. If the blob
+            has been downloaded before, it is requested only if its ETag is
+            changed, otherwise the previously downloaded object is returned:
+            the returned objects must not be modified.
 
             Parameters
             ----------
@@ -97,18 +142,175 @@ class AzureBlobManager(ObjectPersistenceManager):
                 If the specified blob doe not exists.
         """
 
+        cached = self._downloads.get(blob_name)
+
         # Extract the stream data from the blob, handliing the exception if
-        # the resource is not found
+        # the resource is not found or if it is not changed since the last download
         try:
-            downloaded_blob = self.container_client.download_blob(blob_name)
+            if cached is not None:
+                stream = self.container_client.download_blob(blob_name, etag=cached[0],
+                                                             match_condition=MatchConditions.IfModified,
+                                                             max_concurrency=self.max_concurrency)
+            else:
+                stream = self.container_client.download_blob(blob_name, max_concurrency=self.max_concurrency)
+        except ResourceNotModifiedError:
+            return cached[1]
         except ResourceNotFoundError:
-            downloaded_blob = None
+            self._forget(blob_name)
+            return None
+
+        # The chunks of a large blob are downloaded in parallel
+        content = stream.readall()
+        downloaded_blob = pickle.loads(content)
 
-        # If the resource is downloadable write the bytes
-        if downloaded_blob is not None:
-            downloaded_blob = pickle.loads(downloaded_blob.readall())
+        self._downloads.put(blob_name, (stream.properties.etag, downloaded_blob), len(content))
 
         return downloaded_blob
+
+    def _forget(self, blob_name: str):
+        # Drop the downloaded version of a blob, that is changed or deleted
+        self._downloads.pop(blob_name)
+
+    def list(self, prefix: str) -> list:
+        """
+            Lists the blobs of the container whose name starts with the given prefix.
+
+            Parameters
+            ----------
+            prefix: str    
+                The prefix of the blob names to list.
+
+            Return
+            ------
+            names: list
+                The sorted list of the matching blob names.
+        """
+        names = sorted(blob.name for blob in self.container_client.list_blobs(name_starts_with=prefix))
+
+        # Drop the downloaded blobs deleted by other processes, like the compacted segments
+        listed = set(names)
+
+        for blob_name in self._downloads.keys():
+            if blob_name.startswith(prefix) and blob_name not in listed:
+                self._forget(blob_name)
+
+        return names
+
+    def delete(self, blob_name: str):
+        """
+            Deletes a blob of the container, if it exists.
+
+            Parameters
+            ----------
+            blob_name: str    
+                The name of the blob to delete.
+        """
+        self._forget(blob_name)
+
+        try:
+            self.container_client.delete_blob(blob_name)
+        except ResourceNotFoundError:
+            pass
+
+    def acquire_lease(self, blob_name: str, duration: int) -> object:
+        """
+            Acquires the lease of a lock blob, creating the blob if it does not exist.
+            Azure expires the lease by itself, the duration must be between 15 and 60 seconds.
+
+            Parameters
+            ----------
+            blob_name: str    
+                The name of the lock blob.
+
+            duration: int
+                The seconds after which the lease expires.
+
+            Return
+            ------
+            lease: BlobLeaseClient
+                The acquired lease, or None if another holder has it.
+        """
+        blob_client = self.container_client.get_blob_client(blob_name)
+
+        try:
+            blob_client.upload_blob(b'', overwrite=False)
+        except HttpResponseError as e:
+            # The blob already exists, and it could be leased
+            if e.status_code not in (409, 412):
+                raise
+
+        try:
+            return blob_client.acquire_lease(lease_duration=duration)
+        except HttpResponseError as e:
+            # The lease is held by another writer
+            if e.status_code == 409:
+                return None
+
+            raise
+
+    def renew_lease(self, blob_name: str, lease: object) -> bool:
+        """
+            Renews the lease of a lock blob for its whole duration.
+
+            Parameters
+            ----------
+            blob_name: str    
+                The name of the lock blob.
+
+            lease: BlobLeaseClient
+                The lease returned by acquire_lease.
+
+            Return
+            ------
+            renewed: bool
+                False if the lease is expired and acquired by another writer.
+        """
+        try:
+            lease.renew()
+        except HttpResponseError:
+            return False
+
+        return True
+
+    def release_lease(self, blob_name: str, lease: object):
+        """
+            Releases the lease of a lock blob.
+
+            Parameters
+            ----------
+            blob_name: str    
+                The name of the lock blob.
+
+            lease: BlobLeaseClient
+                The lease returned by acquire_lease.
+        """
+        try:
+            lease.release()
+        except HttpResponseError:
+            # The lease is expired, and maybe acquired by another writer
+            pass
+
+    def version(self, blob_name: str) -> object:
+        """
+            Returns the ETag of a blob, which changes every time the blob
+            is overwritten. Only the blob properties are fetched.
+
+            Parameters
+            ----------
+            blob_name: str    
+                The name of the blob whose version is requested.
+
+            Return
+            ------
+            etag: str
+                The ETag of the blob, or None if the blob does not exist.
+        """
+        try:
+            properties = self.container_client.get_blob_client(blob_name).get_blob_properties()
+        except ResourceNotFoundError:
+            return None
+
+        return properties.etag
     
     def remove(self):
         self.container_client.delete_container()
\ No newline at end of file
@@ -0,0 +1,159 @@
+# Shared clients of the persistence services. Every client is created lazily, the first time
+# a manager needs it, and then reused by all the managers and threads of the process, so the
+# connections and the access tokens are not created again for every manager
+from os import environ
+from threading import Lock
+
+# The default account of the Azure storage, used when no connection string is given
+AZURE_ACCOUNT_URL = 'https://deepfacestorage.blob.core.windows.net'
+
+# The keep-alive connections kept open to every host
+CONNECTION_POOL_SIZE = 16
+
+# If this variable is set, the Firestore client connects to the local emulator at that host
+FIRESTORE_EMULATOR_HOST = 'FIRESTORE_EMULATOR_HOST'
+
+# The project of the emulated database, when none is given
+EMULATOR_PROJECT = 'demo-deepface'
+
+_lock = Lock()
+_credential = None
+_session = None
+_blob_service_clients = dict()
+_firestore_clients = dict()
+
+
+def get_azure_credential():
+    """
+        Returns the shared Azure credential. The token obtained via the Managed identity
+        is cached by the credential, so it is requested only when it expires.
+
+        Return
+        ------
+        credential: DefaultAzureCredential
+            The credential shared by all the Azure clients of the process.
+    """
+    global _credential
+
+    with _lock:
+        if _credential is None:
+            from azure.identity import DefaultAzureCredential
+
+            _credential = DefaultAzureCredential()
+
+        return _credential
+
+
+def get_http_session():
+    """
+        Returns the shared HTTP session, that keeps up to CONNECTION_POOL_SIZE connections
+        alive for every host, so the requests do not open a new TLS connection each time.
+
+        Return
+        ------
+        session: requests.Session
+            The session shared by all the Azure clients of the process.
+    """
+    global _session
+
+    with _lock:
+        if _session is None:
+            from requests import Session
+            from requests.adapters import HTTPAdapter
+
+            adapter = HTTPAdapter(pool_connections=CONNECTION_POOL_SIZE, pool_maxsize=CONNECTION_POOL_SIZE)
+            _session = Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+
+        return _session
+
+
+def get_blob_service_client(connection_string: str = None, **options):
+    """
+        Returns the shared blob service client of an Azure storage account. The clients are
+        thread-safe, so a single one is created for every account and set of options.
+
+        Parameters
+        ----------
+        connection_string: str
+            If specified, connect using this string, otherwise connect to AZURE_ACCOUNT_URL
+            with the shared credential.
+
+        options: dict
+            The transfer options of the client, like max_single_get_size.
+
+        Return
+        ------
+        client: BlobServiceClient
+            The client of the storage account.
+    """
+    key = (connection_string, tuple(sorted(options.items())))
+    client = _blob_service_clients.get(key)
+
+    if client is not None:
+        return client
+
+    from azure.core.pipeline.transport import RequestsTransport
+    from azure.storage.blob import BlobServiceClient
+
+    # Resolve the shared objects before taking the lock, they take it too
+    transport = RequestsTransport(session=get_http_session(), session_owner=False)
+    credential = get_azure_credential() if connection_string is None else None
+
+    with _lock:
+        client = _blob_service_clients.get(key)
+
+        if client is None:
+            if connection_string is None:
+                client = BlobServiceClient(account_url=AZURE_ACCOUNT_URL, credential=credential,
+                                           transport=transport, **options)
+            else:
+                client = BlobServiceClient.from_connection_string(connection_string, transport=transport, **options)
+
+            _blob_service_clients[key] = client
+
+        return client
+
+
+def get_firestore_client(project: str = None):
+    """
+        Returns the shared Firestore client. The default firebase app is initialized only
+        once, and reused by the following calls. If the FIRESTORE_EMULATOR_HOST variable
+        is set, an anonymous client of the emulator is returned instead.
+
+        Parameters
+        ----------
+        project: str
+            If specified, the Google Cloud project of the database, otherwise the project
+            of the default credentials.
+
+        Return
+        ------
+        client: google.cloud.firestore_v1.client.Client
+            The client of the database.
+    """
+    with _lock:
+        client = _firestore_clients.get(project)
+
+        if client is None and environ.get(FIRESTORE_EMULATOR_HOST):
+            from google.auth.credentials import AnonymousCredentials
+            from google.cloud.firestore import Client
+
+            # The emulator accepts any project and does not need credentials
+            client = Client(project=project or EMULATOR_PROJECT, credentials=AnonymousCredentials())
+            _firestore_clients[project] = client
+
+        if client is None:
+            from firebase_admin import firestore, get_app, initialize_app
+
+            # The default app can be initialized once per process
+            try:
+                app = get_app()
+            except ValueError:
+                app = initialize_app(options={'projectId': project} if project is not None else None)
+
+            client = firestore.client(app)
+            _firestore_clients[project] = client
+
+        return client
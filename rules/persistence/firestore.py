@@ -1,53 +1,103 @@
-# Gobal dependencies for all Firebase products
-from firebase_admin import initialize_app 
+# The firebase app and the Firestore client are shared by all the managers
+from .clients import get_firestore_client
 from .opm import ObjectPersistenceManager
 
 # Import dependencies for the Firestore specialization of the ObjectPersistenceManager
-from firebase_admin import firestore
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud.firestore_v1 import Increment
 from google.cloud.firestore_v1.client import Client
+from threading import Event, Lock
+
+# The maximum number of writes of a single Firestore batch
+BATCH_SIZE = 500
+
+# The number of batches committed, or of collection chunks read, in parallel
+PARALLEL_REQUESTS = 8
+
+# The collection with a version document for every collection of representations. The
+# version is incremented by every write, so it can be checked with a single document read
+VERSIONS_COLLECTION = 'deepface_versions'
+VERSION_FIELD = 'version'
 
 
 class FirestoreDatabaseManager(ObjectPersistenceManager):
     """
-        This class inherits all of its services from the base ObjectPersistenceManager. 
+        This class inherits all of its services from the base ObjectPersistenceManager.
         FirestoreDatabaseManager is specialized in uploading or downloading
-        data to the Firestore database service of firebase.
+        data to the Firestore database service of firebase. Documents are
+        written in batches and collections are read in parallel chunks.
+        A collection can also be mirrored: a snapshot listener keeps a local
+        copy updated incrementally, and downloads are served from it.
     """
 
-    def __init__(self, collection: str = "skip") -> None:
+    # Documents are keyed by username, so only representations can be stored
+    stores_objects = False
+
+    def __init__(self, collection: str = "skip", parallel_requests: int = PARALLEL_REQUESTS,
+                 mirror_collections: bool = False) -> None:
+        """
+            Parameters
+            ----------
+            collection: str
+                The name of the default collection.
+
+            parallel_requests: int
+                The number of batches committed, or of chunks read, in parallel.
+
+            mirror_collections: bool
+                If True every collection is mirrored the first time it is read, so
+                the following reads and version checks need no request.
+        """
         super(FirestoreDatabaseManager, self).__init__(collection)
-        self.__firebase_fs_setup()
+        self.parallel_requests = parallel_requests
+        self.mirror_collections = mirror_collections
+        self._db = None
+
+        # The mirrored collections: name -> (documents by username, version, listener)
+        self._mirrors = dict()
+        self._mirrors_lock = Lock()
 
-    def __firebase_fs_setup(self):
+    @property
+    def db(self) -> Client:
         """
-            This method is used to initialize Firestore.
+            The Firestore client, initialized the first time it is used. The firebase
+            app is initialized once and shared by every manager of the process. If the
+            FIRESTORE_EMULATOR_HOST variable is set, the client connects to the emulator.
         """
-        initialize_app()
-        self.db: Client = firestore.client()
+        if self._db is None:
+            self._db = get_firestore_client()
+
+        return self._db
+
+    @property
+    def supports_lookup(self) -> bool:
+        # A mirrored collection is already local, a single document is not worth a request
+        return not self.mirror_collections and len(self._mirrors) == 0
 
     def upload(self, collection_name: str, data: list[dict]):
         """
             Uploads some object data to the the Firestore database service of firebase, specifing the name
-            of the collection that will hold it.
+            of the collection that will hold it. The documents are written in batches of at most BATCH_SIZE
+            writes, the documents of the collection that are not in data are kept.
 
             Parameters
             ----------
-            collection_name: str  
+            collection_name: str
                 The name of the collection to upload
 
-            data: Union[list[object], list[dict],]             
-                The data object to upload. It must be: 1) a list of objects, where each of them 
+            data: Union[list[object], list[dict],]
+                The data object to upload. It must be: 1) a list of objects, where each of them
                 can be turned into a dict. 2) A list of dict. 3) A single dict.
 
             Raises
             ------
-            OSError 
+            OSError
                 If the file does not exists
 
             TypeError
                 If data does not have __dict__ attribute
-            
-            ValueError 
+
+            ValueError
                 If the file could not be uploaded for generic issues.
         """
         self.persistence_location = collection_name
@@ -56,18 +106,87 @@ class FirestoreDatabaseManager(ObjectPersistenceManager):
         if not all(isinstance(dt, dict) for dt in data):
             data = map(lambda d : vars(d), data)
 
-        # Add the data to the collection
-        for d in data:
-            self.db.collection(collection_name).document(d['username']).set(d)
+        self.update(collection_name, list(data), list())
+
+    def update(self, collection_name: str, upserts: list[dict], deletions: list[str]) -> int:
+        """
+            Writes and deletes the documents of some usernames, in batches of at most
+            BATCH_SIZE writes, and increments the version of the collection once.
+
+            Parameters
+            ----------
+            collection_name: str
+                The name of the collection to update.
+
+            upserts: list[dict]
+                The documents to write, keyed by their username.
+
+            deletions: list[str]
+                The usernames of the documents to delete.
+
+            Return
+            ------
+            version: int
+                The version of the collection after the update.
+        """
+        collection = self.db.collection(collection_name)
+
+        writes = [(collection.document(d['username']), d) for d in upserts]
+        writes.extend((collection.document(username), None) for username in deletions)
+
+        self._commit(writes, self._version_reference(collection_name))
+
+        return self._read_version(collection_name)
+
+    def _version_reference(self, collection_name: str):
+        return self.db.collection(VERSIONS_COLLECTION).document(collection_name)
+
+    def _read_version(self, collection_name: str) -> int:
+        snapshot = self._version_reference(collection_name).get()
+
+        return snapshot.to_dict().get(VERSION_FIELD, 0) if snapshot.exists else 0
+
+    def _commit(self, writes: list, version_reference):
+        """
+            Commits a list of (document reference, data) writes in batches, in parallel.
+            A None data deletes the document. The version document is incremented by the
+            last batch, after all the others are committed.
+        """
+        def commit_batch(chunk: list, increment_version: bool = False):
+            batch = self.db.batch()
+
+            for reference, d in chunk:
+                if d is None:
+                    batch.delete(reference)
+                else:
+                    batch.set(reference, d)
+
+            if increment_version:
+                batch.set(version_reference, {VERSION_FIELD: Increment(1)}, merge=True)
+
+            batch.commit()
+
+        # The last batch keeps a free write for the version
+        chunks = [writes[i:i + BATCH_SIZE - 1] for i in range(0, len(writes), BATCH_SIZE - 1)] or [list()]
+
+        if len(chunks) > 2:
+            with ThreadPoolExecutor(min(self.parallel_requests, len(chunks) - 1)) as executor:
+                # Consume the results, so the errors of the batches are raised
+                list(executor.map(commit_batch, chunks[:-1]))
+        elif len(chunks) == 2:
+            commit_batch(chunks[0])
+
+        commit_batch(chunks[-1], increment_version=True)
 
     def download(self, collection_name: str) -> list[dict]:
         """
             This method is used to download an entire collection from the firestore
-            specificing its name.
+            specificing its name. If the collection is mirrored the local copy is
+            returned, otherwise the documents of the collection are read in parallel chunks.
 
             Parameters
             ----------
-            collection_name: str  
+            collection_name: str
                 The name associated of the collection to download.
 
             Return
@@ -75,14 +194,152 @@ class FirestoreDatabaseManager(ObjectPersistenceManager):
             obj: object
                 A list of dictionary representing all documents under the collection.
         """
-        docs = self.db.collection(collection_name).stream()
-        obj = list()
-        
-        for doc in docs:
-            obj.append(doc.to_dict())
+        if self.mirror_collections:
+            self.mirror(collection_name)
+
+        with self._mirrors_lock:
+            mirror = self._mirrors.get(collection_name)
+
+            # A mirror is served only after its first snapshot, before it would look empty
+            if mirror is not None and mirror[3].is_set():
+                return list(mirror[0].values())
+
+        collection = self.db.collection(collection_name)
+
+        if self.parallel_requests <= 1:
+            return [doc.to_dict() for doc in collection.stream()]
+
+        # Only the references of the documents of this collection are listed, then their
+        # contents are read in chunks of about the same size
+        references = list(collection.list_documents(page_size=BATCH_SIZE))
+        size = max(1, -(-len(references) // self.parallel_requests))
+        chunks = [references[i:i + size] for i in range(0, len(references), size)]
+
+        with ThreadPoolExecutor(max(1, len(chunks))) as executor:
+            chunks = executor.map(lambda chunk: [doc.to_dict() for doc in self.db.get_all(chunk) if doc.exists], chunks)
+
+            return [d for chunk in chunks for d in chunk]
+
+    def download_document(self, collection_name: str, username: str) -> dict:
+        """
+            This method downloads the single document of a username, without
+            reading the rest of the collection.
+
+            Parameters
+            ----------
+            collection_name: str
+                The name of the collection that contains the document.
+
+            username: str
+                The username that identifies the document.
+
+            Return
+            ------
+            obj: dict
+                The document, or None if it does not exist.
+        """
+        snapshot = self.db.collection(collection_name).document(username).get()
+
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def version(self, collection_name: str) -> object:
+        """
+            Returns the version of a collection, which is incremented by every write
+            of this manager. A single document is read, whatever the size of the
+            collection. A mirrored collection is versioned by the number of changes
+            received, without any request.
+
+            Parameters
+            ----------
+            collection_name: str
+                The name of the collection whose version is requested.
+
+            Return
+            ------
+            version: object
+                The version of the collection, 0 if it has never been written.
+        """
+        if self.mirror_collections:
+            self.mirror(collection_name)
+
+        with self._mirrors_lock:
+            mirror = self._mirrors.get(collection_name)
+
+            if mirror is not None and mirror[3].is_set():
+                return 'mirror', mirror[1]
+
+        return self._read_version(collection_name)
+
+    def mirror(self, collection_name: str):
+        """
+            Starts mirroring a collection: a snapshot listener receives the changed
+            documents and updates a local copy, that is then used by download and
+            version. The method returns after the first snapshot is received, also
+            when the collection is already being mirrored by another caller.
+
+            Parameters
+            ----------
+            collection_name: str
+                The name of the collection to mirror.
+        """
+        with self._mirrors_lock:
+            mirror = self._mirrors.get(collection_name)
+
+            if mirror is None:
+                first_snapshot = Event()
+                self._mirrors[collection_name] = (dict(), 0, None, first_snapshot)
+
+        # The other callers wait for the first snapshot requested by the first one
+        if mirror is not None:
+            mirror[3].wait()
+            return
+
+        def on_snapshot(_, changes, __):
+            with self._mirrors_lock:
+                mirror = self._mirrors.get(collection_name)
+
+                # The collection could have been unmirrored in the meantime
+                if mirror is not None:
+                    documents, version, listener, _ = mirror
+
+                    for change in changes:
+                        if change.type.name == 'REMOVED':
+                            documents.pop(change.document.id, None)
+                        else:
+                            documents[change.document.id] = change.document.to_dict()
+
+                    self._mirrors[collection_name] = (documents, version + 1, listener, first_snapshot)
+
+            first_snapshot.set()
+
+        listener = self.db.collection(collection_name).on_snapshot(on_snapshot)
+        first_snapshot.wait()
+
+        with self._mirrors_lock:
+            mirror = self._mirrors.get(collection_name)
+
+            if mirror is not None:
+                documents, version, _, _ = mirror
+                self._mirrors[collection_name] = (documents, version, listener, first_snapshot)
+                return
+
+        # Unmirrored before the first snapshot, the listener is not needed anymore
+        listener.unsubscribe()
+
+    def unmirror(self, collection_name: str):
+        """
+            Stops mirroring a collection, and drops its local copy.
+
+            Parameters
+            ----------
+            collection_name: str
+                The name of the mirrored collection.
+        """
+        with self._mirrors_lock:
+            mirror = self._mirrors.pop(collection_name, None)
+
+        if mirror is not None and mirror[2] is not None:
+            mirror[2].unsubscribe()
 
-        return obj
-        
-    
     def remove(self):
         return super().remove()
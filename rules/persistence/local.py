@@ -1,9 +1,14 @@
 # Import dependencies for the file sysem specialization of the ObjectPersistenceManager
-from os import mkdir
+from os import (O_CREAT, O_EXCL, O_WRONLY, close, fstat, getpid, link, listdir, mkdir, open as open_exclusive, remove,
+                replace, stat, utime, write)
 from os.path import join
+from threading import get_ident
+from uuid import uuid4
 from .opm import ObjectPersistenceManager
 
+import numpy as np
 import pickle
+import time
 
 class LocalFileManager(ObjectPersistenceManager):
     """
@@ -38,15 +43,25 @@ class LocalFileManager(ObjectPersistenceManager):
             ValueError 
                 If the file could not be uploaded for generic issues.
         """
+        # Write a temporary file and rename it, so that the readers never see a partial file
+        with self._open_temporary(file_name) as f: f.write(pickle.dumps(data))
+        self._commit_temporary(file_name)
+
+    def _open_temporary(self, file_name: str):
         # Create the folder to store data if it not exsist
         try:
             mkdir(self.folder)
         except FileExistsError:
             pass
-        
-        # Write a temporary local file that will be uploaded to the blob storage
-        path: str = join(self.folder, file_name)
-        with open(path, 'wb') as f: f.write(pickle.dumps(data))
+
+        # The hidden name is never listed, and it is unique for every writer
+        return open(self._temporary_path(file_name), 'wb')
+
+    def _temporary_path(self, file_name: str) -> str:
+        return join(self.folder, f'.{file_name}.{getpid()}.{get_ident()}.tmp')
+
+    def _commit_temporary(self, file_name: str):
+        replace(self._temporary_path(file_name), join(self.folder, file_name))
 
 
     def download(self, file_name: str) -> object:
@@ -71,6 +86,234 @@ class LocalFileManager(ObjectPersistenceManager):
             obj = None
 
         return obj
+
+    def upload_array(self, file_name: str, array: np.ndarray):
+        """
+            Writes a matrix as a .npy file, keeping its dtype. The file is written under a temporary
+            name and then renamed, so the processes that have mapped the previous file 
+            keep reading consistent data.
+
+            Parameters
+            ----------
+            file_name: str    
+                The name of the local file that will contain the matrix.
+
+            array: numpy.ndarray        
+                The matrix to write.
+        """
+        with self._open_temporary(file_name) as f: np.save(f, np.ascontiguousarray(array))
+        self._commit_temporary(file_name)
+
+    def download_array(self, file_name: str) -> np.ndarray:
+        """
+            Maps a matrix written with upload_array in memory, without reading it. The
+            mapped pages are shared through the page cache by all the processes that
+            map the same file.
+
+            Parameters
+            ----------
+            file_name: str 
+                The name of the file that contains the matrix.
+
+            Return
+            ------
+            array: numpy.ndarray
+                The read-only memory-mapped matrix, or None if the file does not exist.
+        """
+        try:
+            return np.load(join(self.persistence_location, file_name), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+    def list(self, prefix: str) -> list:
+        """
+            Lists the local files whose name starts with the given prefix.
+
+            Parameters
+            ----------
+            prefix: str 
+                The prefix of the file names to list.
+
+            Return
+            ------
+            names: list
+                The sorted list of the matching file names.
+        """
+        try:
+            names = listdir(self.persistence_location)
+        except FileNotFoundError:
+            names = list()
+
+        return sorted(name for name in names if name.startswith(prefix))
+
+    def delete(self, file_name: str):
+        """
+            Deletes a local file, if it exists.
+
+            Parameters
+            ----------
+            file_name: str 
+                The name of the file to delete.
+        """
+        try:
+            remove(join(self.persistence_location, file_name))
+        except FileNotFoundError:
+            pass
+
+    def acquire_lease(self, file_name: str, duration: int) -> object:
+        """
+            Acquires a lease by creating a lock file, which fails if the file already exists.
+            A lock file not renewed for longer than the duration is considered abandoned, and
+            it is taken over only if it still holds the token of the abandoned lease.
+
+            Parameters
+            ----------
+            file_name: str 
+                The name of the lock file.
+
+            duration: int
+                The seconds after which the lease expires.
+
+            Return
+            ------
+            lease: str
+                The token written in the lock file, or None if another holder has the lease.
+        """
+        try:
+            mkdir(self.folder)
+        except FileExistsError:
+            pass
+
+        path = join(self.persistence_location, file_name)
+        lease = uuid4().hex
+
+        for _ in range(2):
+            try:
+                descriptor = open_exclusive(path, O_CREAT | O_EXCL | O_WRONLY)
+            except FileExistsError:
+                holder, age = self._read_lock(path)
+
+                # The lock has just been released, try again once
+                if holder is None:
+                    continue
+
+                # Take over the lock of a crashed holder, and try again once
+                if age > duration and self._remove_expired_lock(file_name, holder):
+                    continue
+
+                return None
+
+            try:
+                write(descriptor, lease.encode())
+            finally:
+                close(descriptor)
+
+            return lease
+
+        return None
+
+    @staticmethod
+    def _read_lock(path: str) -> tuple:
+        # The token and the age are read from the same open file, so they belong to the same lock
+        try:
+            with open(path) as f:
+                return f.read(), time.time() - fstat(f.fileno()).st_mtime
+        except FileNotFoundError:
+            return None, 0
+
+    def _remove_expired_lock(self, file_name: str, holder: str) -> bool:
+        # The lock is moved aside atomically, so only one writer removes it. If the moved lock
+        # is not the expired one, another writer has taken it over in between and it is restored
+        path = join(self.persistence_location, file_name)
+        aside = join(self.persistence_location, f'.{file_name}.{uuid4().hex}.expired')
+
+        try:
+            replace(path, aside)
+        except FileNotFoundError:
+            return True
+
+        try:
+            with open(aside) as f:
+                if f.read() == holder:
+                    return True
+
+            try:
+                link(aside, path)
+            except FileExistsError:
+                pass
+
+            return False
+        finally:
+            remove(aside)
+
+    def renew_lease(self, file_name: str, lease: object) -> bool:
+        """
+            Renews a lease by touching its lock file, if it still holds the given token.
+
+            Parameters
+            ----------
+            file_name: str 
+                The name of the lock file.
+
+            lease: str
+                The token returned by acquire_lease.
+
+            Return
+            ------
+            renewed: bool
+                False if the lease is expired and taken over by another holder.
+        """
+        path = join(self.persistence_location, file_name)
+
+        if self._read_lock(path)[0] != lease:
+            return False
+
+        utime(path)
+
+        return True
+
+    def release_lease(self, file_name: str, lease: object):
+        """
+            Releases a lease by removing its lock file, if it still holds the given token.
+
+            Parameters
+            ----------
+            file_name: str 
+                The name of the lock file.
+
+            lease: str
+                The token returned by acquire_lease.
+        """
+        try:
+            with open(join(self.persistence_location, file_name)) as f:
+                holder = f.read()
+        except FileNotFoundError:
+            return
+
+        if holder == lease:
+            self.delete(file_name)
+
+    def version(self, file_name: str) -> object:
+        """
+            Returns the version of a local file, given by its modification 
+            time and size.
+
+            Parameters
+            ----------
+            file_name: str 
+                The name of the file whose version is requested.
+
+            Return
+            ------
+            version: tuple
+                The (mtime_ns, size) pair of the file, or None if it does not exist.
+        """
+        try:
+            file_stat = stat(join(self.persistence_location, file_name))
+        except FileNotFoundError:
+            return None
+
+        return file_stat.st_mtime_ns, file_stat.st_size
     
     def remove(self):
         return super().remove()
\ No newline at end of file
@@ -6,6 +6,14 @@ class ObjectPersistenceManager(ABC):
         object's files to a generic persistence's service. 
     """
 
+    # True if the service can store any serializable object, False if it
+    # only stores lists of representations
+    stores_objects = True
+
+    # True if the service can download the representation of a single
+    # username, with download_document
+    supports_lookup = False
+
     def __init__(self, persistence_location: str) -> None:
         """
             Parameters
@@ -62,6 +70,216 @@ class ObjectPersistenceManager(ABC):
         """
         pass
     
+    def upload_array(self, entity_name: str, array):
+        """
+            Uploads a numeric matrix to the persistence storage. By default the
+            matrix is uploaded as any other object, services with a more efficient
+            format for matrices override this method.
+
+            Parameters
+            ----------
+            entity_name: str 
+                The name associated to the matrix to upload.
+
+            array: numpy.ndarray         
+                The matrix to upload.
+        """
+        self.upload(entity_name, array)
+
+    def download_array(self, entity_name: str):
+        """
+            Downloads a numeric matrix uploaded with upload_array.
+
+            Parameters
+            ----------
+            entity_name: str  
+                The name associated to the matrix to download.
+
+            Return
+            ------
+            array: numpy.ndarray
+                The downloaded matrix, or None if it does not exist.
+        """
+        return self.download(entity_name)
+
+    def download_document(self, entity_name: str, username: str) -> dict:
+        """
+            This method downloads the single representation of a username,
+            without downloading the whole entity.
+
+            Parameters
+            ----------
+            entity_name: str  
+                The name associated to the representations.
+
+            username: str  
+                The username of the representation to download.
+
+            Return
+            ------
+            obj: dict
+                The representation, or None if it does not exist.
+
+            Raises
+            ------
+            NotImplementedError 
+                If the service does not support the lookup of single representations.
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support lookups')
+
+    def update(self, entity_name: str, upserts: list, deletions: list) -> object:
+        """
+            This method writes or deletes single representations of an entity,
+            without writing the rest of it.
+
+            Parameters
+            ----------
+            entity_name: str  
+                The name associated to the representations.
+
+            upserts: list  
+                The representations to write, keyed by their username.
+
+            deletions: list  
+                The usernames of the representations to delete.
+
+            Return
+            ------
+            version: int
+                The version of the entity after the update. Every update increments it by one.
+
+            Raises
+            ------
+            NotImplementedError 
+                If the service does not support the update of single representations.
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support updates')
+
+    def list(self, prefix: str) -> list:
+        """
+            This method lists the entities stored in the persistence location
+            whose name starts with the given prefix.
+
+            Parameters
+            ----------
+            prefix: str  
+                The prefix of the names to list.
+
+            Return
+            ------
+            names: list
+                The sorted list of the matching entity names.
+
+            Raises
+            ------
+            NotImplementedError 
+                If the service does not support the listing of the entities.
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support listing')
+
+    def delete(self, entity_name: str):
+        """
+            This method deletes a single entity from the persistence location.
+            Deleting an entity that does not exist is not an error.
+
+            Parameters
+            ----------
+            entity_name: str  
+                The name associated to the data to delete.
+
+            Raises
+            ------
+            NotImplementedError 
+                If the service does not support the deletion of single entities.
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support deletion')
+
+    def acquire_lease(self, entity_name: str, duration: int) -> object:
+        """
+            This method acquires an exclusive lease on an entity, shared by all the
+            processes that use the same persistence location. A lease that is not
+            released expires after the given duration, so a crashed holder does
+            not keep it forever.
+
+            Parameters
+            ----------
+            entity_name: str  
+                The name of the entity used as lock.
+
+            duration: int  
+                The seconds after which the lease expires.
+
+            Return
+            ------
+            lease: object
+                The token of the lease, or None if another holder has it.
+
+            Raises
+            ------
+            NotImplementedError 
+                If the service does not support leases.
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support leases')
+
+    def renew_lease(self, entity_name: str, lease: object) -> bool:
+        """
+            This method extends a lease obtained with acquire_lease by its whole
+            duration, so that a holder working for longer than the duration keeps it.
+
+            Parameters
+            ----------
+            entity_name: str  
+                The name of the entity used as lock.
+
+            lease: object  
+                The token returned by acquire_lease.
+
+            Return
+            ------
+            renewed: bool
+                False if the lease is expired, and maybe acquired by another holder.
+
+            Raises
+            ------
+            NotImplementedError 
+                If the service does not support leases.
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support leases')
+
+    def release_lease(self, entity_name: str, lease: object):
+        """
+            This method releases a lease obtained with acquire_lease. A lease
+            that is expired, and maybe acquired by another holder, is not released.
+
+            Parameters
+            ----------
+            entity_name: str  
+                The name of the entity used as lock.
+
+            lease: object  
+                The token returned by acquire_lease.
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support leases')
+
+    def version(self, entity_name: str) -> object:
+        """
+            This method returns a token that changes every time the entity
+            stored in the persistence location changes. It is used by caches
+            to decide if an entity must be downloaded again.
+
+            Parameters
+            ----------
+            entity_name: str  
+                The name associated to the data whose version is requested.
+
+            Return
+            ------
+            version: object
+                A comparable token, or None if the version can not be determined.
+                In that case callers must assume that the entity is changed.
+        """
+        return None
+
     @abstractmethod
     def remove(self):
         """
@@ -0,0 +1,269 @@
+from ..index import QuantizedMatrix, quantize_embeddings, STORAGE_FLOAT32, SUPPORTED_STORAGES
+from .opm import ObjectPersistenceManager
+from contextlib import contextmanager
+from threading import Event, Thread
+from uuid import uuid4
+
+import logging
+import numpy as np
+import time
+
+logger = logging.getLogger(__name__)
+
+# The operations that can be recorded in a segment
+OP_ADD = 'add'
+OP_DELETE = 'delete'
+
+# The seconds after which the compaction lease of a crashed writer expires, and the seconds
+# between two renewals of the lease by a writer that is still compacting
+COMPACTION_LEASE_DURATION = 60
+COMPACTION_LEASE_RENEWAL = 20
+
+
+class SegmentedStore:
+    """
+        This class stores the representations as a base snapshot plus an append-only
+        log of segments. Every segment is a small object with a list of add/delete
+        records, so a single enrolment costs one small write and concurrent writers
+        never overwrite each other. The segments are periodically compacted into
+        a new base snapshot, by one writer at a time.
+    """
+
+    def __init__(self, persistence_manager: ObjectPersistenceManager, base_name: str,
+                 storage: str = STORAGE_FLOAT32, keep_exact: bool = False) -> None:
+        """
+            Parameters
+            ----------
+            persistence_manager: ObjectPersistenceManager
+                The manager used to store the snapshot and the segments. It must
+                support the listing and the deletion of the entities.
+
+            base_name: str
+                The name of the base snapshot. Segments are named after it.
+
+            storage: str
+                The type of the embeddings written by the compaction [float32, float16, int8].
+
+            keep_exact: bool
+                If True and the embeddings are compressed, the compaction also writes the
+                exact float32 embeddings, used to re-rank the candidates of the coarse scan.
+
+            Raises
+            ------
+            ValueError
+                If the storage type is not supported.
+        """
+        if storage not in SUPPORTED_STORAGES:
+            raise ValueError(f'Unsupported storage type: {storage}')
+
+        self.persistence_manager = persistence_manager
+        self.base_name = base_name
+        self.storage = storage
+        self.keep_exact = keep_exact
+        self.segment_prefix = f'{base_name}.seg.'
+        self.matrix_prefix = f'{base_name}.matrix.'
+        self.lock_name = f'{base_name}.lock'
+
+    def base_version(self) -> object:
+        """
+            Returns the version of the base snapshot, None if it does not exist.
+        """
+        return self.persistence_manager.version(self.base_name)
+
+    def load_base(self) -> tuple:
+        """
+            Downloads the base snapshot. The snapshot is made of a small sidecar with the
+            usernames and the info, and of a float32 matrix with one embedding per row, which
+            is memory-mapped by the managers that support it. Snapshots written as a plain
+            list of representations are still supported.
+
+            Return
+            ------
+            base: tuple
+                The (usernames, infos, embeddings, folded segments) tuple of the snapshot. The
+                embeddings are None if the snapshot is empty, and a QuantizedMatrix if they
+                are compressed.
+        """
+        base = self.persistence_manager.download(self.base_name)
+
+        if base is None:
+            return list(), list(), None, frozenset()
+
+        if isinstance(base, list) or 'representations' in base:
+            representations = base if isinstance(base, list) else base['representations']
+            folded = frozenset() if isinstance(base, list) else frozenset(base['folded'])
+
+            return ([rep['username'] for rep in representations], [rep['info'] for rep in representations],
+                    np.array([rep['embedding'] for rep in representations], dtype=np.float32) if representations else None,
+                    folded)
+
+        embeddings = None
+
+        if base['matrix'] is not None:
+            embeddings = self.persistence_manager.download_array(base['matrix'])
+
+        # The exact embeddings are downloaded only when they are needed
+        if embeddings is not None and base.get('storage', STORAGE_FLOAT32) != STORAGE_FLOAT32:
+            exact = None
+
+            if base.get('exact') is not None:
+                exact = lambda name=base['exact']: self.persistence_manager.download_array(name)
+
+            embeddings = QuantizedMatrix(embeddings, base.get('scales'), exact)
+
+        return base['usernames'], base['infos'], embeddings, frozenset(base['folded'])
+
+    def list_segments(self) -> list:
+        """
+            Lists the names of the stored segments, in the order they have been written.
+        """
+        return self.persistence_manager.list(self.segment_prefix)
+
+    def read_segment(self, segment_name: str) -> list:
+        """
+            Downloads the records of a segment. A segment deleted by a concurrent
+            compaction has no records, since they are already folded in the base.
+        """
+        records = self.persistence_manager.download(segment_name)
+
+        return records if records is not None else list()
+
+    def append(self, records: list) -> str:
+        """
+            Writes a new segment with the given records.
+
+            Parameters
+            ----------
+            records: list
+                The add/delete records to write, as built by add_record and delete_record.
+
+            Return
+            ------
+            segment_name: str
+                The name of the written segment.
+        """
+        # The timestamp keeps the segments sorted by writing time, while
+        # the random suffix avoids collisions between concurrent writers
+        segment_name = f'{self.segment_prefix}{time.time_ns():020d}.{uuid4().hex[:8]}'
+        self.persistence_manager.upload(segment_name, records)
+
+        return segment_name
+
+    @contextmanager
+    def compaction_lease(self):
+        """
+            Acquires the lease that lets a single writer compact the segments. Two writers
+            compacting together would each write a base from their own view, and delete the
+            segments appended by the other one. The gallery to compact must be read after
+            the lease is acquired. The lease is renewed while it is held, so a compaction
+            longer than the lease duration keeps it.
+
+            Return
+            ------
+            leased: bool
+                True if the lease is acquired, False if another writer is compacting.
+        """
+        lease = self.persistence_manager.acquire_lease(self.lock_name, COMPACTION_LEASE_DURATION)
+
+        if lease is None:
+            yield False
+            return
+
+        released = Event()
+        renewer = Thread(target=self._renew_lease, args=(lease, released), name='compaction-lease', daemon=True)
+        renewer.start()
+
+        try:
+            yield True
+        finally:
+            released.set()
+            renewer.join()
+            self.persistence_manager.release_lease(self.lock_name, lease)
+
+    def _renew_lease(self, lease: object, released: Event):
+        # Renew the lease until it is released, a lease taken over by another writer is lost
+        while not released.wait(COMPACTION_LEASE_RENEWAL):
+            if not self.persistence_manager.renew_lease(self.lock_name, lease):
+                logger.warning('The compaction lease of %s has been lost', self.base_name)
+                return
+
+    def compact(self, usernames: list, infos: list, embeddings: np.ndarray, segments: frozenset):
+        """
+            Writes a new base snapshot that includes the given segments, then deletes
+            them. The snapshot is written before deleting the segments, so readers
+            never miss a record, and only the segments included in the stored base are
+            deleted. Every snapshot writes its matrix under a new name, and the matrix
+            of the previous snapshot is kept for the readers still loading it. It must
+            be called while holding the compaction lease.
+
+            Parameters
+            ----------
+            usernames: list
+                The usernames obtained replaying the segments over the base snapshot.
+
+            infos: list
+                The info of every username.
+
+            embeddings: numpy.ndarray
+                The matrix with the embedding of every username, one per row.
+
+            segments: frozenset
+                The names of the stored segments replayed to obtain the gallery. Only
+                these are recorded in the base and deleted, so the base does not grow
+                with the segments deleted by the previous compactions.
+        """
+        matrix_name = None
+        exact_name = None
+        scales = None
+
+        if len(usernames) > 0:
+            # The matrices of a snapshot share its timestamp
+            snapshot = f'{self.matrix_prefix}{time.time_ns():020d}'
+            codes, scales = quantize_embeddings(embeddings, self.storage)
+
+            matrix_name = f'{snapshot}.npy'
+            self.persistence_manager.upload_array(matrix_name, codes)
+
+            if self.keep_exact and self.storage != STORAGE_FLOAT32:
+                exact_name = f'{snapshot}.exact.npy'
+                self.persistence_manager.upload_array(exact_name, np.asarray(embeddings, dtype=np.float32))
+
+        self.persistence_manager.upload(self.base_name, {'usernames': list(usernames),
+                                                         'infos': list(infos),
+                                                         'matrix': matrix_name,
+                                                         'storage': self.storage,
+                                                         'scales': scales,
+                                                         'exact': exact_name,
+                                                         'folded': sorted(segments)})
+
+        # Read the stored base back, and delete only the segments that it includes
+        stored = self.persistence_manager.download(self.base_name)
+        folded = frozenset(stored['folded']) if isinstance(stored, dict) and 'folded' in stored else frozenset()
+
+        for segment_name in segments & folded:
+            self.persistence_manager.delete(segment_name)
+
+        # Delete the matrices of the snapshots older than the previous one
+        matrices = [name for name in self.persistence_manager.list(self.matrix_prefix) if name.endswith('.npy')]
+        snapshots = sorted({name[len(self.matrix_prefix):].split('.')[0] for name in matrices})
+
+        for old_matrix in matrices:
+            if old_matrix[len(self.matrix_prefix):].split('.')[0] in snapshots[:-2]:
+                self.persistence_manager.delete(old_matrix)
+
+    @staticmethod
+    def add_record(representation: dict) -> dict:
+        """
+            Builds the record that adds a representation. The embedding is stored as a
+            float32 array, much smaller than a pickled list of floats.
+        """
+        representation = dict(representation, embedding=np.asarray(representation['embedding'], dtype=np.float32))
+
+        return {'op': OP_ADD, 'representation': representation}
+
+    @staticmethod
+    def delete_record(username: str) -> dict:
+        """
+            Builds the record that deletes the representation of a username.
+        """
+        return {'op': OP_DELETE, 'username': username}
@@ -1,15 +1,112 @@
-from rules.operations import FaceRecognizer, FaceRepresentationUploader, FaceRepresentationDeleter
+from rules.operations import (FaceRecognizer, FaceRepresentationUploader, FaceRepresentationBulkUploader,
+                              FaceRepresentationDeleter, gallery_cache)
+from .batching import MicroBatcher
+from .cache import LRUCache
+from .executor import InferenceExecutor, InferenceTimeoutError, QueueFullError
+from .metrics import metrics_registry, stage_histogram, COUNT_BUCKETS
 from .persistence.local import LocalFileManager
+from .tracking import IoUTracker
 from base64 import b64encode
-from cv2 import imread, imwrite, rectangle
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from cv2 import imdecode, imencode, imread, rectangle, resize, IMREAD_COLOR, INTER_AREA
+from dataclasses import dataclass, field, replace
+from hashlib import sha256
+from importlib.util import find_spec
+from os import cpu_count
 from os.path import isfile
-from deepface.DeepFace import represent, extract_faces
 
-import time
+import csv
+import logging
+import numpy as np
 
-# Defines the detector backend and face recognition model used in the api
+logger = logging.getLogger(__name__)
+
+# Defines the detector backend and face recognition model used in the api. The detector
+# backend can be overridden by every request with one of the supported backends: opencv
+# and ssd are the fastest on CPU, while mtcnn and retinaface are the most accurate. The dlib
+# and mediapipe backends are supported only when their optional packages are installed
 BACKEND = 'mtcnn'
 MODEL = 'Facenet512'
+OPTIONAL_BACKENDS = ('dlib', 'mediapipe')
+SUPPORTED_BACKENDS = ('opencv', 'ssd', 'mtcnn', 'retinaface') + tuple(
+    backend for backend in OPTIONAL_BACKENDS if find_spec(backend) is not None)
+
+# Defines the engine that runs the recognition model [keras, onnx] and the weight quantization
+# of the onnx engine [None, fp16, int8]. The onnx engine is exported from the keras model at its
+# first use; benchmarks/engines.py checks its parity with keras before it is deployed
+EMBEDDING_ENGINE = 'keras'
+ENGINE_QUANTIZATION = None
+
+# Defines the resolution of the detection. The faces are detected on a copy of the image whose
+# longest side is at most DETECTION_MAX_SIDE pixels (None detects at full resolution), and then
+# cropped from the full resolution image. The faces whose shortest side is smaller than
+# MIN_FACE_SIZE pixels of the original image are skipped
+DETECTION_MAX_SIDE = 1024
+MIN_FACE_SIZE = 20
+
+# The margin added around a face, as a fraction of its side, when it is cropped from the full
+# resolution image, so that the detector backend can align it
+FACE_CROP_MARGIN = 0.25
+
+# Defines the index used to search the gallery [flat, ivf] and its parameters. The
+# n_probe parameter of the ivf index trades recall for latency
+INDEX_TYPE = 'flat'
+INDEX_PARAMS = {'n_lists': 256, 'n_probe': 8}
+
+# Defines how the gallery snapshots store the embeddings [float32, float16, int8]. The compressed
+# embeddings are matched with a coarse scan, then the RERANK_CANDIDATES closest candidates of
+# every probe are re-ranked with their exact float32 embeddings. The exact embeddings are stored
+# next to the compressed ones only if RERANK_CANDIDATES is greater than 0
+EMBEDDING_STORAGE = 'float32'
+RERANK_CANDIDATES = 0
+
+# Defines the worker processes that run the inferences. With 0 workers the inferences run
+# in the process that serves the request. The queue depth is the number of inferences that
+# can wait for a free worker before the requests are refused, and the timeout is the number
+# of seconds an inference can last before the request fails. Every worker runs its inferences
+# on INFERENCE_THREADS_PER_WORKER threads, so that the workers do not oversubscribe the cores
+INFERENCE_WORKERS = cpu_count() or 1
+INFERENCE_THREADS_PER_WORKER = 1
+INFERENCE_QUEUE_DEPTH = 2 * INFERENCE_WORKERS
+INFERENCE_TIMEOUT = 30
+
+# Defines the micro-batching of the embeddings: the face crops of concurrent requests are
+# collected for up to EMBEDDING_BATCH_WAIT seconds, or until EMBEDDING_BATCH_SIZE crops
+# are collected, and then embedded with a single forward pass
+EMBEDDING_BATCH_SIZE = 32
+EMBEDDING_BATCH_WAIT = 0.005
+
+# Defines the cache of the detected faces and of their embeddings, keyed by the hash of the
+# uploaded bytes and by the models. It is bounded by the bytes of the cached faces, and every
+# entry expires after DETECTION_CACHE_TTL seconds
+DETECTION_CACHE_BYTES = 64 * 1024 * 1024
+DETECTION_CACHE_TTL = 3600
+
+# Defines the streaming identification: only one frame every STREAM_FRAME_STRIDE is processed. A
+# face continues a track if its area overlaps the last one by TRACK_IOU_THRESHOLD, and a track ends
+# after TRACK_MAX_MISSED processed frames without the face. The face of a track is embedded until
+# it collects TRACK_CONFIRM_VOTES matches, and then again only when its area overlaps the last
+# embedded one by less than TRACK_REEMBED_IOU
+STREAM_FRAME_STRIDE = 2
+TRACK_IOU_THRESHOLD = 0.3
+TRACK_MAX_MISSED = 5
+TRACK_CONFIRM_VOTES = 3
+TRACK_REEMBED_IOU = 0.5
+
+# Defines the identifications: every face is returned with its TOP_K closest identities of the
+# gallery, and a request can ask for up to MAX_TOP_K of them. A request can also override the
+# distance threshold of the model, which is then the distance of a zero score
+TOP_K = 1
+MAX_TOP_K = 100
+
+# Defines the requests with many images, the bulk enrolments and the batch identifications: the columns
+# of the enrolment csv, and the images processed at the same time. Every one of them waits for a worker,
+# so they are as many as the workers and the queue allow. The images of an archive can be at most
+# MAX_ARCHIVE_BYTES once uncompressed
+ENROLMENT_COLUMNS = ('username', 'info', 'file')
+BATCH_CONCURRENCY = max(INFERENCE_WORKERS, 1) + INFERENCE_QUEUE_DEPTH // 2
+MAX_ARCHIVE_BYTES = 512 * 1024 * 1024
 
 # Defines the common keys of reply messages
 KEY_MESSAGE = 'message'
@@ -17,6 +114,15 @@ KEY_STATUS = 'status'
 KEY_FOUNDED_IDS = 'founded_ids'
 KEY_COORDINATES = 'coordinates'
 KEY_IMG_B64 = 'img_b64'
+KEY_RESULTS = 'results'
+KEY_NAME = 'name'
+KEY_FACES = 'faces'
+KEY_IDENTITY = 'identity'
+KEY_FRAME = 'frame'
+KEY_TRACK = 'track_id'
+KEY_TRACKS = 'tracks'
+KEY_ENROLLED = 'enrolled'
+KEY_CANDIDATES = 'candidates'
 
 # Defines common values of status key
 STATUS_FAIL = 'fail'
@@ -27,45 +133,322 @@ NO_MULTIPART_MESSAGE = 'You must send a multipart request, or the request you ha
 EMPTY_MESSAGE = 'Empty input set passed'
 ALL_VALUES_NOT_PASSED_MESSAGE = 'You must pass all values in order to perform this action'
 EXTENSION_NOT_SUPPORTED_MESSAGE = 'The file you have sent is not an image. Check the supported extensions'
+NOT_DECODABLE_MESSAGE = 'The image you have sent could not be decoded'
+NOT_READABLE_MESSAGE = 'The image could not be read'
+BUSY_MESSAGE = 'The server is busy, retry later'
+INFERENCE_TIMEOUT_MESSAGE = 'The inference did not complete in time'
+ARCHIVE_TOO_LARGE_MESSAGE = f'The archive you have sent is larger than {MAX_ARCHIVE_BYTES // (1024 * 1024)} MB once uncompressed'
+BACKEND_NOT_SUPPORTED_MESSAGE = f'The detector backend is not supported. Use one of {", ".join(SUPPORTED_BACKENDS)}'
+TOP_K_NOT_SUPPORTED_MESSAGE = f'The number of candidates must be an integer between 1 and {MAX_TOP_K}'
+THRESHOLD_NOT_SUPPORTED_MESSAGE = 'The threshold must be a positive number'
 
 # Defines input param names
 FIELD_IMG = 'img'
 FIELD_IDENTITY = 'identity'
 FIELD_INFO = 'info'
-
-# Path to temporary file
-TEMP_IMG = 'img.jpg'
+FIELD_ARCHIVE = 'archive'
+FIELD_BACKEND = 'backend'
+FIELD_STRIDE = 'stride'
+FIELD_CSV = 'csv'
+FIELD_K = 'k'
+FIELD_THRESHOLD = 'threshold'
 
 # Supported extensions
 SUPPORTED_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.jfif')
 
+# Extensions used to encode the annotated images, for the ones not known by OpenCV
+ENCODING_EXTENSIONS = {'.jfif': '.jpg'}
+DEFAULT_ENCODING_EXTENSION = '.jpg'
+
 # Request type
 MULTIPART_FORM_DATA = 'multipart/form-data'
 
+# The streams of frames can also be sent as a raw body, where every frame is preceded by its size
+# in FRAME_HEADER_BYTES big-endian bytes. The results are streamed back as newline delimited json
+OCTET_STREAM = 'application/octet-stream'
+FRAME_HEADER_BYTES = 4
+NDJSON = 'application/x-ndjson'
+
 # A constant that defines the container of the blobs
 __CONTAINER_NAME = 'dfdb'
 
 # The manager to execute all the operations regarding a FaceRepresentation
 _manager = LocalFileManager(__CONTAINER_NAME)
 
+# Build the configured index over the cached galleries
+gallery_cache.configure_index(INDEX_TYPE, rerank=RERANK_CANDIDATES, **INDEX_PARAMS)
+gallery_cache.configure_storage(EMBEDDING_STORAGE, keep_exact=RERANK_CANDIDATES > 0)
 
-def upload_representation(file_name: str, username: str, info: str) -> dict:
+# The executor that runs the inferences on the worker processes, each one with the models preloaded
+inference_executor = InferenceExecutor(BACKEND, MODEL, workers=INFERENCE_WORKERS,
+                                       queue_depth=INFERENCE_QUEUE_DEPTH, timeout=INFERENCE_TIMEOUT,
+                                       engine=EMBEDDING_ENGINE, quantization=ENGINE_QUANTIZATION,
+                                       threads_per_worker=INFERENCE_THREADS_PER_WORKER)
+
+# The batcher that merges the embeddings of concurrent requests, one batch in flight for every worker
+embedding_batcher = MicroBatcher(inference_executor.embed, max_batch_size=EMBEDDING_BATCH_SIZE,
+                                 max_wait=EMBEDDING_BATCH_WAIT, dispatchers=max(INFERENCE_WORKERS, 1))
+
+# The approximate memory of a cached face, besides its crop, and of every number of a cached embedding
+CACHED_FACE_BYTES = 512
+CACHED_FLOAT_BYTES = 32
+
+# The cache that lets repeated uploads of the same image skip the inferences
+detection_cache = LRUCache(DETECTION_CACHE_BYTES, DETECTION_CACHE_TTL)
+
+# The metrics of the pipeline stages, exposed by the /metrics endpoint
+decode_seconds = stage_histogram('decode')
+detect_seconds = stage_histogram('detect')
+embed_seconds = stage_histogram('embed')
+encode_seconds = stage_histogram('encode')
+faces_per_image = metrics_registry.histogram('deepface_faces_per_image', 'The number of faces found in every image',
+                                             COUNT_BUCKETS)
+
+metrics_registry.register('deepface_embedding_batch_size', 'The number of faces of every embedding batch',
+                          embedding_batcher.batch_sizes)
+metrics_registry.register('deepface_embedding_batch_wait_seconds', 'The seconds every request waited for its batch',
+                          embedding_batcher.wait_times)
+metrics_registry.gauge('deepface_detection_cache_hit_rate', 'The hit rate of the detection cache',
+                       lambda: detection_cache.stats()['hit_rate'])
+metrics_registry.gauge('deepface_detection_cache_bytes', 'The approximate bytes held by the detection cache',
+                       lambda: detection_cache.size)
+
+
+@dataclass
+class DecodedImage:
+    """
+        The output of the decoding stage: an uploaded image decoded in memory.
+            - pixels:   the decoded BGR image
+            - digest:   the hash of the encoded bytes, which identifies the image in the detection cache
+    """
+    pixels: np.ndarray
+    digest: str
+
+
+def decode_image(data: bytes) -> DecodedImage:
+    """
+        This method decodes the bytes of an uploaded image in memory
+            - data:     the encoded bytes of the image
+            - return:   the decoded image, or None if the bytes are not a valid image
+    """
+    if not data:
+        return None
+
+    with decode_seconds.time():
+        pixels = imdecode(np.frombuffer(data, dtype=np.uint8), IMREAD_COLOR)
+
+    if pixels is None:
+        return None
+
+    return DecodedImage(pixels, sha256(data).hexdigest())
+
+
+@dataclass
+class DetectedFace:
+    """
+        A face found in an image by the detection stage. The embedding and the identity
+        are filled by the later stages.
+            - crop:         the aligned face, resized to the input shape of the model and shaped (1, h, w, 3)
+            - area:         the coordinates (x1, y1) and (x2, y2) of the face in the image
+            - confidence:   the confidence of the detector backend
+            - embedding:    the embedding of the face, None until the embedding stage runs
+            - identity:     the closest username of the gallery, None if not matched or not found
+            - candidates:   the closest usernames of the gallery with their distances and scores,
+                            None until the matching stage runs
+    """
+    crop: np.ndarray
+    area: dict
+    confidence: float
+    embedding: list = None
+    identity: str = None
+    candidates: list = None
+
+
+@dataclass
+class FaceDetections:
+    """
+        The output of the detection stage: the image and the faces found in it. The same
+        object flows through the embedding and the matching stages, so a single detection
+        pass can serve many results.
+            - image:    the decoded image, or the name of the file where the image is stored
+            - faces:    the faces found in the image
+            - key:      the key of the faces in the detection cache, None if they are not cached
+    """
+    image: object
+    faces: list = field(default_factory=list)
+    key: tuple = None
+
+    def __len__(self) -> int:
+        return len(self.faces)
+
+    @property
+    def areas(self) -> list:
+        return [face.area for face in self.faces]
+
+    @property
+    def embeddings(self) -> list:
+        return [face.embedding for face in self.faces]
+
+    @property
+    def identities(self) -> list:
+        return [face.identity for face in self.faces]
+
+
+def detect_faces(img, enforce_detection=True, backend=BACKEND) -> FaceDetections:
+    """
+        This method is the detection stage of the pipeline: it detects the faces of an image
+        and aligns and crops them for the recognition model
+            - img:                  the decoded image, the name of the file where the image is stored, or
+                                    the detections of a previous pass, which are returned as they are
+            - enforce_detection:    if True a ValueError is raised when no face is found
+            - backend:              the detector backend used to find the faces
+            - return:               the detections of the image
+    """
+    if isinstance(img, FaceDetections):
+        return img
+
+    if not isinstance(img, DecodedImage):
+        wrapper = DeepFaceWrapper(img, backend, MODEL, inference_executor, embedding_batcher,
+                                  max_side=DETECTION_MAX_SIDE, min_face_size=MIN_FACE_SIZE)
+
+        # The uncached images are counted too, also when no face is found
+        try:
+            with detect_seconds.time():
+                detections = wrapper.detect(enforce_detection)
+        except ValueError:
+            faces_per_image.observe(0)
+            raise
+
+        faces_per_image.observe(len(detections))
+
+        return detections
+
+    # The models are part of the key, so a new configuration never reuses stale faces
+    key = (img.digest, backend, MODEL, EMBEDDING_ENGINE, ENGINE_QUANTIZATION, enforce_detection)
+
+    with detect_seconds.time():
+        faces = detection_cache.get(key)
+
+        if faces is None:
+            try:
+                faces = DeepFaceWrapper(img.pixels, backend, MODEL, inference_executor, embedding_batcher,
+                                        max_side=DETECTION_MAX_SIDE,
+                                        min_face_size=MIN_FACE_SIZE).detect(enforce_detection).faces
+            except ValueError:
+                # Remember that the image has no face, so that its next uploads skip the detection
+                faces = list()
+
+            _cache_faces(key, faces)
+
+    faces_per_image.observe(len(faces))
+
+    if len(faces) == 0 and enforce_detection:
+        raise ValueError('Face could not be detected')
+
+    # The later stages fill the faces, so every request works on its own copies
+    return FaceDetections(img.pixels, [replace(face, identity=None, candidates=None) for face in faces], key)
+
+
+def embed_faces(detections: FaceDetections) -> FaceDetections:
+    """
+        This method is the embedding stage of the pipeline: it embeds the detected faces that
+        have no embedding yet, with a single batched forward pass
+            - detections:   the output of the detection stage
+            - return:       the same detections, with the embedding of every face
+    """
+    faces = [face for face in detections.faces if face.embedding is None]
+
+    if len(faces) > 0:
+        with embed_seconds.time():
+            embeddings = embedding_batcher.embed([face.crop for face in faces])
+
+        for face, embedding in zip(faces, embeddings):
+            face.embedding = embedding
+
+    if len(faces) > 0 and detections.key is not None:
+        _cache_faces(detections.key, detections.faces)
+
+    return detections
+
+
+def _cache_faces(key: tuple, faces: list):
+    # The crops are kept only until the faces are embedded, since they are much larger than
+    # the embeddings. The identities are not cached, the gallery could change at any time
+    cached = [replace(face, identity=None, candidates=None, crop=face.crop if face.embedding is None else None) for face in faces]
+    size = 0
+
+    for face in cached:
+        size += face.crop.nbytes if face.crop is not None else 0
+        size += len(face.embedding) * CACHED_FLOAT_BYTES if face.embedding is not None else 0
+
+    detection_cache.put(key, cached, size + len(cached) * CACHED_FACE_BYTES)
+
+
+def match_faces(detections: FaceDetections, k: int = TOP_K, threshold: float = None) -> FaceDetections:
+    """
+        This method is the matching stage of the pipeline: it finds the k closest usernames of the
+        gallery for every face. The matches are always computed against the current gallery
+            - detections:   the output of the detection or of the embedding stage
+            - k:            the maximum number of candidates of every face
+            - threshold:    the maximum distance of a candidate, None for the one of the model
+            - return:       the same detections, with the identity and the candidates of every face
+            - raise:        OSError if the gallery cannot be read
+    """
+    embed_faces(detections)
+
+    if len(detections) > 0:
+        recognizer = FaceRecognizer(_manager, [{'embedding': embedding} for embedding in detections.embeddings])
+
+        for face, candidates in zip(detections.faces, recognizer.rank_representations(k, threshold)):
+            face.candidates = candidates
+            face.identity = f'{candidates[0]["username"]} - {candidates[0]["info"]}' if len(candidates) > 0 else None
+
+    return detections
+
+
+def draw_faces(detections: FaceDetections, extension=DEFAULT_ENCODING_EXTENSION) -> str:
+    """
+        This method draws the facial areas on a copy of the detected image
+            - detections:   the output of the detection stage
+            - extension:    the extension that defines the format of the returned image
+            - return:       the b64 encoded image with the facial areas drawn on it
+    """
+    # Draw on a copy, so that the input image is not modified
+    img = detections.image
+    img = imread(filename=img) if isinstance(img, str) else img.copy()
+
+    for area in detections.areas:
+        pt1 = (area['x1'], area['y1'])
+        pt2 = (area['x2'], area['y2'])
+        img = rectangle(img, pt1, pt2, (255, 255, 0), 1)
+
+    # Encode the modified img in memory and turn it into b64 
+    extension = extension.lower() or DEFAULT_ENCODING_EXTENSION
+
+    with encode_seconds.time():
+        _, encoded_img = imencode(ENCODING_EXTENSIONS.get(extension, extension), img)
+
+        return b64encode(encoded_img.tobytes()).decode('utf-8')
+
+
+def upload_representation(img, username: str, info: str, backend=BACKEND) -> dict:
     """
         This method is used to upload a FaceRepresentation to Azure blob services.
-            - file_name:    the name of the file where the image is stored
+            - img:          the decoded image, the name of the file where the image is stored, or its detections
             - username:     the username associated to the face image
             - info:         addirional info on the FaceRepresentation
+            - backend:      the detector backend used to find the face
     """
     # Manage the exceptions that could occur
     try:
-        wrapper = DeepFaceWrapper(file_name, BACKEND, MODEL)
-        embeddings = wrapper.generate_embeddings()
+        detections = detect_faces(img, backend=backend)
 
-        if len(embeddings) > 1:
+        if len(detections) > 1:
             message = {KEY_MESSAGE: 'Could not create a representation: multiple faces detected', 
                        KEY_STATUS: STATUS_FAIL}
         else:
-            face_representation = {'username': username, 'info': info, 'embedding': embeddings[0]}
+            embedding = embed_faces(detections).embeddings[0]
+            face_representation = {'username': username, 'info': info, 'embedding': embedding}
             uploader = FaceRepresentationUploader(_manager, face_representation)
 
             # Upload the representation to the storage and check the result to
@@ -84,6 +467,140 @@ def upload_representation(file_name: str, username: str, info: str) -> dict:
     return message
 
 
+def read_enrolments(text: str) -> list:
+    """
+        This method reads the csv of a bulk enrolment
+            - text:     the csv, with a header that contains the username, info and file columns
+            - return:   a list of (username, info, file) tuples
+            - raise:    ValueError if a column is missing
+    """
+    reader = csv.DictReader(text.splitlines())
+
+    if reader.fieldnames is None or not all(column in reader.fieldnames for column in ENROLMENT_COLUMNS):
+        raise ValueError(f'The csv must have the {", ".join(ENROLMENT_COLUMNS)} columns')
+
+    return [tuple((row[column] or '').strip() for column in ENROLMENT_COLUMNS) for row in reader]
+
+
+def embed_enrolments(enrolments, backend=BACKEND):
+    """
+        This method embeds the faces of many enrolments in parallel: the images are decoded,
+        detected and embedded by BATCH_CONCURRENCY threads, so that every inference worker
+        is busy and the embeddings are batched together. Only a bounded number of images is
+        read at any time, so the enrolments can be many more than the memory would hold.
+            - enrolments:   an iterable of (username, info, read) tuples, where read is a function
+                            without arguments that returns the encoded image
+            - backend:      the detector backend used to find the faces
+            - return:       a generator of (username, info, embedding, message) tuples, in the order of
+                            the enrolments. The embedding is None if the enrolment failed, also when
+                            the image is missing or the inference workers are busy or too slow, so
+                            that a single enrolment does not fail the others
+    """
+    def embed(enrolment: tuple) -> tuple:
+        username, info, read = enrolment
+
+        # A missing file raises FileNotFoundError from a directory and KeyError from a zip archive
+        try:
+            img = decode_image(read())
+        except (OSError, KeyError):
+            return username, info, None, NOT_READABLE_MESSAGE
+
+        if img is None:
+            return username, info, None, NOT_DECODABLE_MESSAGE
+
+        try:
+            detections = detect_faces(img, backend=backend)
+
+            if len(detections) > 1:
+                return username, info, None, 'Could not create a representation: multiple faces detected'
+
+            return username, info, embed_faces(detections).embeddings[0], 'Representation generated'
+        except ValueError:
+            return username, info, None, 'Could not create a representation: no faces detected'
+        except QueueFullError:
+            return username, info, None, BUSY_MESSAGE
+        except InferenceTimeoutError:
+            return username, info, None, INFERENCE_TIMEOUT_MESSAGE
+
+    return _map_bounded(embed, enrolments, 'enrolment')
+
+
+def _map_bounded(function, items, name: str):
+    # Run the function on BATCH_CONCURRENCY threads, yielding the results in the order of the items.
+    # At most twice as many items are pending, so the items are read only when they are needed
+    pending = deque()
+
+    with ThreadPoolExecutor(BATCH_CONCURRENCY, thread_name_prefix=name) as executor:
+        for item in items:
+            pending.append(executor.submit(function, item))
+
+            if len(pending) >= 2 * BATCH_CONCURRENCY:
+                yield pending.popleft().result()
+
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+def upload_representations_bulk(enrolments, backend=BACKEND) -> dict:
+    """
+        This method enrols many FaceRepresentations with a single write to the storage. The
+        usernames repeated in the input, or already enrolled, are skipped, so a failed bulk
+        enrolment can be sent again to enrol only the missing usernames.
+            - enrolments:   an iterable of (username, info, read) tuples, where read is a function
+                            without arguments that returns the encoded image, or None if it is missing
+            - backend:      the detector backend used to find the faces
+            - return:       a dictionary with a result entry for every enrolment, in the same order
+    """
+    results = list()
+    seen = set()
+    valid = list()
+
+    try:
+        gallery = gallery_cache.get(_manager)
+    except OSError:
+        return {KEY_MESSAGE: 'Could not enrol the representations: internal errors',
+                KEY_STATUS: STATUS_FAIL}
+
+    # Skip the usernames already seen in the input, or already enrolled, before spending an inference on them
+    for username, info, read in enrolments:
+        if not username or not info or read is None:
+            results.append({KEY_NAME: username, KEY_MESSAGE: ALL_VALUES_NOT_PASSED_MESSAGE, KEY_STATUS: STATUS_FAIL})
+        elif username in seen or username in gallery:
+            results.append({KEY_NAME: username, KEY_MESSAGE: 'Representation not generated: duplicated username',
+                            KEY_STATUS: STATUS_FAIL})
+        else:
+            seen.add(username)
+            valid.append((username, info, read))
+            results.append(None)
+
+    representations = list()
+    positions = [i for i, result in enumerate(results) if result is None]
+
+    for i, (username, info, embedding, message) in zip(positions, embed_enrolments(valid, backend)):
+        results[i] = {KEY_NAME: username, KEY_MESSAGE: message,
+                      KEY_STATUS: STATUS_FAIL if embedding is None else STATUS_SUCCESS}
+
+        if embedding is not None:
+            representations.append({'username': username, 'info': info, 'embedding': embedding})
+
+    try:
+        duplicated = set(FaceRepresentationBulkUploader(_manager, representations).upload_representations())
+    except OSError:
+        return {KEY_MESSAGE: 'Could not enrol the representations: internal errors',
+                KEY_STATUS: STATUS_FAIL}
+
+    for result in results:
+        if result[KEY_STATUS] == STATUS_SUCCESS and result[KEY_NAME] in duplicated:
+            result.update({KEY_MESSAGE: 'Representation not generated: duplicated username', KEY_STATUS: STATUS_FAIL})
+
+    enrolled = sum(result[KEY_STATUS] == STATUS_SUCCESS for result in results)
+
+    return {KEY_MESSAGE: f'{enrolled} of {len(results)} representations enrolled',
+            KEY_STATUS: STATUS_SUCCESS,
+            KEY_ENROLLED: enrolled,
+            KEY_RESULTS: results}
+
+
 def remove_representation(id: str) -> dict:
     """
         This method is used to delete the specified representation
@@ -108,26 +625,27 @@ def remove_representation(id: str) -> dict:
     return message
 
 
-def find_representations(file_name: str) -> dict:
+def _ranked_faces(detections: FaceDetections) -> list:
+    # The coordinates of every face with its candidates, sorted by distance
+    return [{KEY_COORDINATES: face.area, KEY_CANDIDATES: face.candidates} for face in detections.faces]
+
+
+def find_representations(img, backend=BACKEND, k=TOP_K, threshold=None) -> dict:
     """
         This method is used to find all the FaceRepresentation in a given image
-            - file_name:    the name of the file where the image is stored
-            - return:       a dictionary with the found identities
+            - img:          the decoded image, the name of the file where the image is stored, or its detections
+            - backend:      the detector backend used to find the faces
+            - k:            the maximum number of candidates of every face
+            - threshold:    the maximum distance of a candidate, None for the one of the model
+            - return:       a dictionary with the found identities, and the coordinates and
+                            the candidates of every face
     """
     try:
-        unknown_face_representations = list()
+        detections = match_faces(detect_faces(img, backend=backend), k, threshold)
 
-        wrapper = DeepFaceWrapper(file_name, BACKEND, MODEL)
-        embeddings = wrapper.generate_embeddings()
+        logger.debug('Generated %d embeddings', len(detections))
 
-        print(f'Generated: {len(embeddings)} embeddings')
-
-        # Populate the unknown FaceRepresentation list with the embedding generated
-        for embedding in embeddings:
-            unknown_face_representations.append({'embedding': embedding})
-        
-        recognizer = FaceRecognizer(_manager, unknown_face_representations)
-        ids = recognizer.find_closest_representations()
+        ids = [identity for identity in detections.identities if identity is not None]
 
         # If the closest representation is correctly found determines the correct
         # repsonse message to send to the client
@@ -137,7 +655,8 @@ def find_representations(file_name: str) -> dict:
         else:
             message = {KEY_MESSAGE: 'Representation found',
                        KEY_STATUS: STATUS_SUCCESS, 
-                       KEY_FOUNDED_IDS: ids}
+                       KEY_FOUNDED_IDS: ids,
+                       KEY_FACES: _ranked_faces(detections)}
 
     except ValueError:
         message = {KEY_MESSAGE: 'Could not create a representation: no faces detected',
@@ -149,26 +668,115 @@ def find_representations(file_name: str) -> dict:
     return message
 
 
-def verify_representation(file_name: str, username: str) -> dict:
+def find_representations_batch(images, backend=BACKEND, k=TOP_K, threshold=None) -> dict:
+    """
+        This method is used to find the FaceRepresentation in many images at once. The images are
+        decoded, detected and embedded by BATCH_CONCURRENCY threads, and only their embeddings are
+        kept, so a bounded number of images is held in memory. The faces of all the images are then
+        matched against the gallery with a single matrix operation. The failure of an image does
+        not fail the whole batch.
+            - images:       an iterable of (name, read) pairs, where read is a function without arguments
+                            that returns the encoded image, or None if the file is not a supported image
+            - backend:      the detector backend used to find the faces
+            - k:            the maximum number of candidates of every face
+            - threshold:    the maximum distance of a candidate, None for the one of the model
+            - return:       a dictionary with a result entry for every input image, in the same order
+    """
+    def detect(image: tuple) -> tuple:
+        name, read = image
+
+        try:
+            img = decode_image(read()) if read is not None else None
+        except OSError:
+            return name, None, NOT_READABLE_MESSAGE
+
+        if img is None:
+            return name, None, NOT_DECODABLE_MESSAGE
+
+        # The errors of an image are reported in its own result, like the ones of a frame of a stream
+        try:
+            detections = embed_faces(detect_faces(img, backend=backend))
+        except ValueError:
+            return name, None, 'Could not create a representation: no faces detected'
+        except QueueFullError:
+            return name, None, BUSY_MESSAGE
+        except InferenceTimeoutError:
+            return name, None, INFERENCE_TIMEOUT_MESSAGE
+        except OSError:
+            return name, None, 'Could not create a representation: internal errors'
+
+        # Only the embeddings are needed by the matching, the image and the crops are released
+        detections.image = None
+
+        for face in detections.faces:
+            face.crop = None
+
+        return name, detections, None
+
+    names: list = list()
+    results: list = list()
+    detected: dict = dict()
+
+    for i, (name, detections, error) in enumerate(_map_bounded(detect, images, 'identification')):
+        names.append(name)
+
+        if detections is None:
+            results.append({KEY_NAME: name,
+                            KEY_MESSAGE: error,
+                            KEY_STATUS: STATUS_FAIL})
+        else:
+            results.append(None)
+            detected[i] = detections
+
+    # The faces of all the images flow together through the matching stage,
+    # which fills the face objects shared with the detections of every image
+    faces = FaceDetections(None, [face for detections in detected.values() for face in detections.faces])
+
+    try:
+        match_faces(faces, k, threshold)
+        logger.debug('Matched %d faces from %d images', len(faces), len(names))
+    except OSError:
+        faces = None
+
+    for i, detections in detected.items():
+        ids = [identity for identity in detections.identities if identity is not None]
+
+        if faces is None:
+            results[i] = {KEY_NAME: names[i],
+                          KEY_MESSAGE: 'Could not create a representation: internal errors',
+                          KEY_STATUS: STATUS_FAIL}
+        elif len(ids) == 0:
+            results[i] = {KEY_NAME: names[i],
+                          KEY_MESSAGE: 'Cannot find any close representation',
+                          KEY_STATUS: STATUS_FAIL}
+        else:
+            results[i] = {KEY_NAME: names[i],
+                          KEY_MESSAGE: 'Representation found',
+                          KEY_STATUS: STATUS_SUCCESS,
+                          KEY_FOUNDED_IDS: ids,
+                          KEY_FACES: _ranked_faces(detections)}
+
+    return {KEY_MESSAGE: f'{len(names)} images processed',
+            KEY_STATUS: STATUS_SUCCESS,
+            KEY_RESULTS: results}
+
+
+def verify_representation(img, username: str, backend=BACKEND) -> dict:
     """
         This method performs a face verification task. It verifies the
         presence of a certain person (identified by its username) in the
         input image.
-            - file_name:    the name of the file where the image is stored
+            - img:          the decoded image, the name of the file where the image is stored, or its detections
             - username:     the username to check in the image
+            - backend:      the detector backend used to find the faces
             - returns:      a dictionary with a result message
     """
-    wrapper = DeepFaceWrapper(file_name, BACKEND, MODEL)
-    embeddings = wrapper.generate_embeddings()
-    rep_list: list = list()
+    embeddings = embed_faces(detect_faces(img, backend=backend)).embeddings
 
-    print(f'{len(embeddings)} embeddings found in this image')
-    
-    for embedding in embeddings:
-        rep_list.append({embedding: embedding})
+    logger.debug('%d embeddings found in this image', len(embeddings))
     
-    recognizer = FaceRecognizer(_manager, rep_list
-                                )
+    recognizer = FaceRecognizer(_manager, [{'embedding': embedding} for embedding in embeddings])
+
     try:
         val = recognizer.verify_identity(username)
         message = {KEY_MESSAGE: str(val), 
@@ -181,94 +789,278 @@ def verify_representation(file_name: str, username: str) -> dict:
     return message
 
 
-def extract_faces(file_name: str, return_image=False):
+def analyze_image(img, extension=DEFAULT_ENCODING_EXTENSION, backend=BACKEND, k=TOP_K, threshold=None) -> dict:
+    """
+        This method runs the whole pipeline with a single detection pass: it returns the
+        coordinates, the identity and the candidates of every face, and the image with the
+        faces drawn on it
+            - img:          the decoded image, the name of the file where the image is stored, or its detections
+            - extension:    the extension that defines the format of the returned image
+            - backend:      the detector backend used to find the faces
+            - k:            the maximum number of candidates of every face
+            - threshold:    the maximum distance of a candidate, None for the one of the model
+            - return:       a dictionary with the faces found and the annotated image
+    """
+    try:
+        detections = match_faces(detect_faces(img, backend=backend), k, threshold)
+
+        message = {KEY_MESSAGE: f'{len(detections)} faces analyzed',
+                   KEY_STATUS: STATUS_SUCCESS,
+                   KEY_FACES: [{KEY_COORDINATES: face.area, KEY_IDENTITY: face.identity, KEY_CANDIDATES: face.candidates}
+                               for face in detections.faces],
+                   KEY_IMG_B64: draw_faces(detections, extension)}
+
+    except ValueError:
+        message = {KEY_MESSAGE: 'Could not detect any face in the given image',
+                   KEY_STATUS: STATUS_FAIL}
+    except OSError:
+        message = {KEY_MESSAGE: 'Could not analyze the image: internal errors',
+                   KEY_STATUS: STATUS_FAIL}
+
+    return message
+
+
+def identify_stream(frames, backend=BACKEND, stride=STREAM_FRAME_STRIDE):
+    """
+        This method identifies the faces of a stream of frames, like the ones of a camera. Only one
+        frame every stride is processed, the faces are followed across the frames by an IoU tracker,
+        and only the faces of new tracks, or of tracks that moved, are embedded and matched. The
+        identity of a track is the one matched most times over its frames. The frames are never
+        seen again, so they are not added to the detection cache. The errors of a frame are
+        reported by its own result, since the reply is already streaming.
+            - frames:   an iterable of the encoded frames, read lazily as they arrive
+            - backend:  the detector backend used to find the faces
+            - stride:   the number of frames for every processed one
+            - return:   a generator of dictionaries: one for every processed frame, with the track and
+                        the aggregated identity of every face and the summary of the tracks ended in the
+                        frame, and a last one with the summary of the tracks still open
+    """
+    tracker = IoUTracker(TRACK_IOU_THRESHOLD, TRACK_MAX_MISSED, TRACK_REEMBED_IOU, TRACK_CONFIRM_VOTES)
+
+    for i, data in enumerate(frames):
+        # Skipped frames are not even decoded
+        if i % stride != 0:
+            continue
+
+        img = decode_image(data)
+
+        if img is None:
+            yield {KEY_FRAME: i,
+                   KEY_MESSAGE: NOT_DECODABLE_MESSAGE,
+                   KEY_STATUS: STATUS_FAIL}
+            continue
+
+        try:
+            # A frame without faces still updates the tracker, whose tracks miss the frame. The
+            # pixels are detected without the digest, so the frame bypasses the detection cache
+            try:
+                detections = detect_faces(img.pixels, backend=backend)
+            except ValueError:
+                detections = FaceDetections(img.pixels, list())
+
+            tracks = tracker.update(detections.areas)
+
+            # Only the faces of the tracks that need it flow through the embedding and the matching
+            pending = [(face, track) for face, track in zip(detections.faces, tracks) if tracker.needs_embedding(track)]
+            match_faces(FaceDetections(detections.image, [face for face, _ in pending]))
+
+            for face, track in pending:
+                track.embedded_area = face.area
+                track.vote(face.identity)
+
+            result = {KEY_FRAME: i,
+                      KEY_STATUS: STATUS_SUCCESS,
+                      KEY_FACES: [{KEY_TRACK: track.track_id, KEY_COORDINATES: face.area, KEY_IDENTITY: track.identity}
+                                  for face, track in zip(detections.faces, tracks)]}
+
+            # The ended tracks are reported once and then forgotten, so a long stream uses bounded memory
+            ended = tracker.pop_ended()
+
+            if len(ended) > 0:
+                result[KEY_TRACKS] = [track.summary() for track in ended]
+
+            yield result
+
+        except OSError:
+            yield {KEY_FRAME: i,
+                   KEY_MESSAGE: 'Could not analyze the frame: internal errors',
+                   KEY_STATUS: STATUS_FAIL}
+        except QueueFullError:
+            yield {KEY_FRAME: i,
+                   KEY_MESSAGE: BUSY_MESSAGE,
+                   KEY_STATUS: STATUS_FAIL}
+        except InferenceTimeoutError:
+            yield {KEY_FRAME: i,
+                   KEY_MESSAGE: INFERENCE_TIMEOUT_MESSAGE,
+                   KEY_STATUS: STATUS_FAIL}
+
+    yield {KEY_MESSAGE: 'Stream ended',
+           KEY_STATUS: STATUS_SUCCESS,
+           KEY_TRACKS: [track.summary() for track in tracker.finish()]}
+
+
+def is_ready() -> dict:
+    """
+        This method reports if the models have been loaded and warmed up
+            - return: a dictionary with the readiness status
+    """
+    if inference_executor.ready:
+        return {KEY_MESSAGE: 'Models loaded and warmed up',
+                KEY_STATUS: STATUS_SUCCESS}
+    
+    if inference_executor.error is not None:
+        return {KEY_MESSAGE: f'Could not load the models: {inference_executor.error}',
+                KEY_STATUS: STATUS_FAIL}
+
+    return {KEY_MESSAGE: 'Models are warming up',
+            KEY_STATUS: STATUS_FAIL}
+
+
+def get_gallery_cache_stats() -> dict:
+    """
+        This method returns the hit/miss/reload counters of the gallery cache
+    """
+    return gallery_cache.stats()
+
+
+def get_detection_cache_stats() -> dict:
+    """
+        This method returns the hit rate and the size of the detection cache
+    """
+    return detection_cache.stats()
+
+
+def get_batching_stats() -> dict:
+    """
+        This method returns the histograms of the embedding batch sizes and wait times
+    """
+    return embedding_batcher.stats()
+
+
+def extract_faces(img, return_image=False, extension=DEFAULT_ENCODING_EXTENSION, backend=BACKEND):
     """
         This method is used to extract all the faces from the input image
-            - file_name:    the name of the file where the image is stored
+            - img:          the decoded image, the name of the file where the image is stored, or its detections
             - return_image: if False the method returns a list with the face coordinates, otherwise
                             the method returns a base64 encoded image with the facial areas drawn on it
+            - extension:    the extension that defines the format of the returned image
+            - backend:      the detector backend used to find the faces
             - return:       a list of face coordinates or a b64 encoded image, according to return_image param
             - raise:        a ValueError if the face is not found in the image
     """
-    wrapper = DeepFaceWrapper(file_name, BACKEND, MODEL)
-    areas = wrapper.extract_facial_areas()
+    detections = detect_faces(img, backend=backend)
 
     if return_image:
-        img = imread(filename=file_name)
-
-        for area in areas:
-            pt1 = (area['x1'], area['y1'])
-            pt2 = (area['x2'], area['y2'])
-            img = rectangle(img, pt1, pt2, (255, 255, 0), 1)
-
-        # Write the modified img to a file
-        imwrite(file_name, img)
-
-        # Turn the image into b64 
-        with open(file_name, 'rb') as data:
-            encoded_bytes = b64encode(data.read())
-
-        img = encoded_bytes.decode('utf-8')
-
-        return img
+        return draw_faces(detections, extension)
     else:
-        return areas
+        return detections.areas
     
 
 class DeepFaceWrapper:
 
-    def __init__(self, img, backend, model) -> None:
+    def __init__(self, img, backend, model, executor: InferenceExecutor = None, batcher: MicroBatcher = None,
+                 max_side: int = None, min_face_size: int = 0) -> None:
         """
             - img:  the img whose representation will be generated. This could be a path
                         to an existing file, or a numpy array
             - backend:  specify which face detector backend to use
             - model:    specify the model used to generate the embedding
+            - executor: the executor that runs the inferences with the preloaded models. If it
+                        is not specified, or it serves another model, the inferences run in process
+            - batcher:  the batcher that merges the embeddings with the ones of concurrent requests. It
+                        is used only together with the executor it dispatches to
+            - max_side: the longest side of the copy of the image used to detect the faces. None
+                        detects the faces at full resolution
+            - min_face_size:    the shortest side, in pixels of the original image, of the faces to keep
         """
         if isinstance(img, str) and not isfile(img):
             raise OSError('The file does not exist')
 
+        # The detector backend is chosen for every detection, only the model is bound to the executor
+        if executor is None or executor.model != model:
+            executor = InferenceExecutor(backend, model)
+            batcher = None
+
         self.img = img
         self.backend = backend
         self.model = model
+        self.executor = executor
+        self.batcher = batcher
+        self.max_side = max_side
+        self.min_face_size = min_face_size
+
+        self._detections = None
 
-    def generate_embeddings(self):
+    def detect(self, enforce_detection=True) -> FaceDetections:
         """
-            This method generates all the embeddings for faces found in the image
-            and returns it.
-            - Returns: the list of embeddings. The number of elements is the number of found faces
+            This method detects the faces in the image and aligns them to the input shape of the
+            recognition model. The detection runs once, the later calls reuse its result.
+            - Returns:  the detections of the image
+            - Raise:    ValueError if enforce_detection is True and no face is found in the image
         """
-        tic = time.time()
+        if self._detections is None:
+            img = imread(filename=self.img) if isinstance(self.img, str) else self.img
+            small, scale = self._downscale(img)
+            faces = list()
 
-        representations = represent(img_path=self.img, detector_backend=self.backend, model_name=self.model)
-        embeddings = list()
+            # Detect and align the faces with the preloaded detector backend, returning
+            # the face pixels already resized to the input shape of the model
+            for crop, facial_area, confidence in self.executor.detect(small, enforce_detection, self.backend):
+                # Map the facial area back to the coordinates of the original image
+                area = {'x1': int(facial_area['x'] / scale),
+                        'y1': int(facial_area['y'] / scale),
+                        'x2': int((facial_area['x'] + facial_area['w']) / scale),
+                        'y2': int((facial_area['y'] + facial_area['h']) / scale)}
 
-        for rep in representations:
-            embeddings.append(rep['embedding'])
+                # Skip the tiny faces before paying for their crop
+                if min(area['x2'] - area['x1'], area['y2'] - area['y1']) < self.min_face_size:
+                    continue
 
-        tac = time.time()
+                if scale < 1:
+                    crop = self._crop_full_resolution(img, area, crop)
 
-        print("Spent time generating representation: {}".format(tac - tic))
+                faces.append(DetectedFace(crop, area, confidence))
 
-        return embeddings
+            if len(faces) == 0 and enforce_detection:
+                raise ValueError('Face could not be detected')
 
-    def extract_facial_areas(self):
-        """
-            This method generates the coordinates of the faces found in the pictures
-                - Returns: a list of dictionary with the coordinates (x1, y1) and (x2, y2) for all the faces found
-        """
-        faces = extract_faces(img_path=self.img, detector_backend=self.backend)
-        coordinates = list()
+            self._detections = FaceDetections(self.img, faces)
+
+        return self._detections
+
+    def _downscale(self, img) -> tuple:
+        # Return the copy of the image used for the detection and its scale
+        side = max(img.shape[:2])
+
+        if self.max_side is None or side <= self.max_side:
+            return img, 1.0
+
+        scale = self.max_side / side
+        size = (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale)))
+
+        return resize(img, size, interpolation=INTER_AREA), scale
+
+    def _crop_full_resolution(self, img, area: dict, crop):
+        # Cut the face with a margin out of the full resolution image, and let the detector
+        # backend align it. The crop is bounded like the detection input, since the model
+        # input is much smaller anyway
+        margin_x = int((area['x2'] - area['x1']) * FACE_CROP_MARGIN)
+        margin_y = int((area['y2'] - area['y1']) * FACE_CROP_MARGIN)
+
+        face_img = img[max(0, area['y1'] - margin_y):min(img.shape[0], area['y2'] + margin_y),
+                       max(0, area['x1'] - margin_x):min(img.shape[1], area['x2'] + margin_x)]
+
+        face_img, _ = self._downscale(face_img)
+        refined = self.executor.detect(face_img, False, self.backend)
 
-        for face in faces:
-            entry = dict()
-            facial_area = face['facial_area']
+        # Without a face deepface returns the whole input as a face, then the low resolution crop is kept
+        height, width = face_img.shape[:2]
+        refined = [face for face in refined if (face[1]['w'], face[1]['h']) != (width, height)]
 
-            # Set face points
-            entry['x1'] = facial_area['x']
-            entry['y1'] = facial_area['y']
-            entry['x2'] = facial_area['x'] + facial_area['w']
-            entry['y2'] = facial_area['y'] + facial_area['h']
+        if len(refined) == 0:
+            return crop
 
-            coordinates.append(entry)
+        # The crop could contain parts of other faces, keep the largest one
+        refined_crop, _, _ = max(refined, key=lambda face: face[1]['w'] * face[1]['h'])
 
-        return coordinates
+        return refined_crop
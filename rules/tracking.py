@@ -0,0 +1,154 @@
+from collections import Counter
+from dataclasses import dataclass, field
+
+
+def box_iou(a: dict, b: dict) -> float:
+    """
+        This function computes the intersection over union of two facial areas
+            - a, b:     the areas, as dictionaries with the x1, y1, x2, y2 keys
+            - return:   0 for disjoint areas, 1 for identical areas
+    """
+    width = min(a['x2'], b['x2']) - max(a['x1'], b['x1'])
+    height = min(a['y2'], b['y2']) - max(a['y1'], b['y1'])
+
+    if width <= 0 or height <= 0:
+        return 0.0
+
+    intersection = width * height
+    union = (a['x2'] - a['x1']) * (a['y2'] - a['y1']) + (b['x2'] - b['x1']) * (b['y2'] - b['y1']) - intersection
+
+    return intersection / union if union > 0 else 0.0
+
+
+@dataclass
+class Track:
+    """
+        A face followed across the frames of a stream.
+            - track_id:         the identifier of the track, unique within its stream
+            - area:             the facial area of the last frame where the face was detected
+            - embedded_area:    the facial area of the last embedded face, None if it was never embedded
+            - votes:            how many times every identity was matched, None counts the unknown matches
+            - frames:           the number of frames where the face was detected
+            - missed:           the number of consecutive processed frames where the face was not detected
+    """
+    track_id: int
+    area: dict
+    embedded_area: dict = None
+    votes: Counter = field(default_factory=Counter)
+    frames: int = 1
+    missed: int = 0
+
+    @property
+    def identity(self) -> str:
+        """
+            The identity matched most times, None if the face was never recognized
+        """
+        known = [(identity, count) for identity, count in self.votes.most_common() if identity is not None]
+
+        return known[0][0] if len(known) > 0 else None
+
+    def vote(self, identity: str):
+        self.votes[identity] += 1
+
+    def summary(self) -> dict:
+        return {'track_id': self.track_id, 'identity': self.identity, 'frames': self.frames,
+                'votes': {str(identity): count for identity, count in self.votes.items()}}
+
+
+class IoUTracker:
+    """
+        This class follows the faces of a stream of frames by the overlap of their facial
+        areas. It is cheap enough to run on every processed frame, so that the embedding
+        of a face is computed only when its track is new or when the face moved enough to
+        look different, and the identities of a track are aggregated over its frames.
+    """
+
+    def __init__(self, iou_threshold: float = 0.3, max_missed: int = 5, reembed_iou: float = 0.5,
+                 confirm_votes: int = 3) -> None:
+        """
+            - iou_threshold:    the minimum overlap of a face with the last area of a track to continue it
+            - max_missed:       the processed frames a track survives without being detected
+            - reembed_iou:      a face is embedded again when its overlap with the last embedded area is lower
+            - confirm_votes:    the votes after which a track is not embedded anymore, unless the face moves
+        """
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.reembed_iou = reembed_iou
+        self.confirm_votes = confirm_votes
+
+        self.tracks = dict()
+        self.ended = list()
+        self._next_id = 0
+
+    def update(self, areas: list) -> list:
+        """
+            This method assigns the facial areas of a frame to the tracks, greedily by decreasing
+            overlap. The areas that continue no track start a new one, the tracks not detected
+            for more than max_missed frames are ended.
+                - areas:    the facial areas detected in the frame
+                - return:   the track of every area, in the same order
+        """
+        pairs = sorted(((box_iou(area, track.area), i, track_id)
+                        for i, area in enumerate(areas) for track_id, track in self.tracks.items()), reverse=True)
+        assigned = [None] * len(areas)
+        continued = set()
+
+        for iou, i, track_id in pairs:
+            if iou < self.iou_threshold:
+                break
+
+            if assigned[i] is None and track_id not in continued:
+                track = self.tracks[track_id]
+                track.area = areas[i]
+                track.frames += 1
+                track.missed = 0
+                assigned[i] = track
+                continued.add(track_id)
+
+        for track_id, track in list(self.tracks.items()):
+            if track_id not in continued:
+                track.missed += 1
+
+                if track.missed > self.max_missed:
+                    self.ended.append(self.tracks.pop(track_id))
+
+        for i, area in enumerate(areas):
+            if assigned[i] is None:
+                assigned[i] = Track(self._next_id, area)
+                self.tracks[self._next_id] = assigned[i]
+                self._next_id += 1
+
+        return assigned
+
+    def needs_embedding(self, track: Track) -> bool:
+        """
+            This method tells if the face of a track must be embedded in the current frame: the
+            track is new, it has not collected enough votes yet, or the face moved since its last embedding
+        """
+        if track.embedded_area is None:
+            return True
+
+        if sum(track.votes.values()) < self.confirm_votes:
+            return True
+
+        return box_iou(track.area, track.embedded_area) < self.reembed_iou
+
+    def pop_ended(self) -> list:
+        """
+            This method returns the tracks ended since its last call and forgets them, so that a
+            long stream does not keep all of its tracks
+                - return: the ended tracks, ordered by identifier
+        """
+        ended, self.ended = self.ended, list()
+
+        return sorted(ended, key=lambda track: track.track_id)
+
+    def finish(self) -> list:
+        """
+            This method ends all the tracks
+                - return: every track of the stream not returned by pop_ended yet, ordered by identifier
+        """
+        self.ended.extend(self.tracks.values())
+        self.tracks.clear()
+
+        return self.pop_ended()